@@ -26,7 +26,7 @@ from flask import request, abort
 from flask_restful import Resource, reqparse
 from flask_restful_swagger import swagger
 from app.ws.mtblsWSclient import WsClient
-from app.ws.utils import get_table_header, totuples
+from app.ws.utils import get_table_header, totuples, check_if_match, etag_header, is_not_modified, not_modified
 
 """
 MTBLS Assay Tables
@@ -149,6 +149,7 @@ class AssayTable(Resource):
             abort(403)
 
         assay_file_name = os.path.join(study_location, assay_file_name)
+        check_if_match(assay_file_name)
 
         assay_df = pd.read_csv(assay_file_name, sep="\t", header=0, encoding='utf-8')
         assay_df = assay_df.replace(np.nan, '', regex=True)
@@ -179,7 +180,7 @@ class AssayTable(Resource):
 
         df_dict = totuples(assay_df.reset_index(), row)
 
-        return df_dict
+        return df_dict, 200, etag_header(assay_file_name)
 
 
 class EditAssayFile(Resource):
@@ -252,6 +253,8 @@ class EditAssayFile(Resource):
             abort(403)
 
         assay_file_name = os.path.join(study_location, assay_file_name)
+        if is_not_modified(assay_file_name):
+            return not_modified(assay_file_name)
         logger.info('Trying to load Assay (%s) for Study %s', assay_file_name, study_id)
         # Get the Assay table or create a new one if it does not already exist
         assay_df = pd.read_csv(assay_file_name, sep="\t", header=0, encoding='utf-8')
@@ -263,7 +266,7 @@ class EditAssayFile(Resource):
         # Get an indexed header row
         df_header = get_table_header(assay_df)
 
-        return {'header': df_header, 'data': df_data_dict}
+        return {'header': df_header, 'data': df_data_dict}, 200, etag_header(assay_file_name)
 
     @swagger.operation(
         summary="Add a new row to the given Assay file <b>(Deprecated)</b>",
@@ -357,6 +360,7 @@ class EditAssayFile(Resource):
             abort(403)
 
         assay_file_name = os.path.join(study_location, assay_file_name)
+        check_if_match(assay_file_name)
 
         assay_df = pd.read_csv(assay_file_name, sep="\t", header=0, encoding='utf-8')
         assay_df = assay_df.replace(np.nan, '', regex=True)  # Remove NaN
@@ -373,7 +377,7 @@ class EditAssayFile(Resource):
         # Get an indexed header row
         df_header = get_table_header(assay_df)
 
-        return {'header': df_header, 'data': df_data_dict}
+        return {'header': df_header, 'data': df_data_dict}, 200, etag_header(assay_file_name)
 
     @swagger.operation(
         summary="Update existing rows in the given Assay file <b>(Deprecated)</b>",
@@ -472,6 +476,7 @@ class EditAssayFile(Resource):
             abort(403)
 
         assay_file_name = os.path.join(study_location, assay_file_name)
+        check_if_match(assay_file_name)
 
         assay_df = pd.read_csv(assay_file_name, sep="\t", header=0, encoding='utf-8')
         assay_df = assay_df.replace(np.nan, '', regex=True)  # Remove NaN
@@ -501,7 +506,7 @@ class EditAssayFile(Resource):
         # Get an indexed header row
         df_header = get_table_header(assay_df)
 
-        return {'header': df_header, 'data': df_data_dict}
+        return {'header': df_header, 'data': df_data_dict}, 200, etag_header(assay_file_name)
 
     @swagger.operation(
         summary="Delete a row of the given Assay file <b>(Deprecated)</b>",
@@ -585,6 +590,7 @@ class EditAssayFile(Resource):
             abort(403)
 
         assay_file_name = os.path.join(study_location, assay_file_name)
+        check_if_match(assay_file_name)
 
         assay_df = pd.read_csv(assay_file_name, sep="\t", header=0, encoding='utf-8')
         assay_df = assay_df.replace(np.nan, '', regex=True)  # Remove NaN
@@ -611,4 +617,4 @@ class EditAssayFile(Resource):
         # Get an indexed header row
         df_header = get_table_header(assay_df)
 
-        return {'header': df_header, 'data': df_data_dict}
+        return {'header': df_header, 'data': df_data_dict}, 200, etag_header(assay_file_name)
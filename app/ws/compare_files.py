@@ -17,15 +17,17 @@
 #  Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
 
 import logging
-import numpy as np
+import os
+
 import pandas as pd
 
-from flask import request, abort
+from flask import request, abort, safe_join
+from flask import current_app as app
 from flask.json import jsonify
 from flask_restful import Resource, reqparse
 from flask_restful_swagger import swagger
 from app.ws.mtblsWSclient import WsClient
-from app.ws.utils import logger, log_request, read_tsv
+from app.ws.utils import logger, log_request
 from app.ws.isaApiClient import IsaApiClient
 
 
@@ -33,32 +35,200 @@ logger = logging.getLogger('wslog')
 wsc = WsClient()
 iac = IsaApiClient()
 
-def diff_pd(df1, df2):
-   # https://stackoverflow.com/questions/17095101/outputting-difference-in-two-pandas-dataframes-side-by-side-highlighting-the-d
-    """Identify differences between two pandas DataFrames"""
-    assert (df1.columns == df2.columns).all(), \
-        "DataFrame column names are different"
-    if any(df1.dtypes != df2.dtypes):
-        "Data Types are different, trying to convert"
-        df2 = df2.astype(df1.dtypes)
-    if df1.equals(df2):
-        return None
-    else:
-        # need to account for np.nan != np.nan returning True
-        diff_mask = (df1 != df2) & ~(df1.isnull() & df2.isnull())
-        ne_stacked = diff_mask.stack()
-        changed = ne_stacked[ne_stacked]
-        changed.index.names = ['id', 'col']
-        difference_locations = np.where(diff_mask)
-        changed_from = df1.values[difference_locations]
-        changed_to = df2.values[difference_locations]
-        return pd.DataFrame({'from': changed_from, 'to': changed_to},
-                            index=changed.index)
+
+def read_tsv_header(file_name):
+    return list(pd.read_csv(file_name, sep="\t", nrows=0, encoding='utf-8').columns)
+
+
+def read_tsv_chunks(file_name, columns, chunk_size):
+    """
+    Read a TSV file in chunks of rows, all values as strings, only keeping the given columns (in that order)
+    """
+    for chunk_df in pd.read_csv(file_name, sep="\t", header=0, encoding='utf-8', dtype=str, keep_default_na=False,
+                                chunksize=chunk_size):
+        yield chunk_df[columns]
+
+
+def get_row_keys(chunk_df, key_columns, first_row):
+    if key_columns:
+        if len(key_columns) == 1:
+            return list(chunk_df[key_columns[0]])
+        return list(zip(*[chunk_df[column] for column in key_columns]))
+    return list(range(first_row, first_row + len(chunk_df)))  # No key columns, so compare rows by position
+
+
+def hash_tsv_rows(file_name, columns, key_columns, chunk_size):
+    """
+    Stream a TSV file and hash the values of each row, only looking at the given columns
+    :return: dict of row key -> (row number, row hash), in file order
+    """
+    rows = {}
+    row_number = 0
+    for chunk_df in read_tsv_chunks(file_name, columns, chunk_size):
+        hashes = pd.util.hash_pandas_object(chunk_df, index=False).values
+        for key, row_hash in zip(get_row_keys(chunk_df, key_columns, row_number), hashes):
+            if key in rows:
+                key = unique_key(rows, key)
+            rows[key] = (row_number, int(row_hash))
+            row_number += 1
+    return rows
+
+
+def unique_key(rows, key):
+    # Duplicated key values are told apart by their occurrence, ie. the 2nd row with key 'x' is ('x', 2)
+    occurrence = 2
+    while (key, occurrence) in rows:
+        occurrence += 1
+    return key, occurrence
+
+
+def get_moved_keys(keys_in_old_order, new_positions):
+    """
+    Find the rows that changed place. The rows that kept their order are the longest increasing run of positions
+    in the new file, the others have been moved
+    """
+    positions = [new_positions[key] for key in keys_in_old_order]
+    tails = []  # Patience sort, tails[i] is the index of the smallest tail of an increasing run of length i+1
+    previous = [-1] * len(positions)
+    for idx, position in enumerate(positions):
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if positions[tails[mid]] < position:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo > 0:
+            previous[idx] = tails[lo - 1]
+        if lo == len(tails):
+            tails.append(idx)
+        else:
+            tails[lo] = idx
+
+    in_order = set()
+    idx = tails[-1] if tails else -1
+    while idx != -1:
+        in_order.add(idx)
+        idx = previous[idx]
+    return [key for idx, key in enumerate(keys_in_old_order) if idx not in in_order]
+
+
+def fetch_rows(file_name, columns, key_columns, keys, chunk_size):
+    """
+    Stream a TSV file again, only keeping the values of the rows with the given keys
+    """
+    wanted = set(keys)
+    found = {}
+    seen = {}
+    row_number = 0
+    for chunk_df in read_tsv_chunks(file_name, columns, chunk_size):
+        for key, values in zip(get_row_keys(chunk_df, key_columns, row_number), chunk_df.values.tolist()):
+            if key in seen:
+                key = unique_key(seen, key)
+            seen[key] = True
+            if key in wanted:
+                found[key] = values
+            row_number += 1
+    return found
+
+
+def diff_tsv_files(old_file_name, new_file_name, key_columns=None, chunk_size=None):
+    """
+    Compare two TSV (ISA-Tab) files without loading them fully into memory. Rows are matched on the key columns
+    (or on row number if no key columns are given) and compared using a hash of the values in the columns the
+    files have in common. Only the rows that differ are read again to list the changed values
+    :param old_file_name: full path to the original file
+    :param new_file_name: full path to the updated file
+    :param key_columns: list of column names that identify a row, ie. 'Sample Name'
+    :param chunk_size: number of rows to read at the time
+    :return: dict with the added, removed and reordered columns and the added, removed, moved and changed rows
+    """
+    if chunk_size is None:
+        chunk_size = app.config.get('TSV_DIFF_CHUNK_SIZE')
+    key_columns = key_columns or []
+
+    old_columns = read_tsv_header(old_file_name)
+    new_columns = read_tsv_header(new_file_name)
+    common_columns = [column for column in old_columns if column in new_columns]
+    for column in key_columns:
+        if column not in common_columns:
+            abort(400, "The key column '" + column + "' is not in both files")
+
+    old_rows = hash_tsv_rows(old_file_name, common_columns, key_columns, chunk_size)
+    new_rows = hash_tsv_rows(new_file_name, common_columns, key_columns, chunk_size)
+
+    removed = [key for key in old_rows if key not in new_rows]
+    added = [key for key in new_rows if key not in old_rows]
+    common_keys = [key for key in old_rows if key in new_rows]
+    changed = [key for key in common_keys if old_rows[key][1] != new_rows[key][1]]
+    moved = []
+    if key_columns:
+        moved = get_moved_keys(common_keys, {key: new_rows[key][0] for key in common_keys})
+
+    # Only the rows we report on are read again
+    old_values = fetch_rows(old_file_name, common_columns, key_columns, changed + removed, chunk_size)
+    new_values = fetch_rows(new_file_name, common_columns, key_columns, changed + added, chunk_size)
+
+    changed_rows = []
+    for key in changed:
+        changes = {}
+        for column, old_value, new_value in zip(common_columns, old_values[key], new_values[key]):
+            if old_value != new_value:
+                changes[column] = {'from': old_value, 'to': new_value}
+        changed_rows.append({'key': key, 'row': new_rows[key][0], 'changes': changes})
+
+    return {
+        'columns': {
+            'added': [column for column in new_columns if column not in old_columns],
+            'removed': [column for column in old_columns if column not in new_columns],
+            'reordered': [column for column in new_columns if column in old_columns] != common_columns
+        },
+        'rows': {
+            'added': [{'key': key, 'row': new_rows[key][0], 'values': dict(zip(common_columns, new_values[key]))}
+                      for key in added],
+            'removed': [{'key': key, 'row': old_rows[key][0], 'values': dict(zip(common_columns, old_values[key]))}
+                        for key in removed],
+            'moved': [{'key': key, 'from': old_rows[key][0], 'to': new_rows[key][0]} for key in moved],
+            'changed': changed_rows
+        },
+        'old_row_count': len(old_rows),
+        'new_row_count': len(new_rows)
+    }
+
+
+def get_audit_snapshot(study_location, file_name, audit_timestamp):
+    """
+    Find the file in the latest audit folder created at or before the given timestamp
+    :param audit_timestamp: a (partial) timestamp like 20200312143045 or 20200312, or 'latest'
+    :return: full path to the file in the audit folder
+    """
+    audit_path = os.path.join(study_location, app.config.get('UPDATE_PATH_SUFFIX'))
+    try:
+        folders = sorted(os.listdir(audit_path), reverse=True)
+    except FileNotFoundError:
+        folders = []
+
+    last_timestamp = audit_timestamp.ljust(14, '9')  # 20200312 means any time on the 12th
+    for folder in folders:
+        if audit_timestamp != 'latest' and folder > last_timestamp:
+            continue
+        snapshot = safe_join(audit_path, folder, file_name)
+        if os.path.isfile(snapshot):
+            return snapshot
+
+    abort(404, "Could not find " + file_name + " in an audit folder from " + audit_timestamp + " or before")
 
 
 class CompareTsvFiles(Resource):
     @swagger.operation(
         summary="Find the difference between two tsv (ISA-Tab) files",
+        notes="""Compare two sample, assay or MAF sheets, or compare a sheet with an earlier version of the same 
+        file in the study audit folder. Columns can be added, removed or reordered between the two files.</p>
+        Rows are matched on the 'key_columns' (ie. 'Sample Name'), so inserted, deleted and moved rows are found. 
+        Without key columns the rows are compared by their position in the files.</p>
+        To compare with an audit copy, give 'filename1' and an 'audit_timestamp' instead of 'filename2'. 
+        The latest audit copy created at or before the timestamp (ie. 20200312 or 20200312143045) is used, 
+        or use 'latest' for the most recent copy""",
         parameters=[
             {
                 "name": "study_id",
@@ -80,12 +250,30 @@ class CompareTsvFiles(Resource):
             {
                 "name": "filename2",
                 "description": "TSV filename two",
-                "required": True,
+                "required": False,
                 "allowEmptyValue": False,
                 "allowMultiple": False,
                 "paramType": "query",
                 "dataType": "string"
             },
+            {
+                "name": "key_columns",
+                "description": "Comma separated list of the columns that identify a row, ie. 'Sample Name'",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "dataType": "string"
+            },
+            {
+                "name": "audit_timestamp",
+                "description": "Compare filename1 with the audit copy from this time (or 'latest')",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "dataType": "string"
+            },
             {
                 "name": "user_token",
                 "description": "User API token",
@@ -100,6 +288,10 @@ class CompareTsvFiles(Resource):
                 "code": 200,
                 "message": "OK."
             },
+            {
+                "code": 400,
+                "message": "Bad Request. The key columns are not in both files."
+            },
             {
                 "code": 401,
                 "message": "Unauthorized. Access to the resource requires user authentication."
@@ -134,12 +326,20 @@ class CompareTsvFiles(Resource):
         parser = reqparse.RequestParser()
         parser.add_argument('filename1', help='TSV filename one')
         parser.add_argument('filename2', help='TSV filename two')
-        assay_filename = None
+        parser.add_argument('key_columns', help='Columns that identify a row')
+        parser.add_argument('audit_timestamp', help='Compare with the audit copy from this time')
+        filename1 = None
+        filename2 = None
+        key_columns = None
+        audit_timestamp = None
         if request.args:
             args = parser.parse_args(req=request)
-            filename1 = args['filename1'].lower() if args['filename1'] else None
-            filename2 = args['filename2'].lower() if args['filename2'] else None
-        if not filename1 or not filename2:
+            filename1 = args['filename1'].strip() if args['filename1'] else None
+            filename2 = args['filename2'].strip() if args['filename2'] else None
+            audit_timestamp = args['audit_timestamp'].strip() if args['audit_timestamp'] else None
+            if args['key_columns']:
+                key_columns = [column.strip() for column in args['key_columns'].split(',') if column.strip()]
+        if not filename1 or not (filename2 or audit_timestamp):
             logger.warning("Missing TSV filenames.")
             abort(404, "Missing TSV filenames.")
 
@@ -149,8 +349,18 @@ class CompareTsvFiles(Resource):
         if not read_access:
             abort(401, "Study does not exist or your do not have access to this study.")
 
-        location = study_location
-        df1 = read_tsv(filename1)
-        df2 = read_tsv(filename2)
-        diff_df = diff_pd(df1, df2)
-        return jsonify({"entries": diff_df})
+        if audit_timestamp:  # Compare the earlier (audit) version with the current file
+            new_file_name = safe_join(study_location, filename1)  # Check the file name before we look for it
+            old_file_name = get_audit_snapshot(study_location, filename1, audit_timestamp)
+        else:
+            old_file_name = safe_join(study_location, filename1)
+            new_file_name = safe_join(study_location, filename2)
+
+        try:
+            diff = diff_tsv_files(old_file_name, new_file_name, key_columns=key_columns)
+        except FileNotFoundError as e:
+            abort(404, "Could not find file. " + str(e))
+        except UnicodeDecodeError as e:
+            abort(400, "The files must be UTF-8 encoded to compare them. " + str(e))
+
+        return jsonify({"entries": diff})
@@ -0,0 +1,465 @@
+#  EMBL-EBI MetaboLights - https://www.ebi.ac.uk/metabolights
+#  Metabolomics team
+#
+#  European Bioinformatics Institute (EMBL-EBI), European Molecular Biology Laboratory, Wellcome Genome Campus, Hinxton, Cambridge CB10 1SD, United Kingdom
+#
+#  Copyright 2020 EMBL - European Bioinformatics Institute
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+import errno
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app as app
+
+try:
+    from gevent import monkey
+    from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+except ImportError:  # Not running under gevent, ie. the Flask development server
+    monkey = None
+
+"""
+Copy engine for study files
+
+A copy is planned first: the files under the source folder are listed with their size and modification time and
+compared with the destination folder, files that are already there are skipped. When the study or upload folder is
+given, the folders are listed with its file index, so only the folders that changed since the last copy (or listing)
+are read from the filesystem again, see FileIndex. When the source and destination are on the same filesystem the
+files are hard linked (or moved) instead of copied, the rest is copied by a pool of threads.
+
+Zip files are extracted the same way, see extract_zip_files(): the members of all the archives are extracted by the
+pool of threads, members that are already there with the same size and CRC are skipped.
+"""
+
+logger = logging.getLogger('wslog')
+
+CopyTask = namedtuple('CopyTask', ['source', 'destination', 'size'])
+FileState = namedtuple('FileState', ['size', 'mtime_ns'])
+
+
+class CopyStats:
+    """
+    Progress of a copy. The progress function, if given, is called with this object after every file
+    """
+
+    def __init__(self, progress=None):
+        self.files_total = 0
+        self.bytes_total = 0
+        self.files_done = 0
+        self.bytes_done = 0
+        self.copied = 0
+        self.linked = 0
+        self.moved = 0
+        self.skipped = 0
+        self.errors = []
+        self.start_time = time.time()
+        self.progress = progress
+        self.lock = get_thread_lock()
+
+    def add_planned(self, tasks):
+        self.files_total += len(tasks)
+        self.bytes_total += sum(task.size for task in tasks)
+
+    def add_skipped(self, count):
+        self.skipped += count
+
+    def add_unchanged(self, task):
+        # A planned file that turned out to be there already, ie. an extracted zip member
+        with self.lock:
+            self.files_total -= 1
+            self.bytes_total -= task.size
+            self.skipped += 1
+            if self.progress:
+                self.progress(self)
+
+    def add_done(self, task, action, error=None):
+        with self.lock:
+            self.files_done += 1
+            if error:
+                self.errors.append(task.source + ': ' + str(error))
+            else:
+                self.bytes_done += task.size
+                setattr(self, action, getattr(self, action) + 1)
+            if self.progress:  # In the lock, so the progress never goes back
+                self.progress(self)
+
+    def get_seconds(self):
+        return max(time.time() - self.start_time, 0.001)
+
+    def to_dict(self):
+        seconds = self.get_seconds()
+        return {'files': self.files_total, 'copied': self.copied, 'linked': self.linked, 'moved': self.moved,
+                'skipped': self.skipped, 'errors': len(self.errors), 'bytes': self.bytes_done,
+                'seconds': round(seconds, 2), 'bytesPerSecond': round(self.bytes_done / seconds),
+                'filesPerSecond': round(self.files_done / seconds, 2)}
+
+    def __str__(self):
+        stats = self.to_dict()
+        return ('%(files)s files (%(copied)s copied, %(linked)s linked, %(moved)s moved, %(errors)s errors), '
+                '%(skipped)s unchanged files skipped, %(bytes)s bytes in %(seconds)s seconds. '
+                '%(bytesPerSecond)s bytes/s, %(filesPerSecond)s files/s' % stats)
+
+
+def get_thread_lock():
+    """
+    Lock shared by the threads of the copy and scan pools. Under gevent threading.Lock is a gevent lock, which can not
+    be used from gevent's pool of real threads, so use the original (not patched) lock
+    """
+    if monkey is not None and monkey.is_module_patched('threading'):
+        return monkey.get_original('threading', 'Lock')()
+    return threading.Lock()
+
+
+def get_copy_pool():
+    # Same as the file index scan pool, real threads also when running under gevent
+    size = app.config.get('FILE_COPY_THREADS')
+    if monkey is not None and monkey.is_module_patched('threading'):
+        return GeventThreadPoolExecutor(max_workers=size)
+    return ThreadPoolExecutor(max_workers=size)
+
+
+def list_files(folder, include=None, location=None):
+    """
+    All the files and folders under a folder, without following symbolic links to folders
+    :param folder: full path to the folder
+    :param include: function that is given the relative path and os.DirEntry, returns False to leave it out
+    :param location: study or upload folder the folder is in, to list the folders with its file index
+    :return: dict of relative path: FileState for the files, and a list of relative paths of the folders
+    """
+    if location:
+        return list_indexed_files(folder, include, location)
+
+    files = {}
+    folders = []
+    pending = ['']
+    while pending:
+        relative_folder = pending.pop()
+        for entry in os.scandir(os.path.join(folder, relative_folder)):
+            relative_path = os.path.join(relative_folder, entry.name)
+            if include and not include(relative_path, entry):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(relative_path)
+                    pending.append(relative_path)
+                else:
+                    stat = entry.stat()
+                    files[relative_path] = FileState(stat.st_size, stat.st_mtime_ns)
+            except OSError as e:
+                logger.error('Could not read ' + entry.path + '. ' + str(e))
+    return files, folders
+
+
+def list_indexed_files(folder, include, location):
+    # Imported here, app.ws.file_index imports app.ws.utils which imports this module
+    from app.ws.file_index import FileIndex, get_scan_pool, try_stat_file
+
+    folder = os.path.normpath(folder)
+    file_paths = []
+    folders = []
+    with FileIndex(location) as file_index:
+        file_index.prefetch(folder, lambda entry: not include or include(os.path.relpath(entry.path, folder), entry))
+        pending = [folder]
+        while pending:
+            current = pending.pop()
+            try:
+                entries = file_index.scan(current)
+            except OSError as e:
+                if current == folder:
+                    raise
+                logger.error('Could not list folder ' + current + '. ' + str(e))
+                continue
+            for entry in entries:
+                relative_path = os.path.relpath(entry.path, folder)
+                if include and not include(relative_path, entry):
+                    continue
+                if entry.is_dir():
+                    folders.append(relative_path)
+                    pending.append(entry.path)
+                else:
+                    file_paths.append(entry.path)
+
+    # The index only has the folders and names, a file changed in place does not change the modification time of its
+    # folder, so check the files themselves
+    files = {}
+    with get_scan_pool() as pool:
+        for entry in pool.map(try_stat_file, file_paths):
+            if entry is not None:
+                files[os.path.relpath(entry.path, folder)] = FileState(entry.size, entry.mtime_ns)
+    return files, folders
+
+
+def is_same_file(source_state, destination_state):
+    # copy2 keeps the modification time, compare in whole seconds as not all (NFS) filesystems keep more
+    return source_state.size == destination_state.size and \
+        source_state.mtime_ns // 1000000000 == destination_state.mtime_ns // 1000000000
+
+
+def plan_copy(source, destination, include=None, stats=None, source_location=None, destination_location=None):
+    """
+    Work out which files have to be copied
+    :param source_location: study or upload folder the source is in, to list it with the file index
+    :param destination_location: study or upload folder the destination is in
+    :return: list of CopyTask, list of folders to create, and the relative paths of the files only in the destination
+    """
+    source_files, source_folders = list_files(source, include, source_location)
+    destination_files = {}
+    if os.path.isdir(destination):
+        destination_files = list_files(destination, include, destination_location)[0]
+
+    tasks = []
+    skipped = 0
+    for relative_path, source_state in sorted(source_files.items()):
+        destination_state = destination_files.pop(relative_path, None)
+        if destination_state is not None and is_same_file(source_state, destination_state):
+            skipped += 1
+        else:
+            tasks.append(CopyTask(os.path.join(source, relative_path), os.path.join(destination, relative_path),
+                                  source_state.size))
+    if stats:
+        stats.add_skipped(skipped)
+    folders = [os.path.join(destination, folder) for folder in sorted(source_folders)]
+    return tasks, folders, sorted(destination_files)
+
+
+def get_copy_plan(source, destination, include=None, purge=False, source_location=None, destination_location=None):
+    """
+    Dry run of copy_folder(), nothing is copied or removed
+    :return: dict with the relative paths of the files that would be copied and removed
+    """
+    stats = CopyStats()
+    tasks, folders, destination_only = plan_copy(source, destination, include=include, stats=stats,
+                                                 source_location=source_location,
+                                                 destination_location=destination_location)
+    return {'copy': [os.path.relpath(task.source, source) for task in tasks],
+            'remove': destination_only if purge else [],
+            'folders': [os.path.relpath(folder, destination) for folder in folders if not os.path.isdir(folder)],
+            'skipped': stats.skipped, 'bytes': sum(task.size for task in tasks)}
+
+
+def copy_folder(source, destination, include=None, purge=False, link=None, move=False, progress=None,
+                source_location=None, destination_location=None):
+    """
+    Copy all new and changed files from one folder to another
+    :param source: full path to the source folder
+    :param destination: full path to the destination folder, created if it does not exist
+    :param include: function that is given the relative path and os.DirEntry, returns False to not copy it
+    :param purge: remove the files in the destination that are not in the source (with include)
+    :param link: hard link the files if possible, default FILE_COPY_HARD_LINKS
+    :param move: move the files instead of copying them
+    :param progress: function that is given the CopyStats after every file
+    :param source_location: study or upload folder the source is in, to list it with the file index
+    :param destination_location: study or upload folder the destination is in
+    :return: CopyStats
+    """
+    stats = CopyStats(progress)
+    tasks, folders, destination_only = plan_copy(source, destination, include=include, stats=stats,
+                                                 source_location=source_location,
+                                                 destination_location=destination_location)
+    os.makedirs(destination, exist_ok=True)
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+
+    if purge:
+        for relative_path in destination_only:
+            try:
+                os.remove(os.path.join(destination, relative_path))
+            except OSError as e:
+                logger.error('Could not remove ' + os.path.join(destination, relative_path) + '. ' + str(e))
+
+    copy_files(tasks, stats=stats, link=link, move=move)
+    logger.info('Copied %s to %s: %s', source, destination, str(stats))
+    return stats
+
+
+def copy_files(tasks, stats=None, link=None, move=False):
+    """
+    Copy files with a pool of threads. Files are first written under a temporary name and then renamed, so a
+    destination file is never half written
+    :param tasks: list of CopyTask
+    :param link: hard link the files if possible, default FILE_COPY_HARD_LINKS. Never used when moving the files
+    :param move: move (rename) the files instead of copying them, only when asked for
+    :return: CopyStats
+    """
+    if stats is None:
+        stats = CopyStats()
+    if link is None:
+        link = app.config.get('FILE_COPY_HARD_LINKS')
+    stats.add_planned(tasks)
+    if not tasks:
+        return stats
+
+    # Only try hard links (and renames) until we find the source and destination are on different filesystems
+    options = {'link': link and not move, 'rename': move, 'move': move}
+
+    def transfer(task):
+        try:
+            stats.add_done(task, transfer_file(task, options))
+        except OSError as e:
+            logger.error('Could not copy %s to %s. %s', task.source, task.destination, str(e))
+            stats.add_done(task, None, error=e)
+
+    with get_copy_pool() as pool:
+        list(pool.map(transfer, tasks))
+    return stats
+
+
+def transfer_file(task, options):
+    destination_folder, destination_name = os.path.split(task.destination)
+    if options['rename']:
+        try:
+            os.replace(task.source, task.destination)
+            return 'moved'
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            options['rename'] = False
+            logger.info('Can not move %s to %s, different filesystems. Copying instead', task.source,
+                        destination_folder)
+
+    temp_file = os.path.join(destination_folder, '.' + destination_name + '.' + uuid.uuid4().hex[:8] + '.copying')
+    try:
+        if options['link']:
+            try:
+                os.link(task.source, temp_file)
+                os.replace(temp_file, task.destination)
+                return 'linked'
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                    raise
+                options['link'] = False
+                logger.info('Can not hard link %s to %s (%s). Copying instead', task.source, destination_folder,
+                            str(e))
+
+        shutil.copy2(task.source, temp_file)  # Keeps the modification time, so the next copy can skip the file
+        os.replace(temp_file, task.destination)
+    finally:
+        if os.path.lexists(temp_file):
+            os.remove(temp_file)
+    if options['move']:
+        os.remove(task.source)
+        return 'moved'
+    return 'copied'
+
+
+def extract_zip_files(zip_files, destination, include=None, progress=None):
+    """
+    Extract zip files with a pool of threads. Members are streamed to a temporary file and then renamed, members that
+    would end up outside the destination folder (ie. '../' or absolute paths) are not extracted
+    :param zip_files: list of full paths to the zip files
+    :param destination: full path to the folder to extract to
+    :param include: function that is given the member name, returns False to not extract it
+    :param progress: function that is given the CopyStats after every member
+    :return: CopyStats, extracted members count as copied
+    """
+    stats = CopyStats(progress)
+    destination = os.path.normpath(destination)
+    tasks = []
+    for zip_file in zip_files:
+        try:
+            with zipfile.ZipFile(zip_file) as archive:
+                members = archive.infolist()
+        except (OSError, zipfile.BadZipFile) as e:
+            logger.error('Could not read zip file ' + zip_file + '. ' + str(e))
+            stats.errors.append(zip_file + ': ' + str(e))
+            continue
+
+        to_extract = []
+        for member in members:
+            target = get_member_path(destination, member.filename)
+            if target is None:
+                logger.warning('Not extracting %s from %s, it is outside the study folder', member.filename, zip_file)
+                stats.errors.append(zip_file + ': ' + member.filename + ' is outside the study folder')
+            elif include and not include(member.filename):
+                continue
+            elif member.is_dir():
+                os.makedirs(target, exist_ok=True)
+            else:
+                to_extract.append((member, target))
+
+        # Split the members of an archive into batches, so each thread opens the archive only once
+        batch_count = max(1, min(app.config.get('FILE_COPY_THREADS'), len(to_extract)))
+        for batch in range(batch_count):
+            if to_extract[batch::batch_count]:
+                tasks.append((zip_file, to_extract[batch::batch_count]))
+
+    stats.add_planned([CopyTask(zip_file, target, member.file_size)
+                       for zip_file, batch in tasks for member, target in batch])
+
+    def extract(task):
+        zip_file, batch = task
+        try:
+            with zipfile.ZipFile(zip_file) as archive:
+                for member, target in batch:
+                    copy_task = CopyTask(zip_file, target, member.file_size)
+                    if is_extracted(member, target):  # Reads the file, so in the pool as well
+                        stats.add_unchanged(copy_task)
+                        continue
+                    try:
+                        extract_member(archive, member, target)
+                        stats.add_done(copy_task, 'copied')
+                    except (OSError, zipfile.BadZipFile, zlib.error, RuntimeError) as e:
+                        logger.error('Could not extract %s from %s. %s', member.filename, zip_file, str(e))
+                        stats.add_done(copy_task, None, error=e)
+        except (OSError, zipfile.BadZipFile) as e:
+            logger.error('Could not read zip file ' + zip_file + '. ' + str(e))
+            with stats.lock:
+                stats.errors.append(zip_file + ': ' + str(e))
+
+    if tasks:
+        with get_copy_pool() as pool:
+            list(pool.map(extract, tasks))
+    logger.info('Extracted %s to %s: %s', ', '.join(zip_files), destination, str(stats))
+    return stats
+
+
+def get_member_path(destination, member_name):
+    # Full path of a zip member in the destination folder, None if it would be outside of it
+    target = os.path.normpath(os.path.join(destination, member_name.replace('\\', '/')))
+    if os.path.isabs(member_name) or target == destination or \
+            os.path.commonpath([destination, target]) != destination:
+        return None
+    return target
+
+
+def is_extracted(member, target):
+    # Same size and CRC as the member, the file is only read when the size is the same
+    try:
+        if os.path.getsize(target) != member.file_size:
+            return False
+        crc = 0
+        with open(target, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                crc = zlib.crc32(chunk, crc)
+        return crc == member.CRC
+    except OSError:
+        return False
+
+
+def extract_member(archive, member, target):
+    destination_folder, destination_name = os.path.split(target)
+    os.makedirs(destination_folder, exist_ok=True)
+    temp_file = os.path.join(destination_folder, '.' + destination_name + '.' + uuid.uuid4().hex[:8] + '.extracting')
+    try:
+        # zipfile checks the CRC when the whole member has been read, a bad member raises BadZipFile
+        with archive.open(member) as source, open(temp_file, 'wb') as f:
+            shutil.copyfileobj(source, f, 1024 * 1024)
+        os.replace(temp_file, target)
+    finally:
+        if os.path.lexists(temp_file):
+            os.remove(temp_file)
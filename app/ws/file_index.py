@@ -0,0 +1,540 @@
+#  EMBL-EBI MetaboLights - https://www.ebi.ac.uk/metabolights
+#  Metabolomics team
+#
+#  European Bioinformatics Institute (EMBL-EBI), European Molecular Biology Laboratory, Wellcome Genome Campus, Hinxton, Cambridge CB10 1SD, United Kingdom
+#
+#  Copyright 2020 EMBL - European Bioinformatics Institute
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+import glob
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app as app
+
+try:
+    from gevent import monkey
+    from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+except ImportError:  # Not running under gevent, ie. the Flask development server
+    monkey = None
+
+from app.ws.utils import map_file_type
+
+"""
+Study file index
+
+Keep a list of all the files in a study (or upload) folder in a small SQLite database, so we do not have to list
+every folder on the (NFS) filesystem each time the files are requested. A folder is only listed again when its
+modification time has changed, or when it has not been checked for FILE_INDEX_MAX_AGE seconds. The file type and
+status are kept until the ISA-Tab files in the study folder change. The same listing gives the (recursive) size, file
+count and latest update time of the folders, see get_directory_stats(). The MD5 and SHA-256 checksums of the files
+are kept with the size and modification time they were worked out for, so only new and changed files are read again,
+see FileIndex.get_checksums().
+"""
+
+logger = logging.getLogger('wslog')
+
+# Increment when the tables below change, older index databases are then emptied and rebuilt
+index_version = 3
+index_schema = """
+CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, mtime_ns INTEGER, scanned_at REAL);
+CREATE TABLE IF NOT EXISTS files (folder TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, ctime_ns INTEGER,
+                                  is_dir INTEGER, file_type TEXT, status TEXT, is_folder INTEGER, isa_version TEXT,
+                                  PRIMARY KEY (folder, name));
+CREATE TABLE IF NOT EXISTS checksums (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, md5 TEXT, sha256 TEXT);
+"""
+
+DirectoryStats = namedtuple('DirectoryStats', ['size', 'file_count', 'folder_count', 'latest_mtime_ns',
+                                               'latest_ctime_ns'])
+FileChecksum = namedtuple('FileChecksum', ['size', 'md5', 'sha256'])
+
+
+class IndexedEntry:
+    """
+    A file or folder from the index. Has the same name, path and is_dir() as os.DirEntry, so it can be used instead
+    """
+    __slots__ = ('name', 'path', 'size', 'mtime_ns', 'ctime_ns', '_is_dir', 'file_type', 'status', 'is_folder',
+                 'isa_version')
+
+    def __init__(self, name, path, size, mtime_ns, is_dir, file_type=None, status=None, is_folder=None,
+                 isa_version=None, ctime_ns=0):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.ctime_ns = ctime_ns
+        self._is_dir = bool(is_dir)
+        self.file_type = file_type
+        self.status = status
+        self.is_folder = bool(is_folder)
+        self.isa_version = isa_version
+
+    @property
+    def mtime(self):
+        return self.mtime_ns / 1e9
+
+    def is_dir(self):
+        return self._is_dir
+
+
+class FileIndex:
+    """
+    Indexed listing of a study or upload folder. Use as a context manager, ie.
+        with FileIndex(study_location, assay_file_list) as file_index:
+            for entry in file_index.scan(study_location): ...
+    """
+
+    def __init__(self, location, assay_file_list=None):
+        self.location = os.path.normpath(location)
+        self.assay_file_list = assay_file_list
+        self.max_age = app.config.get('FILE_INDEX_MAX_AGE')
+        self.isa_version = get_isa_version(self.location)
+        self.connection = None
+        self.type_updates = []
+        self.prefetched = {}
+        self.stats = {}
+
+        index_root = app.config.get('FILE_INDEX_ROOT')
+        if index_root:
+            try:
+                os.makedirs(index_root, exist_ok=True)
+                self.connection = sqlite3.connect(get_index_file_name(index_root, self.location), timeout=30)
+                if self.connection.execute("PRAGMA user_version").fetchone()[0] != index_version:
+                    self.connection.executescript("DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS folders; "
+                                                  "DROP TABLE IF EXISTS checksums; "
+                                                  "PRAGMA user_version = " + str(index_version) + ";")
+                self.connection.executescript(index_schema)
+            except (OSError, sqlite3.Error) as e:
+                logger.error('Could not open the file index for ' + self.location + '. ' + str(e))
+                self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.connection is None:
+            return
+        try:
+            if self.type_updates:
+                self.connection.executemany(
+                    "UPDATE files SET file_type = ?, status = ?, is_folder = ?, isa_version = ? "
+                    "WHERE folder = ? AND name = ?", self.type_updates)
+            self.connection.commit()
+        except sqlite3.Error as e:
+            logger.error('Could not update the file index for ' + self.location + '. ' + str(e))
+        finally:
+            self.connection.close()
+            self.connection = None
+
+    def get_folder_key(self, folder):
+        folder = os.path.normpath(folder)
+        if folder == self.location:
+            return ''
+        return os.path.relpath(folder, self.location)
+
+    def scan(self, folder):
+        """
+        List the files and sub-folders in one folder (not recursive), from the index if the folder has not changed
+        :param folder: full path to a folder in this location
+        :return: list of IndexedEntry
+        """
+        folder = os.path.normpath(folder)
+        entries = self.prefetched.pop(folder, None)
+        if entries is not None:
+            return entries
+        if self.connection is None:
+            return scan_folder(folder)
+
+        folder_key = self.get_folder_key(folder)
+        try:
+            mtime_ns = stat_folder(folder)
+        except FileNotFoundError:
+            self.remove_folder(folder_key)
+            raise
+
+        entries = self.get_indexed_entries(folder, folder_key, mtime_ns)
+        if entries is None:
+            entries = self.update_folder(folder, folder_key, mtime_ns, scan_folder(folder))
+        return entries
+
+    def prefetch(self, folder, include_sub_dir):
+        """
+        List a folder and all the sub-folders we will need, in parallel, so later scan() calls do not have to wait for
+        the filesystem. The (slow) filesystem calls run in a thread pool, the index is only used from this thread
+        :param folder: full path to the top folder
+        :param include_sub_dir: function that is given an IndexedEntry, returns True if we need to list that folder
+        """
+        level = [os.path.normpath(folder)]
+        with get_scan_pool() as pool:
+            while level:
+                scanned = self.scan_many(level, pool)
+                self.prefetched.update(scanned)
+                level = [entry.path for folder in level for entry in scanned.get(folder, [])
+                         if entry.is_dir() and include_sub_dir(entry)]
+
+    def scan_many(self, folders, pool):
+        mtimes = dict(zip(folders, pool.map(try_stat_folder, folders)))
+        scanned = {}
+        to_scan = []
+        for folder in folders:
+            folder_key = self.get_folder_key(folder)
+            if mtimes[folder] is None:  # Folder removed, or not readable
+                if self.connection is not None:
+                    self.remove_folder(folder_key)
+                continue
+            entries = None
+            if self.connection is not None:
+                entries = self.get_indexed_entries(folder, folder_key, mtimes[folder])
+            if entries is None:
+                to_scan.append(folder)
+            else:
+                scanned[folder] = entries
+
+        for folder, entries in zip(to_scan, pool.map(try_scan_folder, to_scan)):
+            if entries is None:
+                continue
+            if self.connection is not None:
+                entries = self.update_folder(folder, self.get_folder_key(folder), mtimes[folder], entries)
+            scanned[folder] = entries
+        return scanned
+
+    def get_indexed_entries(self, folder, folder_key, mtime_ns):
+        row = self.connection.execute("SELECT mtime_ns, scanned_at FROM folders WHERE folder = ?",
+                                      (folder_key,)).fetchone()
+        # The top folder is always listed again, as the ISA-Tab files in it are often updated in place
+        if folder_key and row and row[0] == mtime_ns and time.time() - row[1] < self.max_age:
+            return [IndexedEntry(name, os.path.join(folder, name), size, file_mtime_ns, is_dir, file_type, status,
+                                 is_folder, isa_version, ctime_ns)
+                    for name, size, file_mtime_ns, ctime_ns, is_dir, file_type, status, is_folder, isa_version in
+                    self.connection.execute("SELECT name, size, mtime_ns, ctime_ns, is_dir, file_type, status, "
+                                            "is_folder, isa_version FROM files WHERE folder = ?", (folder_key,))]
+        return None
+
+    def update_folder(self, folder, folder_key, mtime_ns, scanned_entries):
+        known = {name: (size, file_mtime_ns, file_type, status, is_folder, isa_version)
+                 for name, size, file_mtime_ns, file_type, status, is_folder, isa_version in
+                 self.connection.execute("SELECT name, size, mtime_ns, file_type, status, is_folder, isa_version "
+                                         "FROM files WHERE folder = ?", (folder_key,))}
+        entries = []
+        for entry in scanned_entries:
+            old = known.pop(entry.name, None)
+            # Keep the file type if the file itself has not changed, it may still be valid for this ISA-Tab version
+            if old and old[0] == entry.size and old[1] == entry.mtime_ns:
+                entry.file_type, entry.status, entry.is_folder, entry.isa_version = old[2], old[3], bool(old[4]), old[5]
+            entries.append(entry)
+
+        try:
+            for name in known:  # Removed since the last scan
+                if self.connection.execute("SELECT 1 FROM folders WHERE folder = ?",
+                                           (os.path.join(folder_key, name),)).fetchone():
+                    self.remove_folder(os.path.join(folder_key, name))
+
+            self.connection.execute("DELETE FROM files WHERE folder = ?", (folder_key,))
+            self.connection.executemany(
+                "INSERT INTO files (folder, name, size, mtime_ns, ctime_ns, is_dir, file_type, status, is_folder, "
+                "isa_version) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(folder_key, entry.name, entry.size, entry.mtime_ns, entry.ctime_ns, int(entry.is_dir()),
+                  entry.file_type, entry.status, int(entry.is_folder), entry.isa_version) for entry in entries])
+            self.connection.execute("INSERT OR REPLACE INTO folders (folder, mtime_ns, scanned_at) VALUES (?, ?, ?)",
+                                    (folder_key, mtime_ns, time.time()))
+            self.connection.commit()
+        except sqlite3.Error as e:  # ie. locked for too long, the folder is listed again next time
+            self.connection.rollback()
+            logger.error('Could not update the file index for ' + folder + '. ' + str(e))
+        return entries
+
+    def remove_folder(self, folder_key):
+        try:
+            if not folder_key:  # The whole location is gone
+                self.connection.execute("DELETE FROM files")
+                self.connection.execute("DELETE FROM folders")
+                return
+            # Not LIKE, it is case insensitive and '_' in the folder name would match any character
+            prefix = folder_key + os.sep
+            for table in ('files', 'folders'):
+                self.connection.execute("DELETE FROM " + table + " WHERE folder = ? OR substr(folder, 1, ?) = ?",
+                                        (folder_key, len(prefix), prefix))
+        except sqlite3.Error as e:
+            logger.error('Could not remove ' + folder_key + ' from the file index for ' + self.location + '. ' + str(e))
+
+    def get_stats(self, folder):
+        """
+        Size, number of files and sub-folders, and latest modification and change time of everything under a folder.
+        The sub-folders are listed in parallel, unchanged folders come from the index
+        :param folder: full path to a folder in this location
+        :return: DirectoryStats
+        """
+        folder = os.path.normpath(folder)
+        if folder in self.stats:
+            return self.stats[folder]
+
+        self.prefetch(folder, lambda entry: entry.path not in self.stats)
+        folders = [folder]
+        listed = {}
+        for current in folders:  # Top down, the list grows while we go
+            try:
+                listed[current] = self.scan(current)
+            except OSError:
+                listed[current] = []
+            folders.extend(entry.path for entry in listed[current] if entry.is_dir() and entry.path not in self.stats)
+
+        for current in reversed(folders):  # Bottom up, so the sub-folders are done first
+            size = file_count = folder_count = latest_mtime_ns = latest_ctime_ns = 0
+            for entry in listed[current]:
+                latest_mtime_ns = max(latest_mtime_ns, entry.mtime_ns)
+                latest_ctime_ns = max(latest_ctime_ns, entry.ctime_ns)
+                if entry.is_dir():
+                    sub_folder = self.stats[entry.path]
+                    size += sub_folder.size
+                    file_count += sub_folder.file_count
+                    folder_count += 1 + sub_folder.folder_count
+                    latest_mtime_ns = max(latest_mtime_ns, sub_folder.latest_mtime_ns)
+                    latest_ctime_ns = max(latest_ctime_ns, sub_folder.latest_ctime_ns)
+                else:
+                    size += entry.size
+                    file_count += 1
+            self.stats[current] = DirectoryStats(size, file_count, folder_count, latest_mtime_ns, latest_ctime_ns)
+        return self.stats[folder]
+
+    def get_checksum(self, entry):
+        """
+        The checksums of a file, if they were worked out for its current size and modification time
+        :return: FileChecksum, or None
+        """
+        if self.connection is None:
+            return None
+        row = self.connection.execute("SELECT size, mtime_ns, md5, sha256 FROM checksums WHERE path = ?",
+                                      (self.get_folder_key(entry.path),)).fetchone()
+        if row and row[0] == entry.size and row[1] == entry.mtime_ns:
+            return FileChecksum(entry.size, row[2], row[3])
+        return None
+
+    def get_checksums(self, folder, update=False, progress=None):
+        """
+        The checksums of all the files under a folder (not the hidden ones)
+        :param folder: full path to a folder in this location
+        :param update: work out the checksums of the new and changed files, in parallel. Otherwise these files have
+        no md5 and sha256
+        :param progress: JobProgress when running as a background job
+        :return: dict of relative path (to the location): FileChecksum
+        """
+        folder = os.path.normpath(folder)
+        self.prefetch(folder, lambda entry: not entry.name.startswith('.'))
+        files = []
+        folders = [folder]
+        for current in folders:
+            try:
+                entries = self.scan(current)
+            except OSError as e:
+                if current == folder:
+                    raise
+                logger.error('Could not list folder ' + current + '. ' + str(e))
+                continue
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    folders.append(entry.path)
+                else:
+                    files.append(entry.path)
+
+        # A file changed in place does not change the modification time of its folder, so check the files themselves
+        with get_scan_pool() as pool:
+            files = [entry for entry in pool.map(try_stat_file, files) if entry is not None]
+
+        checksums = {}
+        to_hash = []
+        for entry in files:
+            checksum = self.get_checksum(entry)
+            if checksum is None:
+                to_hash.append(entry)
+                checksum = FileChecksum(entry.size, None, None)
+            checksums[self.get_folder_key(entry.path)] = checksum
+        if not update:
+            return checksums
+
+        files_total, bytes_total = len(to_hash), sum(entry.size for entry in to_hash)
+        files_done = bytes_done = 0
+        buffer_size = app.config.get('CHECKSUM_BUFFER_SIZE')
+        commit_interval = app.config.get('CHECKSUM_COMMIT_INTERVAL')
+        # Saved in small batches, so the index is not locked for the other requests while a large folder is hashed,
+        # and an interrupted job keeps the checksums it already worked out
+        hashed = []
+        self.save_checksums(hashed)  # Commit the changes to the folders, ie. removed ones, before we start
+        committed_at = time.time()
+        with get_scan_pool(app.config.get('CHECKSUM_THREADS')) as pool:
+            for entry, hashes in zip(to_hash, pool.map(lambda entry: try_hash_file(entry.path, buffer_size), to_hash)):
+                files_done += 1
+                bytes_done += entry.size
+                if progress:
+                    progress.update(files_done=files_done, files_total=files_total, bytes_done=bytes_done,
+                                    bytes_total=bytes_total)
+                if hashes is None:
+                    continue
+                path = self.get_folder_key(entry.path)
+                checksums[path] = FileChecksum(entry.size, hashes[0], hashes[1])
+                hashed.append((path, entry.size, entry.mtime_ns, hashes[0], hashes[1]))
+                if time.time() - committed_at >= commit_interval:
+                    self.save_checksums(hashed)
+                    hashed = []
+                    committed_at = time.time()
+        self.save_checksums(hashed)
+
+        if self.connection is not None:  # Forget the files that were removed
+            folder_key = self.get_folder_key(folder)
+            try:
+                removed = [(path,) for path, in self.connection.execute("SELECT path FROM checksums")
+                           if path not in checksums and (not folder_key or path.startswith(folder_key + os.sep))]
+                self.connection.executemany("DELETE FROM checksums WHERE path = ?", removed)
+                self.connection.commit()
+            except sqlite3.Error as e:
+                self.connection.rollback()
+                logger.error('Could not update the checksums in the file index for ' + self.location + '. ' + str(e))
+        return checksums
+
+    def save_checksums(self, rows):
+        # rows of (path, size, mtime_ns, md5, sha256)
+        if self.connection is None:
+            return
+        try:
+            self.connection.executemany("INSERT OR REPLACE INTO checksums (path, size, mtime_ns, md5, sha256) "
+                                        "VALUES (?, ?, ?, ?, ?)", rows)
+            self.connection.commit()
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            logger.error('Could not save ' + str(len(rows)) + ' checksums in the file index for ' + self.location +
+                         '. ' + str(e))
+
+    def get_file_type(self, entry):
+        """
+        The file type, status and folder flag (same as map_file_type) of an entry, using the indexed value if the
+        ISA-Tab files have not changed since it was worked out
+        """
+        if entry.file_type is not None and entry.isa_version == self.isa_version:
+            return entry.file_type, entry.status, entry.is_folder
+
+        folder = os.path.dirname(entry.path)
+        file_type, status, is_folder = map_file_type(entry.name, folder, assay_file_list=self.assay_file_list,
+                                                     is_dir=entry.is_dir())
+        entry.file_type, entry.status, entry.is_folder, entry.isa_version = \
+            file_type, status, bool(is_folder), self.isa_version
+        if self.connection is not None:
+            self.type_updates.append((file_type, status, int(bool(is_folder)), self.isa_version,
+                                      self.get_folder_key(folder), entry.name))
+        return file_type, status, is_folder
+
+
+def get_directory_stats(folder, location=None):
+    """
+    Size, file count and latest update of everything under a folder, see FileIndex.get_stats()
+    :param folder: full path to the folder
+    :param location: study or upload folder the folder is in, default is the folder itself
+    :return: DirectoryStats, all zero if the folder does not exist
+    """
+    with FileIndex(location or folder) as file_index:
+        return file_index.get_stats(folder)
+
+
+def get_scan_pool(size=None):
+    """
+    Thread pool for the filesystem calls. Under gevent (monkey patched) this has to be gevent's pool of real threads,
+    so the blocking (NFS) calls run in parallel and do not block the other greenlets
+    :param size: number of threads, default FILE_SCAN_THREADS
+    """
+    size = size or app.config.get('FILE_SCAN_THREADS')
+    if monkey is not None and monkey.is_module_patched('threading'):
+        return GeventThreadPoolExecutor(max_workers=size)
+    return ThreadPoolExecutor(max_workers=size)
+
+
+def stat_folder(folder):
+    return os.stat(folder).st_mtime_ns
+
+
+def try_stat_folder(folder):
+    try:
+        return stat_folder(folder)
+    except OSError:
+        return None
+
+
+def try_scan_folder(folder):
+    try:
+        return scan_folder(folder)
+    except OSError as e:
+        logger.error('Could not list folder ' + folder + '. ' + str(e))
+        return None
+
+
+def scan_folder(folder):
+    entries = []
+    for entry in os.scandir(folder):
+        try:
+            stat = entry.stat(follow_symlinks=False)
+            size, mtime_ns, ctime_ns = stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns
+        except OSError:
+            size, mtime_ns, ctime_ns = 0, 0, 0
+        entries.append(IndexedEntry(entry.name, entry.path, size, mtime_ns, entry.is_dir(), ctime_ns=ctime_ns))
+    return entries
+
+
+def try_stat_file(path):
+    try:
+        stat = os.stat(path)
+    except OSError:  # Removed since the folder was listed
+        return None
+    return IndexedEntry(os.path.basename(path), path, stat.st_size, stat.st_mtime_ns, False)
+
+
+def hash_file(path, buffer_size):
+    # Large reads, hashlib releases the GIL while it works through them so the threads run in parallel
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(buffer_size), b''):
+            md5.update(chunk)
+            sha256.update(chunk)
+    return md5.hexdigest(), sha256.hexdigest()
+
+
+def try_hash_file(path, buffer_size):
+    try:
+        return hash_file(path, buffer_size)
+    except OSError as e:
+        logger.error('Could not read file ' + path + '. ' + str(e))
+        return None
+
+
+def get_index_file_name(index_root, location):
+    # The study id is in the folder name, the hash makes it unique for study and upload folders
+    name = os.path.basename(location) or 'root'
+    return os.path.join(index_root, name + '_' + hashlib.md5(location.encode('utf-8')).hexdigest() + '.db')
+
+
+def get_isa_version(location):
+    """
+    A version string for the ISA-Tab files in a folder, changes whenever any of these files is added, removed or updated
+    """
+    versions = []
+    for isa_file in sorted(glob.glob(os.path.join(location, "?_*.t*"))):
+        try:
+            stat = os.stat(isa_file)
+            versions.append(os.path.basename(isa_file) + ':' + str(stat.st_mtime_ns) + ':' + str(stat.st_size))
+        except OSError:
+            continue
+    return hashlib.md5('|'.join(versions).encode('utf-8')).hexdigest()
@@ -25,7 +25,8 @@ from app.ws.mm_models import *
 from app.ws.mtblsWSclient import WsClient
 from app.ws.models import *
 from flask_restful_swagger import swagger
-from app.ws.utils import log_request, add_ontology_to_investigation, read_tsv, update_ontolgies_in_isa_tab_sheets
+from app.ws.utils import log_request, add_ontology_to_investigation, read_tsv, update_ontolgies_in_isa_tab_sheets, \
+    get_investigation_file_name, check_if_match, is_not_modified, not_modified, add_etag_after_request
 from app.ws.db_connection import study_submitters, update_release_date
 import logging
 import os
@@ -176,6 +177,11 @@ class StudyTitle(Resource):
         if not read_access:
             abort(403)
 
+        i_file_name = get_investigation_file_name(study_location)
+        if is_not_modified(i_file_name):
+            return not_modified(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -285,6 +291,10 @@ class StudyTitle(Resource):
         if not write_access:
             abort(403)
 
+        i_file_name = get_investigation_file_name(study_location)
+        check_if_match(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -406,6 +416,10 @@ class StudyReleaseDate(Resource):
         if not write_access:
             abort(403)
 
+        i_file_name = get_investigation_file_name(study_location)
+        check_if_match(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -546,6 +560,11 @@ class StudyDescription(Resource):
         if not read_access:
             abort(403)
 
+        i_file_name = get_investigation_file_name(study_location)
+        if is_not_modified(i_file_name):
+            return not_modified(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -655,6 +674,10 @@ class StudyDescription(Resource):
         if not write_access:
             abort(403)
 
+        i_file_name = get_investigation_file_name(study_location)
+        check_if_match(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -822,6 +845,10 @@ class StudyContacts(Resource):
         if not write_access:
             abort(403)
 
+        i_file_name = get_investigation_file_name(study_location)
+        check_if_match(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -971,6 +998,11 @@ class StudyContacts(Resource):
             study_status = wsc.get_permissions(study_id, user_token)
         if not read_access:
             abort(403)
+        i_file_name = get_investigation_file_name(study_location)
+        if is_not_modified(i_file_name):
+            return not_modified(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -1150,6 +1182,10 @@ class StudyContacts(Resource):
             save_audit_copy = True
             save_msg_str = "be"
 
+        i_file_name = get_investigation_file_name(study_location)
+        check_if_match(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -1307,6 +1343,10 @@ class StudyContacts(Resource):
         if not write_access:
             abort(403)
 
+        i_file_name = get_investigation_file_name(study_location)
+        check_if_match(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -1484,6 +1524,10 @@ class StudyProtocols(Resource):
         # TODO, use new utils.add_protcol method
         # Add new protocol
         logger.info('Adding new Protocol %s for %s', new_obj.name, study_id)
+        i_file_name = get_investigation_file_name(study_location)
+        check_if_match(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -1578,6 +1622,11 @@ class StudyProtocols(Resource):
             wsc.get_permissions(study_id, user_token)
         if not read_access:
             abort(403)
+        i_file_name = get_investigation_file_name(study_location)
+        if is_not_modified(i_file_name):
+            return not_modified(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -1721,6 +1770,10 @@ class StudyProtocols(Resource):
         if not write_access:
             abort(403)
 
+        i_file_name = get_investigation_file_name(study_location)
+        check_if_match(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -1906,6 +1959,10 @@ class StudyProtocols(Resource):
         if not write_access:
             abort(403)
 
+        i_file_name = get_investigation_file_name(study_location)
+        check_if_match(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -2057,6 +2114,10 @@ class StudyFactors(Resource):
             wsc.get_permissions(study_id, user_token)
         if not write_access:
             abort(403)
+        i_file_name = get_investigation_file_name(study_location)
+        check_if_match(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -2162,6 +2223,11 @@ class StudyFactors(Resource):
             wsc.get_permissions(study_id, user_token)
         if not read_access:
             abort(403)
+        i_file_name = get_investigation_file_name(study_location)
+        if is_not_modified(i_file_name):
+            return not_modified(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -2285,6 +2351,10 @@ class StudyFactors(Resource):
             wsc.get_permissions(study_id, user_token)
         if not write_access:
             abort(403)
+        i_file_name = get_investigation_file_name(study_location)
+        check_if_match(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -2440,6 +2510,10 @@ class StudyFactors(Resource):
         if not write_access:
             abort(403)
 
+        i_file_name = get_investigation_file_name(study_location)
+        check_if_match(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -2621,6 +2695,10 @@ class StudyDescriptors(Resource):
         if not write_access:
             abort(403)
 
+        i_file_name = get_investigation_file_name(study_location)
+        check_if_match(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -2725,6 +2803,11 @@ class StudyDescriptors(Resource):
         if not read_access:
             abort(403)
 
+        i_file_name = get_investigation_file_name(study_location)
+        if is_not_modified(i_file_name):
+            return not_modified(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -2849,6 +2932,10 @@ class StudyDescriptors(Resource):
         if not write_access:
             abort(403)
 
+        i_file_name = get_investigation_file_name(study_location)
+        check_if_match(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -3001,6 +3088,10 @@ class StudyDescriptors(Resource):
         if not write_access:
             abort(403)
 
+        i_file_name = get_investigation_file_name(study_location)
+        check_if_match(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -3157,6 +3248,10 @@ class StudyPublications(Resource):
         if not write_access:
             abort(403)
 
+        i_file_name = get_investigation_file_name(study_location)
+        check_if_match(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -3262,6 +3357,11 @@ class StudyPublications(Resource):
         if not read_access:
             abort(403)
 
+        i_file_name = get_investigation_file_name(study_location)
+        if is_not_modified(i_file_name):
+            return not_modified(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -3386,6 +3486,10 @@ class StudyPublications(Resource):
         if not write_access:
             abort(403)
 
+        i_file_name = get_investigation_file_name(study_location)
+        check_if_match(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -3538,6 +3642,10 @@ class StudyPublications(Resource):
         if not write_access:
             abort(403)
 
+        i_file_name = get_investigation_file_name(study_location)
+        check_if_match(i_file_name)
+        add_etag_after_request(i_file_name)
+
         isa_study, isa_inv, std_path = iac.get_isa_study(study_id, user_token,
                                                          skip_load_tables=True,
                                                          study_location=study_location)
@@ -0,0 +1,276 @@
+#  EMBL-EBI MetaboLights - https://www.ebi.ac.uk/metabolights
+#  Metabolomics team
+#
+#  European Bioinformatics Institute (EMBL-EBI), European Molecular Biology Laboratory, Wellcome Genome Campus, Hinxton, Cambridge CB10 1SD, United Kingdom
+#
+#  Copyright 2020 EMBL - European Bioinformatics Institute
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app as app
+from flask import request, abort
+from flask_restful import Resource
+from flask_restful_swagger import swagger
+
+from app.ws.file_copy import get_thread_lock
+from app.ws.mtblsWSclient import WsClient
+
+try:
+    from gevent import monkey
+    from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+except ImportError:  # Not running under gevent, ie. the Flask development server
+    monkey = None
+
+"""
+Background jobs
+
+Long running file operations (copy, sync, unzip, conversion) can run as a job instead of inside the HTTP request. The
+endpoint submits the work and returns the job id at once, the job status and progress are kept in a small SQLite
+database (JOB_DB_FILE) so any worker can report on them, see /studies/<study_id>/jobs/<job_id>.
+"""
+
+logger = logging.getLogger('wslog')
+wsc = WsClient()
+
+job_schema = """
+CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, study_id TEXT, job_type TEXT, status TEXT,
+                                 created_at REAL, started_at REAL, finished_at REAL, host TEXT, pid INTEGER,
+                                 files_done INTEGER, files_total INTEGER, bytes_done INTEGER, bytes_total INTEGER,
+                                 message TEXT, result TEXT);
+"""
+
+job_fields = ('job_id', 'study_id', 'job_type', 'status', 'created_at', 'started_at', 'finished_at', 'host', 'pid',
+              'files_done', 'files_total', 'bytes_done', 'bytes_total', 'message', 'result')
+
+
+class JobProgress:
+    """
+    Given to the job function as 'progress', to report how far the job is. Can also be used as the progress function
+    of the copy engine, see copy_folder(). The copy engine calls it from its own threads, these have no application
+    context, so the settings are read when the job starts
+    """
+
+    def __init__(self, runner, job_id):
+        self.runner = runner
+        self.job_id = job_id
+        self.job_db_file = app.config.get('JOB_DB_FILE')
+        self.interval = app.config.get('JOB_PROGRESS_INTERVAL')
+        self.values = {}
+        self.saved_at = 0
+        self.lock = get_thread_lock()  # Also used by the copy threads, see CopyStats
+
+    def update(self, files_done=None, files_total=None, bytes_done=None, bytes_total=None, message=None):
+        with self.lock:
+            for name, value in (('files_done', files_done), ('files_total', files_total),
+                                ('bytes_done', bytes_done), ('bytes_total', bytes_total), ('message', message)):
+                if value is not None:
+                    self.values[name] = value
+            # Do not write to the database for every file
+            if time.time() - self.saved_at >= self.interval:
+                self.save_values()
+
+    def save(self):
+        with self.lock:
+            self.save_values()
+
+    def save_values(self):
+        if self.values:
+            self.runner.update_job(self.job_id, job_db_file=self.job_db_file, **self.values)
+            self.values = {}
+        self.saved_at = time.time()
+
+    def __call__(self, copy_stats):
+        self.update(files_done=copy_stats.files_done, files_total=copy_stats.files_total,
+                    bytes_done=copy_stats.bytes_done, bytes_total=copy_stats.bytes_total)
+
+
+class JobRunner:
+    def __init__(self):
+        self.pool = None
+        self.lock = get_thread_lock()
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                size = app.config.get('JOB_THREADS')
+                if monkey is not None and monkey.is_module_patched('threading'):
+                    self.pool = GeventThreadPoolExecutor(max_workers=size)
+                else:
+                    self.pool = ThreadPoolExecutor(max_workers=size, thread_name_prefix='job')
+        return self.pool
+
+    def connect(self, job_db_file=None):
+        job_db_file = job_db_file or app.config.get('JOB_DB_FILE')
+        os.makedirs(os.path.dirname(job_db_file), exist_ok=True)
+        connection = sqlite3.connect(job_db_file, timeout=30)
+        connection.executescript(job_schema)
+        return connection
+
+    def update_job(self, job_id, job_db_file=None, **values):
+        connection = self.connect(job_db_file)
+        try:
+            with connection:
+                connection.execute("UPDATE jobs SET " + ", ".join(name + " = ?" for name in values) +
+                                   " WHERE job_id = ?", list(values.values()) + [job_id])
+        except sqlite3.Error as e:
+            logger.error('Could not update job ' + job_id + '. ' + str(e))
+        finally:
+            connection.close()
+
+    def submit(self, job_type, study_id, function, *args, **kwargs):
+        """
+        Run a function as a background job. The function is called in the application context with the given
+        arguments and progress=JobProgress, and returns the (JSON) result of the job
+        :return: job id
+        """
+        job_id = uuid.uuid4().hex
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute("INSERT INTO jobs (job_id, study_id, job_type, status, created_at, host, pid, "
+                                   "files_done, bytes_done) VALUES (?, ?, ?, 'queued', ?, ?, ?, 0, 0)",
+                                   (job_id, study_id, job_type, time.time(), socket.gethostname(), os.getpid()))
+        finally:
+            connection.close()
+
+        self.get_pool().submit(self.run, app._get_current_object(), job_id, function, args, kwargs)
+        logger.info('Submitted %s job %s for %s', job_type, job_id, study_id)
+        return job_id
+
+    def run(self, flask_app, job_id, function, args, kwargs):
+        with flask_app.app_context():
+            self.update_job(job_id, status='running', started_at=time.time())
+            progress = JobProgress(self, job_id)
+            try:
+                result = function(*args, progress=progress, **kwargs)
+                progress.save()
+                self.update_job(job_id, status='done', finished_at=time.time(), result=json.dumps(result))
+                logger.info('Job %s done', job_id)
+            except Exception as e:
+                logger.exception('Job %s failed', job_id)
+                progress.save()
+                self.update_job(job_id, status='failed', finished_at=time.time(), message=str(e))
+
+    def get_job(self, job_id):
+        connection = self.connect()
+        try:
+            row = connection.execute("SELECT " + ", ".join(job_fields) + " FROM jobs WHERE job_id = ?",
+                                     (job_id,)).fetchone()
+        finally:
+            connection.close()
+        if row is None:
+            return None
+
+        job = dict(zip(job_fields, row))
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        if job['status'] in ('queued', 'running') and job['host'] == socket.gethostname() and \
+                not is_process_running(job['pid']):
+            job['status'] = 'failed'  # The worker was restarted before the job finished
+            job['message'] = 'Job was interrupted'
+        return job
+
+
+job_runner = JobRunner()
+
+
+def is_process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def get_job_response(job_id):
+    # Returned by the endpoints when the work is submitted as a background job
+    return {'jobId': job_id, 'status': 'queued'}, 202
+
+
+class StudyJob(Resource):
+    @swagger.operation(
+        summary="Get the status and progress of a background job",
+        notes="Status is one of queued, running, done or failed. When done, 'result' has the same response the "
+              "endpoint would have given without running it as a job",
+        parameters=[
+            {
+                "name": "study_id",
+                "description": "Study Identifier",
+                "required": True,
+                "allowMultiple": False,
+                "paramType": "path",
+                "dataType": "string"
+            },
+            {
+                "name": "job_id",
+                "description": "Job id, as returned when the job was submitted",
+                "required": True,
+                "allowMultiple": False,
+                "paramType": "path",
+                "dataType": "string"
+            },
+            {
+                "name": "user_token",
+                "description": "User API token",
+                "paramType": "header",
+                "type": "string",
+                "required": True,
+                "allowMultiple": False
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK."
+            },
+            {
+                "code": 403,
+                "message": "Forbidden. Access to the study is not allowed. Please provide a valid user token"
+            },
+            {
+                "code": 404,
+                "message": "Not found. The requested job or study does not exist."
+            }
+        ]
+    )
+    def get(self, study_id, job_id):
+        # param validation
+        if study_id is None or job_id is None:
+            abort(404)
+        study_id = study_id.upper()
+
+        # User authentication
+        user_token = None
+        if "user_token" in request.headers:
+            user_token = request.headers["user_token"]
+
+        # check for access rights
+        is_curator, read_access, write_access, obfuscation_code, study_location, release_date, submission_date, \
+            study_status = wsc.get_permissions(study_id, user_token)
+        if not read_access:
+            abort(403)
+
+        job = job_runner.get_job(job_id)
+        if job is None or job['study_id'] != study_id:
+            abort(404)
+
+        return {'jobId': job['job_id'], 'jobType': job['job_type'], 'status': job['status'],
+                'createdAt': job['created_at'], 'startedAt': job['started_at'], 'finishedAt': job['finished_at'],
+                'filesDone': job['files_done'], 'filesTotal': job['files_total'], 'bytesDone': job['bytes_done'],
+                'bytesTotal': job['bytes_total'], 'message': job['message'], 'result': job['result']}
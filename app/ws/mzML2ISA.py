@@ -17,8 +17,9 @@
 #  Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
 
 from flask import request, abort
-from flask_restful import Resource
+from flask_restful import Resource, reqparse
 from flask_restful_swagger import swagger
+from app.ws.jobs import job_runner, get_job_response
 from app.ws.mtblsWSclient import WsClient
 from app.ws.utils import *
 from app.ws.isaApiClient import IsaApiClient
@@ -42,6 +43,18 @@ class Convert2ISAtab(Resource):
                 "paramType": "path",
                 "dataType": "string"
             },
+            {
+                "name": "background",
+                "description": "Run as a background job. Returns a job id at once, "
+                               "use /studies/<study_id>/jobs/<job_id> for the progress and result",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "type": "Boolean",
+                "defaultValue": False,
+                "default": False
+            },
             {
                 "name": "user_token",
                 "description": "User API token",
@@ -56,6 +69,10 @@ class Convert2ISAtab(Resource):
                 "code": 200,
                 "message": "OK."
             },
+            {
+                "code": 202,
+                "message": "Accepted. The background job was submitted, see jobId."
+            },
             {
                 "code": 401,
                 "message": "Unauthorized. Access to the resource requires user authentication. "
@@ -87,12 +104,23 @@ class Convert2ISAtab(Resource):
 
         study_id = study_id.upper()
 
+        parser = reqparse.RequestParser()
+        parser.add_argument('background', help='Run as a background job')
+        background = False
+        if request.args:
+            args = parser.parse_args(req=request)
+            background = (args['background'] or '').lower() == 'true'
+
         # param validation
         is_curator, read_access, write_access, obfuscation_code, study_location, release_date, submission_date, \
             study_status = wsc.get_permissions(study_id, user_token)
         if not write_access:
             abort(403)
 
+        if background:
+            return get_job_response(job_runner.submit('convert', study_id, convert_study_to_isa, study_location,
+                                                      study_id))
+
         status, message = convert_to_isa(study_location, study_id)
 
         if not status:
@@ -100,6 +128,14 @@ class Convert2ISAtab(Resource):
         return message
 
 
+def convert_study_to_isa(study_location, study_id, progress=None):
+    # Background job version of Convert2ISAtab, the job fails if the conversion fails
+    status, message = convert_to_isa(study_location, study_id)
+    if not status:
+        raise RuntimeError(message)
+    return message
+
+
 class ValidateMzML(Resource):
     @swagger.operation(
         summary="Validate mzML files",
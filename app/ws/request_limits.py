@@ -0,0 +1,160 @@
+#  EMBL-EBI MetaboLights - https://www.ebi.ac.uk/metabolights
+#  Metabolomics team
+#
+#  European Bioinformatics Institute (EMBL-EBI), European Molecular Biology Laboratory, Wellcome Genome Campus, Hinxton, Cambridge CB10 1SD, United Kingdom
+#
+#  Copyright 2020 EMBL - European Bioinformatics Institute
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app as app
+from flask import request, abort, jsonify, make_response
+from werkzeug.wrappers import Response
+
+"""
+Request limits for the heavy endpoints
+
+Each endpoint class (downloads, validation, file listing) has a maximum number of requests running at the same time,
+and a token bucket per user token and per study. A request over any of the limits gets a 429 with a Retry-After
+header. The limits are kept in memory, so they apply per (gunicorn) worker process. See REQUEST_LIMITS in the config.
+"""
+
+logger = logging.getLogger('wslog')
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.updated = time.monotonic()
+
+    def refill(self, rate, burst):
+        """
+        :param rate: tokens added per second
+        :param burst: maximum number of tokens in the bucket, 0 blocks all requests
+        """
+        now = time.monotonic()
+        self.tokens = min(burst, self.tokens + (now - self.updated) * (rate or 0))
+        self.updated = now
+
+    def get_wait_time(self, rate, burst):
+        # Seconds before the next token is available, None if there is one now
+        if self.tokens >= 1:
+            return None
+        if not rate or burst < 1:  # There will never be a token
+            return app.config.get('REQUEST_LIMIT_RETRY_AFTER')
+        return (1 - self.tokens) / rate
+
+
+class RequestLimiter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+        self.running = {}
+
+    def get_limits(self, endpoint_class, study_id):
+        limits = dict(app.config.get('REQUEST_LIMITS', {}).get(endpoint_class, {}))
+        study_limits = app.config.get('REQUEST_LIMITS_PER_STUDY', {}).get(study_id, {})
+        limits.update(study_limits.get(endpoint_class, {}))
+        return limits
+
+    def get_bucket(self, key, burst):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(burst)
+        self.buckets.move_to_end(key)
+        return bucket
+
+    def acquire(self, endpoint_class, study_id=None, user_token=None):
+        """
+        Start a request, if it is within the limits. Call release() when the request is done
+        :return: None if the request can go ahead, else the number of seconds the client should wait
+        """
+        limits = self.get_limits(endpoint_class, study_id)
+        with self.lock:
+            concurrent = limits.get('concurrent')
+            if concurrent is not None and self.running.get(endpoint_class, 0) >= concurrent:
+                return app.config.get('REQUEST_LIMIT_RETRY_AFTER')
+
+            buckets = []
+            if user_token and limits.get('token_burst') is not None:
+                buckets.append((self.get_bucket((endpoint_class, 'token', user_token), limits['token_burst']),
+                                limits.get('token_rate'), limits['token_burst']))
+            if study_id and limits.get('study_burst') is not None:
+                buckets.append((self.get_bucket((endpoint_class, 'study', study_id), limits['study_burst']),
+                                limits.get('study_rate'), limits['study_burst']))
+
+            # Only take the tokens when there is one in every bucket
+            wait_times = []
+            for bucket, rate, burst in buckets:
+                bucket.refill(rate, burst)
+                wait_time = bucket.get_wait_time(rate, burst)
+                if wait_time is not None:
+                    wait_times.append(wait_time)
+            if wait_times:
+                return max(wait_times)
+            for bucket, rate, burst in buckets:
+                bucket.tokens -= 1
+
+            self.running[endpoint_class] = self.running.get(endpoint_class, 0) + 1
+            max_buckets = app.config.get('REQUEST_LIMIT_BUCKETS')
+            while len(self.buckets) > max_buckets:
+                self.buckets.popitem(last=False)  # Forget the least recently seen clients and studies
+        return None
+
+    def release(self, endpoint_class):
+        with self.lock:
+            self.running[endpoint_class] = max(0, self.running.get(endpoint_class, 0) - 1)
+
+
+request_limiter = RequestLimiter()
+
+
+def limit_requests(endpoint_class):
+    """
+    Decorator for a Resource method, returns 429 Too Many Requests when the request is over the limits of the
+    endpoint class. A streamed response (ie. a download) counts as running until it has been sent
+    :param endpoint_class: name of the limits in REQUEST_LIMITS, ie. 'download', 'validation' or 'file_listing'
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            study_id = kwargs.get('study_id')
+            study_id = study_id.upper() if study_id else None
+            user_token = request.headers.get('user_token')
+            retry_after = request_limiter.acquire(endpoint_class, study_id=study_id, user_token=user_token)
+            if retry_after is not None:
+                retry_after = int(math.ceil(retry_after))
+                logger.warning('Too many %s requests for study %s, retry after %s seconds', endpoint_class,
+                               study_id, retry_after)
+                response = make_response(jsonify({'message': 'Too many requests, please try again in ' +
+                                                             str(retry_after) + ' seconds'}), 429)
+                response.headers['Retry-After'] = str(retry_after)
+                abort(response)
+
+            released = False
+            try:
+                rv = f(*args, **kwargs)
+                if isinstance(rv, Response):
+                    rv.call_on_close(lambda: request_limiter.release(endpoint_class))
+                    released = True
+                return rv
+            finally:
+                if not released:
+                    request_limiter.release(endpoint_class)
+        return wrapper
+    return decorator
@@ -26,7 +26,7 @@ from flask import request, abort
 from flask_restful import Resource, reqparse
 from flask_restful_swagger import swagger
 from app.ws.mtblsWSclient import WsClient
-from app.ws.utils import get_table_header, totuples
+from app.ws.utils import get_table_header, totuples, check_if_match, etag_header, is_not_modified, not_modified
 
 """
 MTBLS Sample Tables
@@ -117,6 +117,8 @@ class EditSampleFile(Resource):
             abort(403)
 
         sample_file_name = os.path.join(study_location, sample_file_name)
+        if is_not_modified(sample_file_name):
+            return not_modified(sample_file_name)
         logger.info('Trying to load sample (%s) for Study %s', sample_file_name, study_id)
         # Get the sample table or create a new one if it does not already exist
         sample_df = pd.read_csv(sample_file_name, sep="\t", header=0, encoding='utf-8')
@@ -128,7 +130,7 @@ class EditSampleFile(Resource):
         # Get an indexed header row
         df_header = get_table_header(sample_df)
 
-        return {'header': df_header, 'data': df_data_dict}
+        return {'header': df_header, 'data': df_data_dict}, 200, etag_header(sample_file_name)
 
     @swagger.operation(
         summary="Add a new row to the given sample file <b>(Deprecated)</b>",
@@ -217,6 +219,7 @@ class EditSampleFile(Resource):
             abort(403)
 
         sample_file_name = os.path.join(study_location, sample_file_name)
+        check_if_match(sample_file_name)
 
         sample_df = pd.read_csv(sample_file_name, sep="\t", header=0, encoding='utf-8')
         sample_df = sample_df.replace(np.nan, '', regex=True)  # Remove NaN
@@ -234,7 +237,7 @@ class EditSampleFile(Resource):
         # Write the new row back in the file
         sample_df.to_csv(sample_file_name, sep="\t", encoding='utf-8', index=False)
 
-        return {'header': df_header, 'data': df_data_dict}
+        return {'header': df_header, 'data': df_data_dict}, 200, etag_header(sample_file_name)
 
     @swagger.operation(
         summary="Update existing rows in the given sample file <b>(Deprecated)</b>",
@@ -332,6 +335,7 @@ class EditSampleFile(Resource):
             abort(403)
 
         sample_file_name = os.path.join(study_location, sample_file_name)
+        check_if_match(sample_file_name)
 
         sample_df = pd.read_csv(sample_file_name, sep="\t", header=0, encoding='utf-8')
         sample_df = sample_df.replace(np.nan, '', regex=True)  # Remove NaN
@@ -359,7 +363,7 @@ class EditSampleFile(Resource):
         # Write the new row back in the file
         sample_df.to_csv(sample_file_name, sep="\t", encoding='utf-8', index=False)
 
-        return {'header': df_header, 'data': df_data_dict}
+        return {'header': df_header, 'data': df_data_dict}, 200, etag_header(sample_file_name)
 
     @swagger.operation(
         summary="Delete a row of the given sample file <b>(Deprecated)</b>",
@@ -442,6 +446,7 @@ class EditSampleFile(Resource):
             abort(403)
 
         sample_file_name = os.path.join(study_location, sample_file_name)
+        check_if_match(sample_file_name)
 
         sample_df = pd.read_csv(sample_file_name, sep="\t", header=0, encoding='utf-8')
         sample_df = sample_df.replace(np.nan, '', regex=True)  # Remove NaN
@@ -468,4 +473,4 @@ class EditSampleFile(Resource):
         # Get an indexed header row
         df_header = get_table_header(sample_df)
 
-        return {'header': df_header, 'data': df_data_dict}
+        return {'header': df_header, 'data': df_data_dict}, 200, etag_header(sample_file_name)
@@ -16,17 +16,26 @@
 #
 #  Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
 
+import base64
+import glob
+import hashlib
+import io
 import logging
 import os
-from zipfile import ZipFile
+import urllib.parse
+import uuid
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
 
-from flask import request, send_file, safe_join, abort, make_response
+from flask import current_app as app
+from flask import request, send_file, safe_join, abort, make_response, Response, stream_with_context
 from flask_restful import Resource, reqparse
 from flask_restful_swagger import swagger
 
 from app.ws.db_connection import get_obfuscation_code
+from app.ws.file_index import FileIndex, IndexedEntry
 from app.ws.mtblsWSclient import WsClient
-from app.ws.study_files import get_basic_files
+from app.ws.request_limits import limit_requests
+from app.ws.utils import get_file_type_rules, get_file_version
 
 logger = logging.getLogger('wslog')
 # MetaboLights (Java-Based) WebService client
@@ -39,7 +48,9 @@ class SendFiles(Resource):
         notes="Download/Stream files from the study folder</p>"
               "To download all the ISA-Tab metadata in one zip file, use the word <b>'metadata'</b> in the file_name."
               "</p>The 'obfuscation_code' path parameter is mandatory, but for any <b>PUBLIC</b> studies you can use the "
-              "keyword <b>'public'</b> instead of the real obfuscation code",
+              "keyword <b>'public'</b> instead of the real obfuscation code"
+              "</p>Single files can be downloaded in parts (HTTP Range requests, also with If-Range), "
+              "so an interrupted download can be resumed",
         parameters=[
             {
                 "name": "study_id",
@@ -81,6 +92,10 @@ class SendFiles(Resource):
                 "code": 200,
                 "message": "OK."
             },
+            {
+                "code": 206,
+                "message": "Partial Content. The requested range of the file."
+            },
             {
                 "code": 401,
                 "message": "Unauthorized. Access to the resource requires user authentication. "
@@ -93,9 +108,18 @@ class SendFiles(Resource):
             {
                 "code": 404,
                 "message": "Not found. The requested identifier is not valid or does not exist."
+            },
+            {
+                "code": 429,
+                "message": "Too Many Requests. Please wait for the number of seconds in the Retry-After header."
+            },
+            {
+                "code": 416,
+                "message": "Range Not Satisfiable. The requested range is not in the file."
             }
         ]
     )
+    @limit_requests('download')
     def get(self, study_id, obfuscation_code):
         # param validation
         if study_id is None:
@@ -103,9 +127,6 @@ class SendFiles(Resource):
             abort(404)
         study_id = study_id.upper()
 
-        if study_id == "MTBLS1405":
-            abort(429)
-
         # User authentication
         if "user_token" in request.headers:
             user_token = request.headers["user_token"]
@@ -130,16 +151,6 @@ class SendFiles(Resource):
         is_curator, read_access, write_access, db_obfuscation_code, study_location, release_date, submission_date, \
             study_status = wsc.get_permissions(study_id, user_token)
 
-        files = ""
-        if file_name == 'metadata':
-            file_list = get_basic_files(study_location, include_sub_dir=False, assay_file_list=None)
-            for _file in file_list:
-                f_type = _file['type']
-                f_name = _file['file']
-                if "metadata" in f_type:
-                    files = files + f_name + ','
-            file_name = files.rstrip(",")
-
         if not read_access:
             if obfuscation_code:
                 db_obfuscation_code_list = get_obfuscation_code(study_id)
@@ -150,56 +161,233 @@ class SendFiles(Resource):
             else:
                 abort(403)
         try:
-            remove_file = False
-
-            short_zip = study_id + "_compressed_files.zip"
-            zip_name = os.path.join(study_location, short_zip)
-            if os.path.isfile(zip_name):
-                os.remove(zip_name)
-
-            if ',' in file_name:
-                zipfile = ZipFile(zip_name, mode='a')
-                remove_file = True
-                files = file_name.split(',')
-                for file in files:
-                    safe_path = safe_join(study_location, file)
-                    if os.path.isdir(safe_path):
-                        for sub_file in recursively_get_files(safe_path):
-                            f_name = sub_file.path.replace(study_location, '')
-                            zipfile.write(sub_file.path, arcname=f_name)
-                    else:
-                        zipfile.write(safe_path, arcname=file)
-                zipfile.close()
-                remove_file = True
-                safe_path = zip_name
-                file_name = short_zip
-            else:
-                safe_path = safe_join(study_location, file_name)
-                if os.path.isdir(safe_path):
-                    zipfile = ZipFile(zip_name, mode='a')
-                    for sub_file in recursively_get_files(safe_path):
-                        zipfile.write(sub_file.path.replace(os.path.join(study_location, study_id), ''),
-                                      arcname=sub_file.name)
-                    zipfile.close()
-                    remove_file = True
-                    safe_path = zip_name
-                    file_name = short_zip
-                else:
-                    head, tail = os.path.split(file_name)
-                    file_name = tail
-
-            resp = make_response(send_file(safe_path, as_attachment=True, attachment_filename=file_name, cache_timeout=0))
-            # response.headers["Content-Disposition"] = "attachment; filename={}".format(file_name)
-            resp.headers['Content-Type'] = 'application/octet-stream'
-            return resp
+            if file_name == 'metadata':
+                return send_metadata_bundle(study_id, study_location)
+
+            if ',' in file_name or os.path.isdir(safe_join(study_location, file_name)):
+                # Zip the files on the fly, straight into the response
+                zip_files = get_zip_file_list(study_location, file_name.split(','))
+                short_zip = study_id + "_compressed_files.zip"
+                return Response(stream_with_context(stream_zip(zip_files)), mimetype='application/zip',
+                                headers={'Content-Disposition': 'attachment; filename=' + short_zip,
+                                         'X-Accel-Buffering': 'no'})
+
+            safe_path = safe_join(study_location, file_name)
+            head, tail = os.path.split(file_name)
+            file_name = tail
+
+            return send_study_file(safe_path, file_name, study_location=study_location)
         except FileNotFoundError as e:
             abort(404, "Could not find file " + file_name)
-        except Exception as e:
-            abort(404, "Could not create zip file " + str(e))
-        finally:
-            if remove_file:
-                os.remove(safe_path)
-                logger.info('Removed zip file ' + safe_path)
+
+
+def get_metadata_files(study_location):
+    # Same ISA-Tab file names as map_file_type() gives a metadata type, without checking the references
+    file_type_rules = get_file_type_rules()
+    return sorted(entry.path for entry in os.scandir(study_location)
+                  if file_type_rules.classify_name(entry.name)[0] == 'metadata' and entry.is_file())
+
+
+def send_metadata_bundle(study_id, study_location):
+    metadata_files = get_metadata_files(study_location)
+    if not metadata_files:
+        abort(404, "Could not find any metadata files for " + study_id)
+
+    if not app.config.get('METADATA_BUNDLE_ROOT'):  # No cache, zip the files on the fly
+        return Response(stream_with_context(stream_zip([(path, os.path.basename(path)) for path in metadata_files])),
+                        mimetype='application/zip',
+                        headers={'Content-Disposition': 'attachment; filename=' + study_id + '_metadata.zip'})
+
+    bundle = get_metadata_bundle(study_id, metadata_files)
+    resp = make_response(send_file(bundle, as_attachment=True, attachment_filename=study_id + '_metadata.zip',
+                                   cache_timeout=0, conditional=True))
+    resp.headers['Content-Type'] = 'application/zip'
+    return resp
+
+
+def get_metadata_bundle(study_id, metadata_files):
+    """
+    Zip file with the ISA-Tab metadata files of a study, kept in METADATA_BUNDLE_ROOT. The name has a hash of the
+    file names, modification times and sizes, so it is only built again when any of the metadata files change
+    :param study_id: MTBLS accession number
+    :param metadata_files: full paths to the metadata files
+    :return: full path to the zip file
+    """
+    fingerprint = hashlib.sha1()
+    for path in metadata_files:
+        mtime_ns, size = get_file_version(path)
+        fingerprint.update((os.path.basename(path) + ':' + str(mtime_ns) + ':' + str(size) + '\n').encode('utf-8'))
+
+    bundle_root = app.config.get('METADATA_BUNDLE_ROOT')
+    bundle_prefix = os.path.join(bundle_root, study_id + '_metadata_')
+    bundle = bundle_prefix + fingerprint.hexdigest() + '.zip'
+    if os.path.isfile(bundle):
+        return bundle
+
+    os.makedirs(bundle_root, exist_ok=True)
+    temp_bundle = bundle + '.' + uuid.uuid4().hex + '.tmp'  # Other requests may build the same bundle at the same time
+    try:
+        with ZipFile(temp_bundle, mode='w', compression=ZIP_DEFLATED) as zip_file:
+            for path in metadata_files:
+                zip_file.write(path, arcname=os.path.basename(path))
+        os.replace(temp_bundle, bundle)
+    finally:
+        if os.path.isfile(temp_bundle):
+            os.remove(temp_bundle)
+    logger.info('Created metadata bundle ' + bundle)
+
+    for old_bundle in glob.glob(bundle_prefix + '*.zip'):
+        if old_bundle != bundle:
+            try:
+                os.remove(old_bundle)
+            except OSError:
+                pass  # Already removed by another request
+    return bundle
+
+
+def send_study_file(safe_path, file_name, study_location=None):
+    """
+    Send one file, or let the front-end proxy send it (DOWNLOAD_OFFLOAD), once the access rights are checked.
+    Flask handles Range and If-Range requests (206), the proxies do the same themselves. If the checksums of the file
+    are known (see FileIndex.get_checksums()) they are sent in a Digest header
+    """
+    digest = get_file_digest(study_location, safe_path) if study_location else None
+    offload = app.config.get('DOWNLOAD_OFFLOAD')
+    if offload in ('x-accel-redirect', 'x-sendfile'):
+        if not os.path.isfile(safe_path):
+            raise FileNotFoundError(safe_path)
+        offload_header = get_offload_header(offload, safe_path)
+        if offload_header:
+            resp = make_response('')
+            resp.headers[offload_header[0]] = offload_header[1]
+            resp.headers.set('Content-Disposition', 'attachment', filename=file_name)
+            resp.headers['Content-Type'] = 'application/octet-stream'
+            if digest:
+                resp.headers['Digest'] = digest
+            return resp
+
+    resp = make_response(send_file(safe_path, as_attachment=True, attachment_filename=file_name, cache_timeout=0,
+                                   conditional=True))
+    # response.headers["Content-Disposition"] = "attachment; filename={}".format(file_name)
+    resp.headers['Content-Type'] = 'application/octet-stream'
+    if digest:
+        resp.headers['Digest'] = digest
+    return resp
+
+
+def get_file_digest(study_location, safe_path):
+    """
+    Digest header (RFC 3230) for a study file, from the checksums in the file index
+    :return: ie. 'md5=...,sha-256=...', or None if the checksums of the current version of the file are not known
+    """
+    try:
+        stat = os.stat(safe_path)
+    except OSError:
+        return None
+    entry = IndexedEntry(os.path.basename(safe_path), safe_path, stat.st_size, stat.st_mtime_ns, False)
+    with FileIndex(study_location) as file_index:
+        checksum = file_index.get_checksum(entry)
+    if checksum is None:
+        return None
+    return 'md5=' + base64.b64encode(bytes.fromhex(checksum.md5)).decode('ascii') + \
+        ',sha-256=' + base64.b64encode(bytes.fromhex(checksum.sha256)).decode('ascii')
+
+
+def get_offload_header(offload, safe_path):
+    """
+    The header that hands the file over to the proxy, nginx (X-Accel-Redirect) or Apache/lighttpd (X-Sendfile)
+    :return: (header name, value), or None if the proxy can not serve this file
+    """
+    if offload == 'x-sendfile':
+        return 'X-Sendfile', safe_path
+
+    accel_root = os.path.normpath(app.config.get('DOWNLOAD_ACCEL_ROOT'))
+    relative_path = os.path.relpath(os.path.normpath(safe_path), accel_root)
+    if relative_path.startswith(os.pardir):
+        logger.warning('File ' + safe_path + ' is not in ' + accel_root + ', can not use X-Accel-Redirect')
+        return None
+    return 'X-Accel-Redirect', app.config.get('DOWNLOAD_ACCEL_LOCATION') + urllib.parse.quote(relative_path)
+
+
+class ZipStreamBuffer(io.RawIOBase):
+    """
+    Unseekable output for ZipFile, the bytes written so far are taken out by stream_zip() and sent to the browser
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def get_zip_file_list(study_location, file_names):
+    """
+    All the files to zip, folders are added with all the files in them
+    :param study_location: study folder
+    :param file_names: files or folders, relative to the study folder
+    :return: list of (full path, name in the zip file)
+    """
+    zip_files = []
+    for file_name in file_names:
+        safe_path = safe_join(study_location, file_name.strip())
+        if os.path.isdir(safe_path):
+            zip_files.extend((sub_file.path, os.path.relpath(sub_file.path, study_location))
+                             for sub_file in recursively_get_files(safe_path))
+        elif os.path.isfile(safe_path):
+            zip_files.append((safe_path, os.path.relpath(safe_path, study_location)))
+        else:
+            raise FileNotFoundError(file_name)
+    return zip_files
+
+
+def is_compressed_file(arc_name):
+    # Raw data (also files in .d/.raw folders) and archives hardly get any smaller, only store them
+    extensions = tuple(ext.lower() for ext in app.config.get('RAW_FILES_LIST') + app.config.get('COMPRESSED_FILES_LIST'))
+    return any(part.lower().endswith(extensions) for part in arc_name.split(os.sep))
+
+
+def stream_zip(zip_files):
+    """
+    Generate a zip file (ZIP64 when needed) in chunks, while reading the files. Nothing is written to disk
+    :param zip_files: list of (full path, name in the zip file)
+    """
+    chunk_size = app.config.get('DOWNLOAD_CHUNK_SIZE')
+    buffer = ZipStreamBuffer()
+    with ZipFile(buffer, mode='w', allowZip64=True) as zip_file:
+        for path, arc_name in zip_files:
+            try:
+                zip_info = ZipInfo.from_file(path, arcname=arc_name)
+                source = open(path, 'rb')
+            except OSError as e:  # Too late to return an error, leave the file out
+                logger.error('Could not add ' + path + ' to the zip file. ' + str(e))
+                continue
+
+            # Once the entry is started, a read error can not be undone. Let it stop the stream, so the download
+            # fails instead of having a truncated file in it (with a valid CRC)
+            zip_info.compress_type = ZIP_STORED if is_compressed_file(arc_name) else ZIP_DEFLATED
+            try:
+                with source, zip_file.open(zip_info, mode='w') as target:
+                    for chunk in iter(lambda: source.read(chunk_size), b''):
+                        target.write(chunk)
+                        data = buffer.take()
+                        if data:
+                            yield data
+            except OSError as e:
+                logger.error('Could not read ' + path + ', stopping the zip file. ' + str(e))
+                raise
+            yield buffer.take()
+    yield buffer.take()  # The central directory
 
 
 def recursively_get_files(base_dir):
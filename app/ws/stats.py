@@ -23,6 +23,7 @@ from flask import request, abort
 from flask_restful import Resource
 from flask_restful_swagger import swagger
 
+from app.ws.file_index import get_directory_stats
 from app.ws.db_connection import get_all_study_acc, database_maf_info_table_actions, add_maf_info_data, \
     insert_update_data
 from app.ws.isaApiClient import IsaApiClient
@@ -117,7 +118,7 @@ def update_maf_stats(user_token):
             continue  # Cannot find the required metadata files, skip to the next study
 
         try:
-            number_of_files = sum([len(files) for r, d, files in os.walk(study_location)])
+            number_of_files = get_directory_stats(study_location).file_count
         except:
             number_of_files = 0
 
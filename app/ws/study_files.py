@@ -16,22 +16,24 @@
 #
 #  Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
 
+import base64
 import json
-import zipfile
-from copy import deepcopy
+from bisect import bisect_right
 from operator import itemgetter
-from os import scandir
 
+from flask import Response, stream_with_context
 from flask.json import jsonify
 from flask_restful import Resource, reqparse
 from flask_restful_swagger import swagger
 from marshmallow import ValidationError
-from dirsync import sync
+from app.ws.file_copy import CopyTask, copy_files, copy_folder, extract_zip_files, get_copy_plan
+from app.ws.file_index import FileIndex, get_scan_pool, scan_folder
 from app.ws.isaApiClient import IsaApiClient
+from app.ws.jobs import job_runner, get_job_response
 from app.ws.mtblsStudy import write_audit_files
 from app.ws.mtblsWSclient import WsClient
+from app.ws.request_limits import limit_requests
 from app.ws.utils import *
-from datetime import datetime
 
 logger = logging.getLogger('wslog')
 wsc = WsClient()
@@ -47,45 +49,40 @@ def get_all_files_from_filesystem(study_id, obfuscation_code, study_location, di
                 study_location, upload_location)
 
     start_time = time.time()
-    s_start_time = time.time()
-    study_files, latest_update_time = get_all_files(study_location, directory=directory,
-                                                    include_raw_data=include_raw_data,
-                                                    assay_file_list=assay_file_list, validation_only=validation_only,
-                                                    short_format=short_format, include_sub_dir=include_sub_dir,
-                                                    static_validation_file=static_validation_file)
-    logger.info("Listing study files for " + study_id + " took %s seconds" % round(time.time() - s_start_time, 2))
+
+    def list_study_files():
+        s_start_time = time.time()
+        listing = get_all_files(study_location, directory=directory, include_raw_data=include_raw_data,
+                                assay_file_list=assay_file_list, validation_only=validation_only,
+                                short_format=short_format, include_sub_dir=include_sub_dir,
+                                static_validation_file=static_validation_file)
+        logger.info("Listing study files for " + study_id + " took %s seconds" % round(time.time() - s_start_time, 2))
+        return listing
+
     upload_files = []
     if include_upload_folder:
-        u_start_time = time.time()
-
         # Does the private FTP folder exist?
         try:
             os.stat(upload_location)
         except:
             os.mkdir(upload_location)
 
-        upload_files, latest_update_time = get_all_files(upload_location, directory=directory,
-                                                         include_raw_data=include_raw_data,
-                                                         validation_only=validation_only, short_format=short_format,
-                                                         static_validation_file=static_validation_file)
-        logger.info("Listing upload files for " + study_id + " took %s seconds" % round(time.time() - u_start_time, 2))
+        # List the upload folder at the same time as the study folder
+        with get_scan_pool(1) as upload_listing:
+            upload_future = upload_listing.submit(
+                get_all_files_in_app_context, app._get_current_object(), upload_location, directory=directory,
+                include_raw_data=include_raw_data, validation_only=validation_only, short_format=short_format,
+                static_validation_file=static_validation_file)
+            study_files, latest_update_time = list_study_files()
+            upload_files, latest_update_time = upload_future.result()
+        logger.info("Listing upload files for " + study_id + " took %s seconds" % round(time.time() - start_time, 2))
+    else:
+        study_files, latest_update_time = list_study_files()
 
     # Sort the two lists
     study_files, upload_files = [sorted(l, key=itemgetter('file')) for l in (study_files, upload_files)]
 
-    # Now, the status for each file can differ from upload and study folder as only study files are
-    # referenced in the ISA-Tab files. If they are referenced, they get status 'active'
-    u_files = deepcopy(upload_files)
-    for row in u_files:
-        row.pop('status')
-
-    s_files = deepcopy(study_files)
-    for row in s_files:
-        row.pop('status')
-
-    upload_diff = [dict(i) for i in
-                   {frozenset(row.items()) for row in u_files} -
-                   {frozenset(row.items()) for row in s_files}]
+    upload_diff = get_upload_diff(study_files, upload_files)
 
     upload_location = upload_location.split('/mtblight')  # FTP/Aspera root starts here
 
@@ -94,6 +91,24 @@ def get_all_files_from_filesystem(study_id, obfuscation_code, study_location, di
     return study_files, upload_files, upload_diff, upload_location, latest_update_time
 
 
+def stream_files(study_location, upload_location, directory=None, include_raw_data=True, include_sub_dir=False,
+                 assay_file_list=None, checksums=False):
+    # Newline delimited JSON, the client can show the files while the rest of the (large) folders are still listed
+    def generate():
+        for location, folder, file_list in (('study', study_location, assay_file_list),
+                                            ('upload', upload_location, None)):
+            if not os.path.isdir(folder):
+                continue
+            for record in iterate_files(folder, directory=directory, include_raw_data=include_raw_data,
+                                        include_sub_dir=include_sub_dir, assay_file_list=file_list,
+                                        checksums=checksums):
+                record['location'] = location
+                yield json.dumps(record) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no'})
+
+
 class StudyFiles(Resource):
     @swagger.operation(
         summary="Get a list, with timestamps, of all files in the study and upload folder(s)",
@@ -126,6 +141,69 @@ class StudyFiles(Resource):
                 "paramType": "query",
                 "dataType": "string",
             },
+            {
+                "name": "stream",
+                "description": "Stream the files as they are found, as newline delimited JSON (application/x-ndjson). "
+                               "Each line is one file, with a location of 'study' or 'upload'",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "type": "Boolean",
+                "defaultValue": False,
+                "default": False
+            },
+            {
+                "name": "include_sub_dir",
+                "description": "When streaming, also list the files in all sub-directories",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "type": "Boolean",
+                "defaultValue": False,
+                "default": False
+            },
+            {
+                "name": "limit",
+                "description": "Return one page of (at most) this many files from the directory, sorted by name",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "dataType": "integer"
+            },
+            {
+                "name": "cursor",
+                "description": "Return the page after this cursor, use the 'nextCursor' value of the previous page",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "dataType": "string"
+            },
+            {
+                "name": "location",
+                "description": "Folder to page through, 'study' (default) or 'upload'",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "dataType": "string",
+                "enum": ["study", "upload"]
+            },
+            {
+                "name": "checksums",
+                "description": "When streaming or paging, add the md5 and sha256 of the files. These are null until "
+                               "they are worked out, see /studies/<study_id>/files/checksums",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "type": "Boolean",
+                "defaultValue": False,
+                "default": False
+            },
             {
                 "name": "user_token",
                 "description": "User API token",
@@ -140,12 +218,17 @@ class StudyFiles(Resource):
                 "code": 200,
                 "message": "OK."
             },
+            {
+                "code": 400,
+                "message": "Bad Request. The cursor, limit or location is not valid."
+            },
             {
                 "code": 404,
                 "message": "Not found. The requested identifier is not valid or does not exist."
             }
         ]
     )
+    @limit_requests('file_listing')
     def get(self, study_id):
 
         # param validation
@@ -164,16 +247,43 @@ class StudyFiles(Resource):
         parser = reqparse.RequestParser()
         parser.add_argument('include_raw_data', help='Include raw data')
         parser.add_argument('directory', help='List files in sub-directory')
+        parser.add_argument('stream', help='Stream the files as newline delimited JSON')
+        parser.add_argument('include_sub_dir', help='Include files in all sub-directories')
+        parser.add_argument('limit', help='Number of files per page')
+        parser.add_argument('cursor', help='Cursor of the next page')
+        parser.add_argument('location', help='Study or upload folder')
+        parser.add_argument('checksums', help='Add the checksums of the files')
         include_raw_data = False
         directory = None
+        stream = False
+        include_sub_dir = False
+        limit = None
+        cursor = None
+        location = 'study'
+        checksums = False
 
         if request.args:
             args = parser.parse_args(req=request)
-            include_raw_data = False if args['include_raw_data'].lower() != 'true' else True
+            include_raw_data = False if (args['include_raw_data'] or '').lower() != 'true' else True
             directory = args['directory'] if args['directory'] else None
-
-        if directory and directory.startswith(os.sep):
+            stream = (args['stream'] or '').lower() == 'true'
+            include_sub_dir = (args['include_sub_dir'] or '').lower() == 'true'
+            cursor = args['cursor'] if args['cursor'] else None
+            location = args['location'].lower() if args['location'] else location
+            checksums = (args['checksums'] or '').lower() == 'true'
+            if args['limit'] or cursor:
+                try:
+                    page_size = app.config.get('FILE_LIST_PAGE_SIZE')
+                    limit = min(int(args['limit']), page_size) if args['limit'] else page_size
+                except ValueError:
+                    abort(400, "limit must be a number")
+                if limit < 1:
+                    abort(400, "limit must be a positive number")
+
+        if directory and (directory.startswith(os.sep) or '..' in directory.split(os.sep)):
             abort(401, "You can only specify folders in the current study folder")
+        if location not in ('study', 'upload'):
+            abort(400, "location must be 'study' or 'upload'")
 
         # check for access rights
         is_curator, read_access, write_access, obfuscation_code, study_location, release_date, submission_date, study_status = \
@@ -181,6 +291,25 @@ class StudyFiles(Resource):
         if not read_access:
             abort(403)
 
+        upload_location = app.config.get('MTBLS_FTP_ROOT') + study_id.lower() + "-" + obfuscation_code
+
+        if stream:
+            return stream_files(study_location, upload_location, directory=directory,
+                                include_raw_data=include_raw_data, include_sub_dir=include_sub_dir,
+                                assay_file_list=get_assay_file_list(study_location), checksums=checksums)
+
+        if limit:
+            folder = study_location if location == 'study' else upload_location
+            assay_file_list = get_assay_file_list(study_location) if location == 'study' else None
+            try:
+                file_list, next_cursor = get_files_page(folder, directory=directory, cursor=cursor, limit=limit,
+                                                        include_raw_data=include_raw_data,
+                                                        assay_file_list=assay_file_list, checksums=checksums)
+            except FileNotFoundError:
+                abort(404, "Folder not found")
+            return jsonify({'files': file_list, 'nextCursor': next_cursor, 'location': location,
+                            'directory': directory})
+
         study_files, upload_files, upload_diff, upload_location, latest_update_time = \
             get_all_files_from_filesystem(study_id, obfuscation_code, study_location,
                                           directory=directory, include_raw_data=include_raw_data,
@@ -408,6 +537,29 @@ class CopyFilesFolders(Resource):
                 "required": False,
                 "allowMultiple": False
             },
+            {
+                "name": "dry_run",
+                "description": "Do not copy anything, only return the files that would be copied",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "type": "Boolean",
+                "defaultValue": False,
+                "default": False
+            },
+            {
+                "name": "background",
+                "description": "Run as a background job. Returns a job id at once, "
+                               "use /studies/<study_id>/jobs/<job_id> for the progress and result",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "type": "Boolean",
+                "defaultValue": False,
+                "default": False
+            },
             {
                 "name": "user_token",
                 "description": "User API token",
@@ -422,6 +574,10 @@ class CopyFilesFolders(Resource):
                 "code": 200,
                 "message": "OK. Files/Folders were copied across."
             },
+            {
+                "code": 202,
+                "message": "Accepted. The background job was submitted, see jobId."
+            },
             {
                 "code": 401,
                 "message": "Unauthorized. Access to the resource requires user authentication."
@@ -452,14 +608,20 @@ class CopyFilesFolders(Resource):
         parser = reqparse.RequestParser()
         parser.add_argument('include_raw_data', help='Include raw data')
         parser.add_argument('file_location', help='Alternative file location')
+        parser.add_argument('dry_run', help='Only list the files that would be copied')
+        parser.add_argument('background', help='Run as a background job')
         include_raw_data = False
         file_location = None
+        dry_run = False
+        background = False
 
         # If false, only sync ISA-Tab metadata files
         if request.args:
             args = parser.parse_args(req=request)
-            include_raw_data = False if args['include_raw_data'].lower() != 'true' else True
+            include_raw_data = False if (args['include_raw_data'] or '').lower() != 'true' else True
             file_location = args['file_location']
+            dry_run = (args['dry_run'] or '').lower() == 'true'
+            background = (args['background'] or '').lower() == 'true'
 
         # body content validation
         files = {}
@@ -487,64 +649,93 @@ class CopyFilesFolders(Resource):
         logger.info("For %s we use %s as the upload path. The study path is %s", study_id, upload_location,
                     study_location)
 
+        if not single_files_only or not files:
+            files = None
+
+        if dry_run:
+            if files:
+                abort(400, 'A dry run is only possible when copying all files')
+            return {'plan': copytree(upload_location, study_location, include_raw_data=include_raw_data,
+                                     include_investigation_file=is_curator, dry_run=True)}
+
         audit_status, dest_path = write_audit_files(study_location)
-        if single_files_only and len(files) >= 1:
-            for file in files:
-                try:
-                    from_file = file["from"]
-                    to_file = file["to"]
-                    source_file = os.path.join(upload_location, to_file)
-                    destination_file = os.path.join(study_location, to_file)
-
-                    logger.info("Copying specific file %s to %s", from_file, to_file)
-
-                    if not from_file or not to_file:
-                        abort(417, "Please provide both 'from' and 'to' file parameters")
-
-                    if from_file != to_file:
-                        if os.path.isfile(source_file):
-                            logger.info(
-                                "The filename/folder you are copying to (%s) already exists in the upload folder, deleting first",
-                                to_file)
-                            os.remove(source_file, source_file)
-                        else:
-                            logger.info("Renaming file %s to %s", from_file, to_file)
-                            os.rename(os.path.join(upload_location, from_file), source_file)
-
-                    if os.path.isdir(source_file):
-                        logger.info(source_file + ' is a directory')
-                        try:
-                            if os.path.exists(destination_file) and os.path.isdir(destination_file):
-                                logger.info('Removing directory ' + destination_file)
-                                shutil.rmtree(destination_file)  # Remove the destination file/folder first
-
-                            logger.info("Copying folder '%s' to study folder '%s'", source_file, destination_file)
-                            shutil.copytree(source_file, destination_file)
-                            status = True
-                        except OSError as e:
-                            logger.error('Folder already exists? Can not copy %s to %s',
-                                         source_file, destination_file, str(e))
+
+        if background:
+            return get_job_response(job_runner.submit('copy', study_id, copy_upload_files, study_id, user_token,
+                                                      upload_location, study_location, files=files,
+                                                      include_raw_data=include_raw_data,
+                                                      include_investigation_file=is_curator))
+        return copy_upload_files(study_id, user_token, upload_location, study_location, files=files,
+                                 include_raw_data=include_raw_data, include_investigation_file=is_curator)
+
+
+def copy_upload_files(study_id, user_token, upload_location, study_location, files=None, include_raw_data=False,
+                      include_investigation_file=False, progress=None):
+    """
+    Copy files from the upload folder to the study folder, and reindex the study
+    :param files: only copy these files (list of {'from': ..., 'to': ...}), None for all new and updated files
+    :param include_investigation_file: also copy the investigation file, only for curators
+    :param progress: JobProgress when running as a background job
+    """
+    status = False
+    message = None
+    if files:
+        for file_count, file in enumerate(files):
+            if progress:
+                progress.update(files_done=file_count, files_total=len(files))
+            try:
+                from_file = file["from"]
+                to_file = file["to"]
+                source_file = os.path.join(upload_location, to_file)
+                destination_file = os.path.join(study_location, to_file)
+
+                logger.info("Copying specific file %s to %s", from_file, to_file)
+
+                if not from_file or not to_file:
+                    abort(417, "Please provide both 'from' and 'to' file parameters")
+
+                if from_file != to_file:
+                    if os.path.isfile(source_file):
+                        logger.info(
+                            "The filename/folder you are copying to (%s) already exists in the upload folder, deleting first",
+                            to_file)
+                        os.remove(source_file, source_file)
                     else:
-                        logger.info("Copying file %s to study folder %s", to_file, study_location)
-                        shutil.copy2(source_file, destination_file)
-                        status = True
-                except Exception as e:
-                    logger.error('File copy failed with error ' + str(e))
+                        logger.info("Renaming file %s to %s", from_file, to_file)
+                        os.rename(os.path.join(upload_location, from_file), source_file)
+
+                if os.path.isdir(source_file):
+                    logger.info(source_file + ' is a directory')
+                    try:
+                        # Same as replacing the folder, but files that are already there are not copied again
+                        logger.info("Copying folder '%s' to study folder '%s'", source_file, destination_file)
+                        stats = copy_folder(source_file, destination_file, purge=True,
+                                            source_location=upload_location, destination_location=study_location)
+                        status = not stats.errors
+                    except OSError as e:
+                        logger.error('Can not copy %s to %s. %s', source_file, destination_file, str(e))
+                else:
+                    logger.info("Copying file %s to study folder %s", to_file, study_location)
+                    stats = copy_files([CopyTask(source_file, destination_file, os.path.getsize(source_file))])
+                    status = not stats.errors
+            except Exception as e:
+                logger.error('File copy failed with error ' + str(e))
+        if progress:
+            progress.update(files_done=len(files), files_total=len(files))
 
-        else:
-            logger.info("Copying all newer files from '%s' to '%s'", upload_location, study_location)
-            include_inv = False
-            if is_curator:
-                include_inv = True
-            status, message = copy_files_and_folders(upload_location, study_location,
-                                                     include_raw_data=include_raw_data,
-                                                     include_investigation_file=include_inv)
+    else:
+        logger.info("Copying all newer files from '%s' to '%s'", upload_location, study_location)
+        status, message = copy_files_and_folders(upload_location, study_location,
+                                                 include_raw_data=include_raw_data,
+                                                 include_investigation_file=include_investigation_file,
+                                                 progress=progress)
+
+    if status:
+        reindex_status, message = wsc.reindex_study(study_id, user_token)
+        return {'Success': 'Copied files from ' + upload_location}
+    else:
+        return {'Warning': message}
 
-        if status:
-            reindex_status, message = wsc.reindex_study(study_id, user_token)
-            return {'Success': 'Copied files from ' + upload_location}
-        else:
-            return {'Warning': message}
 
 class SyncFolder(Resource):
     @swagger.operation(
@@ -567,6 +758,29 @@ class SyncFolder(Resource):
                 "required": True,
                 "allowMultiple": False
             },
+            {
+                "name": "dry_run",
+                "description": "Do not copy anything, only return the files that would be copied",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "type": "Boolean",
+                "defaultValue": False,
+                "default": False
+            },
+            {
+                "name": "background",
+                "description": "Run as a background job. Returns a job id at once, "
+                               "use /studies/<study_id>/jobs/<job_id> for the progress and result",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "type": "Boolean",
+                "defaultValue": False,
+                "default": False
+            },
             {
                 "name": "user_token",
                 "description": "User API token",
@@ -581,6 +795,10 @@ class SyncFolder(Resource):
                 "code": 200,
                 "message": "OK. Files/Folders were copied across."
             },
+            {
+                "code": 202,
+                "message": "Accepted. The background job was submitted, see jobId."
+            },
             {
                 "code": 401,
                 "message": "Unauthorized. Access to the resource requires user authentication."
@@ -610,11 +828,21 @@ class SyncFolder(Resource):
         # query validation
         parser = reqparse.RequestParser()
         parser.add_argument('directory_name', help='Alternative file location')
+        parser.add_argument('dry_run', help='Only list the files that would be copied')
+        parser.add_argument('background', help='Run as a background job')
+        directory_name = None
+        dry_run = False
+        background = False
 
         # If false, only sync ISA-Tab metadata files
         if request.args:
             args = parser.parse_args(req=request)
             directory_name = args['directory_name']
+            dry_run = (args['dry_run'] or '').lower() == 'true'
+            background = (args['background'] or '').lower() == 'true'
+
+        if not directory_name:
+            abort(400, 'Please provide the directory_name to sync')
 
         # check for access rights
         is_curator, read_access, write_access, obfuscation_code, study_location, release_date, submission_date, \
@@ -622,24 +850,47 @@ class SyncFolder(Resource):
         if not write_access:
             abort(403)
 
-        destination = app.config.get('MTBLS_FTP_ROOT') + study_id.lower() + '-' + obfuscation_code + "/" + directory_name
+        upload_location = app.config.get('MTBLS_FTP_ROOT') + study_id.lower() + '-' + obfuscation_code
+        destination = upload_location + "/" + directory_name
         source = study_location + "/" + directory_name
-        logger.info("syncing files from " + source + " to " + destination)
-        try:
-            if not os.path.exists(destination):
-                os.makedirs(destination)
-                os.chmod(destination, 0o777)
-            sync(source, destination, 'sync', purge=False, logger=logger)
-            logger.info('Copied file %s to %s', source, destination)
-            return {'Success': 'Copied files from study folder to  ftp folder'}
-        except OSError as e:
-            logger.error('Does the folder already exists? Can not copy %s to %s', source,
-                         destination, str(e))
-        except FileExistsError as e:
-            logger.error('Folder already exists! Can not copy %s to %s', source, destination,
-                         str(e))
-        except Exception as e:
-            logger.error('Other error! Can not copy %s to %s', source, destination, str(e))
+        if dry_run:
+            return {'plan': get_copy_plan(source, destination, source_location=study_location,
+                                          destination_location=upload_location)}
+        if background:
+            return get_job_response(job_runner.submit('sync', study_id, sync_study_folder, source, destination,
+                                                      study_location, upload_location))
+        return sync_study_folder(source, destination, study_location, upload_location)
+
+
+def sync_study_folder(source, destination, study_location, upload_location, progress=None):
+    """
+    Copy the new and updated files in a folder from the study folder to the upload (FTP) folder. Both folders are
+    listed with their file index, so only the sub-folders that changed since the last sync are listed again
+    :param progress: JobProgress when running as a background job, errors are raised so the job fails
+    """
+    logger.info("syncing files from " + source + " to " + destination)
+    try:
+        if not os.path.exists(destination):
+            os.makedirs(destination)
+            os.chmod(destination, 0o777)
+        # Never hard link, the users can change the files in the upload folder
+        stats = copy_folder(source, destination, link=False, progress=progress, source_location=study_location,
+                            destination_location=upload_location)
+        logger.info('Copied file %s to %s', source, destination)
+        if stats.errors:
+            return {'Warning': 'Not all files were copied from study folder to ftp folder. ' + str(stats),
+                    'errors': stats.errors}
+        return {'Success': 'Copied files from study folder to  ftp folder. ' + str(stats)}
+    except OSError as e:
+        logger.error('Does the folder already exists? Can not copy %s to %s. %s', source, destination, str(e))
+        if progress:
+            raise
+        return {'Error': 'Can not copy files from study folder to ftp folder. ' + str(e)}
+    except Exception as e:
+        logger.error('Other error! Can not copy %s to %s. %s', source, destination, str(e))
+        if progress:
+            raise
+        return {'Error': 'Can not copy files from study folder to ftp folder. ' + str(e)}
 
 
 class SampleStudyFiles(Resource):
@@ -775,6 +1026,18 @@ class UnzipFiles(Resource):
                 "defaultValue": False,
                 "default": True
             },
+            {
+                "name": "background",
+                "description": "Run as a background job. Returns a job id at once, "
+                               "use /studies/<study_id>/jobs/<job_id> for the progress and result",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "type": "Boolean",
+                "defaultValue": False,
+                "default": False
+            },
             {
                 "name": "user_token",
                 "description": "User API token",
@@ -789,6 +1052,10 @@ class UnzipFiles(Resource):
                 "code": 200,
                 "message": "OK. Files unzipped."
             },
+            {
+                "code": 202,
+                "message": "Accepted. The background job was submitted, see jobId."
+            },
             {
                 "code": 401,
                 "message": "Unauthorized. Access to the resource requires user authentication."
@@ -819,14 +1086,17 @@ class UnzipFiles(Resource):
         parser = reqparse.RequestParser()
         parser.add_argument('files', help='files')
         parser.add_argument('force', help='Remove zip files')
+        parser.add_argument('background', help='Run as a background job')
         files = None
         remove_zip = False
+        background = False
 
         # If false, only sync ISA-Tab metadata files
         if request.args:
             args = parser.parse_args(req=request)
             files = args['files'] if args['files'] else None
-            remove_zip = False if args['force'].lower() != 'true' else True
+            remove_zip = False if (args['force'] or '').lower() != 'true' else True
+            background = (args['background'] or '').lower() == 'true'
 
         # body content validation
         try:
@@ -846,39 +1116,50 @@ class UnzipFiles(Resource):
 
         audit_status, dest_path = write_audit_files(study_location)
 
-        inv_message = ""
-
-        for file in files:
-            f_name = file["name"]
-            try:
-                with zipfile.ZipFile(os.path.join(study_location, f_name), "r") as zip_ref:
-                    # zip_ref.extractall(study_location)
-                    list_of_file_names = zip_ref.namelist()
-                    for file_name in list_of_file_names:
-                        if not (file_name.startswith('i_') and file_name.endswith('.txt')):
-                            # Extract a single file from zip
-                            zip_ref.extract(file_name, path=study_location)
-                        else:
-                            inv_message = '. Investigation file not extracted'
-
-            except Exception as e:
-                msg = 'Could not extract zip file ' + f_name
-                logger.error(msg + ":" + str(e))
-                return {'Error': msg}
-
-            try:
-                if remove_zip:
-                    remove_file(study_location, f_name, allways_remove=True)
-            except:
-                msg = 'Could not remove zip file ' + f_name
-                logger.error(msg)
-                return {'Error': msg}
+        if background:
+            return get_job_response(job_runner.submit('unzip', study_id, unzip_study_files, study_location, files,
+                                                      remove_zip=remove_zip))
+        return unzip_study_files(study_location, files, remove_zip=remove_zip)
+
+
+def unzip_study_files(study_location, files, remove_zip=False, progress=None):
+    """
+    Extract zip files in the study folder, except any investigation file in them. The members of all the zip files
+    are extracted in parallel, members that were already extracted are skipped, see extract_zip_files()
+    :param files: list of {'name': zip file name}
+    :param remove_zip: remove the zip files afterwards
+    :param progress: JobProgress when running as a background job
+    """
+    investigation_files = []
+
+    def include_member(member_name):
+        if member_name.startswith('i_') and member_name.endswith('.txt'):
+            investigation_files.append(member_name)
+            return False
+        return True
+
+    zip_files = [os.path.join(study_location, file["name"]) for file in files]
+    stats = extract_zip_files(zip_files, study_location, include=include_member, progress=progress)
+    if stats.errors:
+        msg = 'Could not extract zip file ' + ', '.join(file["name"] for file in files)
+        logger.error(msg + ": " + '; '.join(stats.errors))
+        return {'Error': msg + '. ' + stats.errors[0]}
+
+    for file in files:
+        try:
+            if remove_zip:
+                remove_file(study_location, file["name"], allways_remove=True)
+        except:
+            msg = 'Could not remove zip file ' + file["name"]
+            logger.error(msg)
+            return {'Error': msg}
 
-        ret_msg = 'Files unzipped' + inv_message
-        if remove_zip:
-            ret_msg = 'Files unzipped and removed' + inv_message
+    inv_message = '. Investigation file not extracted' if investigation_files else ''
+    ret_msg = 'Files unzipped' + inv_message
+    if remove_zip:
+        ret_msg = 'Files unzipped and removed' + inv_message
 
-        return {'Success': ret_msg}
+    return {'Success': ret_msg + '. ' + str(stats)}
 
 
 def clean_name(name):
@@ -919,6 +1200,39 @@ def get_all_files(path, directory=None, include_raw_data=False, assay_file_list=
     return files, latest_update_time
 
 
+def get_file_key(entry, ignore_fields=()):
+    # Hashable key for a file list entry, so we can use sets/dicts instead of searching lists
+    if not isinstance(entry, dict):
+        return entry
+    key = tuple(sorted((field, value) for field, value in entry.items() if field not in ignore_fields))
+    try:
+        hash(key)
+    except TypeError:  # ie. a list value read from a static validation file
+        key = json.dumps(key, sort_keys=True)
+    return key
+
+
+def get_upload_diff(study_files, upload_files):
+    """
+    The files in the upload folder that are not (the same) in the study folder. The status for each file can
+    differ from upload and study folder as only study files are referenced in the ISA-Tab files. If they are
+    referenced, they get status 'active', so the status is not compared (or returned)
+    """
+    study_keys = {get_file_key(row, ignore_fields=('status',)) for row in study_files}
+    upload_diff = {}
+    for row in upload_files:
+        key = get_file_key(row, ignore_fields=('status',))
+        if key not in study_keys and key not in upload_diff:
+            upload_diff[key] = {field: value for field, value in row.items() if field != 'status'}
+    return list(upload_diff.values())
+
+
+def get_all_files_in_app_context(flask_app, path, **kwargs):
+    # For listing a folder in another thread, which does not have the application context of the request
+    with flask_app.app_context():
+        return get_all_files(path, **kwargs)
+
+
 def get_file_information(study_location=None, path=None, directory=None, include_raw_data=False,
                          assay_file_list=None, validation_only=False, short_format=None,
                          include_sub_dir=None, static_validation_file=None):
@@ -926,6 +1240,7 @@ def get_file_information(study_location=None, path=None, directory=None, include
     file_name = ""
     ignore_file_list = app.config.get('IGNORE_FILE_LIST')
     latest_update_time = ""
+    latest_raw_time = ""
     try:
         timeout_secs = app.config.get('FILE_LIST_TIMEOUT')
         end_time = time.time() + timeout_secs
@@ -934,12 +1249,16 @@ def get_file_information(study_location=None, path=None, directory=None, include
             path = os.path.join(path, directory)
 
         tree_file_list = []
+        static_file_found = False
         try:
-            tree_file_list, static_file_found = \
-                list_directories(study_location, dir_list=[], base_study_location=study_location,
-                                 short_format=short_format, validation_only=validation_only,
-                                 include_sub_dir=include_sub_dir, static_validation_file=static_validation_file,
-                                 include_raw_data=include_raw_data, ignore_file_list=ignore_file_list)
+            with FileIndex(study_location, assay_file_list=assay_file_list) as file_index:
+                tree_file_list, static_file_found = \
+                    list_directories(study_location, dir_list=[], base_study_location=study_location,
+                                     assay_file_list=assay_file_list, short_format=short_format,
+                                     validation_only=validation_only, include_sub_dir=include_sub_dir,
+                                     static_validation_file=static_validation_file,
+                                     include_raw_data=include_raw_data, ignore_file_list=ignore_file_list,
+                                     file_index=file_index)
             # tree_file_list, folder_list = traverse_subfolders(
             #     study_location=study_location, file_location=path, file_list=tree_file_list, all_folders=[], full_path=True)
 
@@ -972,7 +1291,10 @@ def get_file_information(study_location=None, path=None, directory=None, include
                 return file_list  # Return after xx seconds regardless
 
             if not file_name.startswith('.'):  # ignore hidden files on Linux/UNIX:
-                if not include_raw_data:  # Only return metadata files
+                if not directory and not short_format and not static_file_found:
+                    # The file index has already given us the times and type, no need to look at the file again
+                    file_time, raw_time = entry['createdAt'], entry['timestamp']
+                elif not include_raw_data:  # Only return metadata files
                     if file_name.startswith(('i_', 'a_', 's_', 'm_')):
                         file_time, raw_time, file_type, status, folder = \
                             get_file_times(path, file_name, validation_only=validation_only)
@@ -990,13 +1312,9 @@ def get_file_information(study_location=None, path=None, directory=None, include
                 if file_type:
                     file_list.append({"file": file_name, "createdAt": file_time, "timestamp": raw_time,
                                       "type": file_type, "status": status, "directory": folder})
-                    if latest_update_time == "":
-                        latest_update_time = file_time
-                    else:
-                        latest_update_time = latest_update_time if datetime.strptime(latest_update_time,
-                                                                                     "%B %d %Y %H:%M:%S") > datetime.strptime(
-                            file_time, "%B %d %Y %H:%M:%S") \
-                            else file_time
+                    # The raw timestamps (20180724092134) sort in time order, no need to parse the dates
+                    if raw_time and raw_time > latest_raw_time:
+                        latest_raw_time, latest_update_time = raw_time, file_time
     except Exception as e:
         logger.error('Error in listing files under ' + path + '. Last file was ' + file_name)
         logger.error(str(e))
@@ -1004,20 +1322,20 @@ def get_file_information(study_location=None, path=None, directory=None, include
     return file_list, latest_update_time
 
 
-def flatten_list(list_name, flat_list=None):
+def flatten_list(list_name, flat_list=None, seen=None):
     # Now, with sub-folders we may have lists of lists, so flatten the structure
-    if not flat_list:
+    if flat_list is None:
         flat_list = []
+    if seen is None:
+        seen = {get_file_key(entry) for entry in flat_list}
 
     for entry in list_name:
         if isinstance(entry, list):
-            for sub_entry in entry:
-                if isinstance(sub_entry, list):
-                    flatten_list(sub_entry, flat_list=flat_list)
-                elif sub_entry not in flat_list and type(sub_entry) != bool:
-                    flat_list.append(sub_entry)
-        else:
-            if type(entry) != bool and entry not in flat_list:
+            flatten_list(entry, flat_list=flat_list, seen=seen)
+        elif type(entry) != bool:
+            key = get_file_key(entry)
+            if key not in seen:
+                seen.add(key)
                 flat_list.append(entry)
     return flat_list
 
@@ -1042,6 +1360,132 @@ def get_file_times(directory, file_name, assay_file_list=None, validation_only=F
     return file_time, raw_time, file_type, status, folder
 
 
+def get_file_record(entry, name, file_index, sub_folder=False, checksums=False):
+    file_type, status, folder = file_index.get_file_type(entry)
+    if sub_folder and entry.name.startswith(('i_', 'a_', 's_', 'm_')):
+        status = 'old'  # metadata files in a sub-directory are not active
+    file_time, raw_time = get_entry_times(entry)
+    record = {"file": name, "createdAt": file_time, "timestamp": raw_time, "type": file_type, "status": status,
+              "directory": folder}
+    if checksums and not entry.is_dir():
+        checksum = file_index.get_checksum(entry)
+        record['md5'], record['sha256'] = (checksum.md5, checksum.sha256) if checksum else (None, None)
+    return record
+
+
+def get_listed_entries(file_index, folder, include_raw_data=True):
+    # The visible entries of one folder, sorted by name so the listing order is stable between requests
+    entries = [entry for entry in file_index.scan(folder) if not entry.name.startswith('.') and
+               (include_raw_data or entry.name.startswith(('i_', 'a_', 's_', 'm_')))]
+    entries.sort(key=lambda entry: entry.name)
+    return entries
+
+
+def iterate_files(location, directory=None, include_raw_data=True, include_sub_dir=False, assay_file_list=None,
+                  checksums=False):
+    """
+    Yield the files in a study or upload folder one at the time, as each folder is listed (in name order per folder)
+    :param location: study or upload folder
+    :param directory: start in this sub-folder
+    :param include_raw_data: False = only list ISA-Tab metadata files
+    :param include_sub_dir: also list the files in all sub-folders
+    :param assay_file_list: the assay files of the study, for the file types
+    :param checksums: add the md5 and sha256 of the files, if they were worked out already
+    """
+    with FileIndex(location, assay_file_list=assay_file_list) as file_index:
+        folders = [os.path.join(location, directory) if directory else location]
+        while folders:
+            folder = folders.pop()
+            try:
+                entries = get_listed_entries(file_index, folder, include_raw_data=include_raw_data)
+            except OSError as e:
+                logger.error('Could not list folder ' + folder + '. ' + str(e))
+                continue
+            sub_folders = []
+            for entry in entries:
+                name = os.path.relpath(entry.path, location)
+                record = get_file_record(entry, name, file_index, sub_folder=os.sep in name, checksums=checksums)
+                yield record
+                if entry.is_dir() and include_sub_dir and record['type'] != 'audit':
+                    sub_folders.append(entry.path)
+            folders.extend(reversed(sub_folders))  # Depth first, in name order
+
+
+def get_files_page(location, directory=None, cursor=None, limit=None, include_raw_data=True, assay_file_list=None,
+                   checksums=False):
+    """
+    One page of the files in a folder (not recursive), in name order
+    :param cursor: value of nextCursor from the previous page, None for the first page
+    :param limit: maximum number of files on the page
+    :param checksums: add the md5 and sha256 of the files, if they were worked out already
+    :return: list of files and the cursor for the next page (None on the last page)
+    """
+    folder = os.path.join(location, directory) if directory else location
+    with FileIndex(location, assay_file_list=assay_file_list) as file_index:
+        entries = get_listed_entries(file_index, folder, include_raw_data=include_raw_data)
+        names = [entry.name for entry in entries]
+        start = bisect_right(names, decode_file_cursor(cursor)) if cursor else 0
+        page = entries[start:start + limit]
+        file_list = [get_file_record(entry, os.path.relpath(entry.path, location), file_index,
+                                     sub_folder=bool(directory), checksums=checksums) for entry in page]
+
+    next_cursor = None
+    if page and start + limit < len(entries):
+        next_cursor = encode_file_cursor(page[-1].name)
+    return file_list, next_cursor
+
+
+def get_tree_level(location, directory=None, assay_file_list=None, folder_stats=False):
+    """
+    One level of the file tree, for the lazy tree view. The folders on this level are listed as well (in parallel),
+    for their number of entries and the size of the files directly in them, but nothing further down
+    :param location: study folder
+    :param directory: sub-folder to list, None for the study folder itself
+    :param folder_stats: add the size, file count and latest update of everything under each folder
+    :return: list of files, folders have childCount and size
+    """
+    folder = os.path.normpath(os.path.join(location, directory) if directory else location)
+    file_list = []
+    with FileIndex(location, assay_file_list=assay_file_list) as file_index:
+        file_index.prefetch(folder, lambda entry: os.path.dirname(entry.path) == folder
+                            and not entry.name.startswith('.'))
+        for entry in get_listed_entries(file_index, folder):
+            record = get_file_record(entry, os.path.relpath(entry.path, location), file_index,
+                                     sub_folder=bool(directory))
+            if entry.is_dir():
+                try:
+                    children = [child for child in file_index.scan(entry.path) if not child.name.startswith('.')]
+                    record['childCount'] = len(children)
+                    record['size'] = sum(child.size for child in children if not child.is_dir())
+                except OSError:
+                    record['childCount'], record['size'] = None, None
+                if folder_stats:
+                    record['stats'] = get_stats_record(file_index.get_stats(entry.path))
+            else:
+                record['size'] = entry.size
+            file_list.append(record)
+    return file_list
+
+
+def get_stats_record(stats):
+    latest_update = ""
+    if stats.latest_mtime_ns:
+        latest_update = time.strftime(file_date_format, time.gmtime(stats.latest_mtime_ns / 1e9))
+    return {"size": stats.size, "fileCount": stats.file_count, "folderCount": stats.folder_count,
+            "latestUpdate": latest_update}
+
+
+def encode_file_cursor(file_name):
+    return base64.urlsafe_b64encode(file_name.encode('utf-8')).decode('ascii')
+
+
+def decode_file_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    except (ValueError, UnicodeError):
+        abort(400, "Invalid cursor")
+
+
 def get_basic_files(study_location, include_sub_dir, assay_file_list=None, metadata_only=False):
     file_list = []
     start_time = time.time()
@@ -1050,40 +1494,47 @@ def get_basic_files(study_location, include_sub_dir, assay_file_list=None, metad
         file_list = list_directories_full(study_location, file_list, base_study_location=study_location)
         # file_list = list_directories(study_location, file_list, base_study_location=study_location, include_sub_dir=include_sub_dir)
     else:
-        for entry in scandir(study_location):
-            if not entry.name.startswith("."):
-                file_name = entry.name
-                fname, ext = os.path.splitext(file_name)
-                if metadata_only and fname.startswith(('i_', 'a_', 's_', 'm_')) and (ext == '.txt' or ext == '.tsv'):
-                    file_type, status, folder = map_file_type(file_name, study_location,
-                                                              assay_file_list=assay_file_list)
-                else:
-                    file_type, status, folder = map_file_type(file_name, study_location,
-                                                              assay_file_list=assay_file_list)
-                name = entry.path.replace(study_location + os.sep, '')
+        with FileIndex(study_location, assay_file_list=assay_file_list) as file_index:
+            for entry in file_index.scan(study_location):
+                if not entry.name.startswith("."):
+                    file_type, status, folder = file_index.get_file_type(entry)
+                    name = entry.path.replace(study_location + os.sep, '')
 
-                file_list.append({"file": name, "createdAt": "", "timestamp": "", "type": file_type,
-                                  "status": status, "directory": folder})
+                    file_list.append({"file": name, "createdAt": "", "timestamp": "", "type": file_type,
+                                      "status": status, "directory": folder})
 
     logger.info("Basic tree listing for all files for "
                 + study_location + " took %s seconds" % round(time.time() - start_time, 2))
     return file_list
 
 
-def list_directories_full(file_location, dir_list, base_study_location, assay_file_list=None):
-    for entry in scandir(file_location):
+def list_directories_full(file_location, dir_list, base_study_location, assay_file_list=None, file_index=None):
+    if file_index is None:
+        with FileIndex(base_study_location, assay_file_list=assay_file_list) as file_index:
+            file_index.prefetch(file_location, lambda entry: True)  # List all sub-folders in parallel
+            return list_directories_full(file_location, dir_list, base_study_location,
+                                         assay_file_list=assay_file_list, file_index=file_index)
+
+    for entry in file_index.scan(file_location):
         name = entry.path.replace(base_study_location + os.sep, '')
-        file_type, status, folder = map_file_type(entry.name, file_location, assay_file_list=assay_file_list)
+        file_type, status, folder = file_index.get_file_type(entry)
         dir_list.append({"file": name, "createdAt": "", "timestamp": "", "type": file_type,
                          "status": status, "directory": folder})
         if entry.is_dir():
-            dir_list.extend(list_directories_full(entry.path, [], base_study_location))
+            dir_list.extend(list_directories_full(entry.path, [], base_study_location, file_index=file_index))
     return dir_list
 
 
+def get_entry_times(entry, validation_only=False):
+    if validation_only:
+        return "", ""
+    dt = time.gmtime(entry.mtime)
+    return time.strftime(file_date_format, dt), time.strftime(date_format, dt)
+
+
 def list_directories(file_location, dir_list, base_study_location, assay_file_list=None,
                      short_format=None, include_sub_dir=None, validation_only=None,
-                     static_validation_file=None, include_raw_data=None, ignore_file_list=None):
+                     static_validation_file=None, include_raw_data=None, ignore_file_list=None, file_index=None):
     static_file_found = False
     validation_files_list = os.path.join(file_location, 'validation_files.json')
     folder_exclusion_list = app.config.get('FOLDER_EXCLUSION_LIST')
@@ -1097,7 +1548,17 @@ def list_directories(file_location, dir_list, base_study_location, assay_file_li
             logger.error(str(e))
         dir_list = validation_files
     else:
-        for entry in scandir(file_location):
+        if file_index and include_sub_dir and os.path.normpath(file_location) == os.path.normpath(base_study_location):
+            # List all the sub-folders we need in parallel first, the loop below then gets them from the index
+            def include_folder(entry):
+                name = entry.path.replace(base_study_location + os.sep, '')
+                return not entry.name.startswith('.') and \
+                    is_listed_sub_dir(name, file_index.get_file_type(entry)[0], include_sub_dir=include_sub_dir,
+                                      validation_only=validation_only, include_raw_data=include_raw_data)
+            file_index.prefetch(file_location, include_folder)
+
+        entries = file_index.scan(file_location) if file_index else scan_folder(file_location)
+        for entry in entries:
             file_type = None
             ignored_file = False
 
@@ -1118,40 +1579,45 @@ def list_directories(file_location, dir_list, base_study_location, assay_file_li
                 if not include_raw_data and not name.startswith(('i_', 'a_', 's_', 'm_')):
                     continue
 
-                file_type, status, folder = map_file_type(entry.name, file_location, assay_file_list=assay_file_list)
+                if file_index:
+                    file_type, status, folder = file_index.get_file_type(entry)
+                else:
+                    file_type, status, folder = map_file_type(entry.name, file_location,
+                                                              assay_file_list=assay_file_list, is_dir=entry.is_dir())
 
                 if short_format:
                     if name not in folder_exclusion_list:
                         dir_list.append(name)
                 else:
-                    dir_list.append({"file": name, "createdAt": "", "timestamp": "", "type": file_type,
-                                     "status": status, "directory": folder})
-
-                if entry.is_dir():
-                    if not include_sub_dir:
-                        # if short_format and name in folder_exclusion_list:
-                        if validation_only and name in folder_exclusion_list:
-                            continue
-                    else:
-                        if file_type == 'audit':
-                            continue
-
-                        if validation_only and name in folder_exclusion_list:
-                            continue
-
-                        if file_type in ['raw', 'derived'] and validation_only:  # or validation only?
-                            continue
-                        else:
-                            dir_list.extend(list_directories(entry.path, [], base_study_location,
-                                                             assay_file_list=assay_file_list,
-                                                             short_format=short_format,
-                                                             include_sub_dir=include_sub_dir,
-                                                             static_validation_file=static_validation_file,
-                                                             include_raw_data=include_raw_data,
-                                                             ignore_file_list=ignore_file_list))
+                    file_time, raw_time = get_entry_times(entry, validation_only=validation_only)
+                    dir_list.append({"file": name, "createdAt": file_time, "timestamp": raw_time,
+                                     "type": file_type, "status": status, "directory": folder})
+
+                if entry.is_dir() and is_listed_sub_dir(name, file_type, include_sub_dir=include_sub_dir,
+                                                        validation_only=validation_only,
+                                                        include_raw_data=include_raw_data):
+                    dir_list.extend(list_directories(entry.path, [], base_study_location,
+                                                     assay_file_list=assay_file_list,
+                                                     short_format=short_format,
+                                                     include_sub_dir=include_sub_dir,
+                                                     static_validation_file=static_validation_file,
+                                                     include_raw_data=include_raw_data,
+                                                     ignore_file_list=ignore_file_list,
+                                                     file_index=file_index))
     return dir_list, static_file_found
 
 
+def is_listed_sub_dir(name, file_type, include_sub_dir=None, validation_only=None, include_raw_data=None):
+    # Does list_directories() also list the files in this sub-folder?
+    if not include_sub_dir or file_type == 'audit':
+        return False
+    if not include_raw_data and not name.startswith(('i_', 'a_', 's_', 'm_')):
+        return False
+    if validation_only and (name in app.config.get('FOLDER_EXCLUSION_LIST') or file_type in ('raw', 'derived')):
+        return False
+    return True
+
+
 class StudyFilesTree(Resource):
     @swagger.operation(
         summary="Get a basic list of all files, and subdirectories, in the study folder",
@@ -1184,6 +1650,31 @@ class StudyFilesTree(Resource):
                 "paramType": "query",
                 "dataType": "string",
             },
+            {
+                "name": "lazy",
+                "description": "Only list one level of the tree (the study folder or the directory). Folders include "
+                               "their number of entries (childCount) and the size of the files directly in them. "
+                               "Use files/tree/expand to list a folder when it is opened",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "type": "Boolean",
+                "defaultValue": False,
+                "default": False
+            },
+            {
+                "name": "folder_stats",
+                "description": "Add the total size, number of files and sub-folders, and latest update of everything "
+                               "under each folder (stats)",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "type": "Boolean",
+                "defaultValue": False,
+                "default": False
+            },
             {
                 "name": "user_token",
                 "description": "User API token",
@@ -1204,6 +1695,7 @@ class StudyFilesTree(Resource):
             }
         ]
     )
+    @limit_requests('file_listing')
     def get(self, study_id):
 
         # param validation
@@ -1222,15 +1714,21 @@ class StudyFilesTree(Resource):
         parser = reqparse.RequestParser()
         parser.add_argument('include_sub_dir', help='include files in all sub-directories')
         parser.add_argument('directory', help='List files in a specific sub-directory')
+        parser.add_argument('lazy', help='Only list one level of the tree')
+        parser.add_argument('folder_stats', help='Add the size and number of files under each folder')
         include_sub_dir = False
         directory = None
+        lazy = False
+        folder_stats = False
 
         if request.args:
             args = parser.parse_args(req=request)
-            include_sub_dir = False if args['include_sub_dir'].lower() != 'true' else True
+            include_sub_dir = False if (args['include_sub_dir'] or '').lower() != 'true' else True
             directory = args['directory'] if args['directory'] else None
+            lazy = (args['lazy'] or '').lower() == 'true'
+            folder_stats = (args['folder_stats'] or '').lower() == 'true'
 
-        if directory and directory.startswith(os.sep):
+        if directory and (directory.startswith(os.sep) or '..' in directory.split(os.sep)):
             abort(401, "You can only specify folders in the current study folder")
 
         # check for access rights
@@ -1242,6 +1740,16 @@ class StudyFilesTree(Resource):
         upload_location = app.config.get('MTBLS_FTP_ROOT') + study_id.lower() + "-" + obfuscation_code
         upload_location = upload_location.split('/mtblight')
 
+        if lazy:
+            try:
+                file_list = get_tree_level(study_location, directory=directory,
+                                           assay_file_list=get_assay_file_list(study_location),
+                                           folder_stats=folder_stats)
+            except FileNotFoundError:
+                abort(404, "Folder not found")
+            return jsonify({'study': file_list, 'latest': [], 'private': [], 'directory': directory,
+                            'uploadPath': upload_location[1], 'obfuscationCode': obfuscation_code})
+
         if directory:
             study_location = os.path.join(study_location, directory)
 
@@ -1255,6 +1763,366 @@ class StudyFilesTree(Resource):
 
 
 
+class StudyFilesTreeExpand(Resource):
+    @swagger.operation(
+        summary="Expand one folder of the study file tree",
+        notes="Lists the files and folders directly in the given sub-directory of the study folder. Folders include "
+              "their number of entries (childCount) and the size of the files directly in them.",
+        parameters=[
+            {
+                "name": "study_id",
+                "description": "Study Identifier",
+                "required": True,
+                "allowMultiple": False,
+                "paramType": "path",
+                "dataType": "string"
+            },
+            {
+                "name": "directory",
+                "description": "Sub-directory to expand, relative to the study folder",
+                "required": True,
+                "allowEmptyValue": False,
+                "allowMultiple": False,
+                "paramType": "query",
+                "dataType": "string",
+            },
+            {
+                "name": "folder_stats",
+                "description": "Add the total size, number of files and sub-folders, and latest update of everything "
+                               "under each folder (stats)",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "type": "Boolean",
+                "defaultValue": False,
+                "default": False
+            },
+            {
+                "name": "user_token",
+                "description": "User API token",
+                "paramType": "header",
+                "type": "string",
+                "required": True,
+                "allowMultiple": False
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK."
+            },
+            {
+                "code": 400,
+                "message": "Bad Request. No directory given."
+            },
+            {
+                "code": 404,
+                "message": "Not found. The requested identifier or directory is not valid or does not exist."
+            }
+        ]
+    )
+    @limit_requests('file_listing')
+    def get(self, study_id):
+
+        # param validation
+        if study_id is None:
+            abort(404)
+
+        study_id = study_id.upper()
+
+        # User authentication
+        user_token = None
+        if "user_token" in request.headers:
+            user_token = request.headers["user_token"]
+
+        # query validation
+        parser = reqparse.RequestParser()
+        parser.add_argument('directory', help='Sub-directory to expand')
+        parser.add_argument('folder_stats', help='Add the size and number of files under each folder')
+        directory = None
+        folder_stats = False
+
+        if request.args:
+            args = parser.parse_args(req=request)
+            directory = args['directory'].strip(os.sep) if args['directory'] else None
+            folder_stats = (args['folder_stats'] or '').lower() == 'true'
+
+        if not directory:
+            abort(400, "Please give the directory to expand")
+        if '..' in directory.split(os.sep):
+            abort(401, "You can only specify folders in the current study folder")
+
+        # check for access rights
+        is_curator, read_access, write_access, obfuscation_code, study_location, release_date, submission_date, study_status = \
+            wsc.get_permissions(study_id, user_token)
+        if not read_access:
+            abort(403)
+
+        if not os.path.isdir(os.path.join(study_location, directory)):
+            abort(404, "Folder not found")
+
+        try:
+            file_list = get_tree_level(study_location, directory=directory,
+                                       assay_file_list=get_assay_file_list(study_location),
+                                       folder_stats=folder_stats)
+        except FileNotFoundError:
+            abort(404, "Folder not found")
+
+        return jsonify({'directory': directory, 'files': file_list})
+
+
+class StudyFileChecksums(Resource):
+    @swagger.operation(
+        summary="Get the MD5 and SHA-256 checksums of the files in the study or upload folder",
+        notes="Only the checksums that were already worked out are returned, files that are new or changed since then "
+              "are listed under 'missing'. POST to work out the missing checksums.</br>"
+              "format=md5 or format=sha256 returns a text file that can be checked with md5sum -c or sha256sum -c",
+        parameters=[
+            {
+                "name": "study_id",
+                "description": "Study Identifier",
+                "required": True,
+                "allowMultiple": False,
+                "paramType": "path",
+                "dataType": "string"
+            },
+            {
+                "name": "location",
+                "description": "Folder, 'study' (default) or 'upload'",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "dataType": "string",
+                "enum": ["study", "upload"]
+            },
+            {
+                "name": "format",
+                "description": "'json' (default), 'md5' or 'sha256'",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "dataType": "string",
+                "enum": ["json", "md5", "sha256"]
+            },
+            {
+                "name": "user_token",
+                "description": "User API token",
+                "paramType": "header",
+                "type": "string",
+                "required": True,
+                "allowMultiple": False
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK."
+            },
+            {
+                "code": 400,
+                "message": "Bad Request. The location or format is not valid."
+            },
+            {
+                "code": 403,
+                "message": "Forbidden. Access to the study is not allowed. Please provide a valid user token"
+            },
+            {
+                "code": 404,
+                "message": "Not found. The requested identifier is not valid or does not exist."
+            }
+        ]
+    )
+    @limit_requests('file_listing')
+    def get(self, study_id):
+
+        # param validation
+        if study_id is None:
+            abort(404)
+
+        study_id = study_id.upper()
+
+        # User authentication
+        user_token = None
+        if "user_token" in request.headers:
+            user_token = request.headers["user_token"]
+
+        # query validation
+        parser = reqparse.RequestParser()
+        parser.add_argument('location', help='Study or upload folder')
+        parser.add_argument('format', help='json, md5 or sha256')
+        location = 'study'
+        checksum_format = 'json'
+
+        if request.args:
+            args = parser.parse_args(req=request)
+            location = args['location'].lower() if args['location'] else location
+            checksum_format = args['format'].lower() if args['format'] else checksum_format
+
+        if location not in ('study', 'upload'):
+            abort(400, "location must be 'study' or 'upload'")
+        if checksum_format not in ('json', 'md5', 'sha256'):
+            abort(400, "format must be 'json', 'md5' or 'sha256'")
+
+        # check for access rights
+        is_curator, read_access, write_access, obfuscation_code, study_location, release_date, submission_date, \
+            study_status = wsc.get_permissions(study_id, user_token)
+        if not read_access or (location == 'upload' and not write_access):  # The upload folder is private
+            abort(403)
+
+        folder = study_location
+        if location == 'upload':
+            folder = app.config.get('MTBLS_FTP_ROOT') + study_id.lower() + "-" + obfuscation_code
+
+        try:
+            with FileIndex(folder) as file_index:
+                checksums = file_index.get_checksums(folder)
+        except FileNotFoundError:
+            abort(404, "Folder not found")
+
+        if checksum_format != 'json':
+            # Same as the output of md5sum/sha256sum, run in the study folder
+            lines = [getattr(checksum, checksum_format) + '  ' + path + '\n'
+                     for path, checksum in sorted(checksums.items()) if checksum.md5]
+            return Response(''.join(lines), mimetype='text/plain',
+                            headers={'Content-Disposition': 'attachment; filename=' + study_id + '_' + location +
+                                                            '.' + checksum_format})
+
+        return jsonify({'location': location,
+                        'files': [{'file': path, 'size': checksum.size, 'md5': checksum.md5,
+                                   'sha256': checksum.sha256}
+                                  for path, checksum in sorted(checksums.items()) if checksum.md5],
+                        'missing': sorted(path for path, checksum in checksums.items() if not checksum.md5)})
+
+    @swagger.operation(
+        summary="Work out the MD5 and SHA-256 checksums of the new and changed files in the study or upload folder",
+        notes="Files that have not changed since their checksums were worked out are not read again",
+        parameters=[
+            {
+                "name": "study_id",
+                "description": "Study Identifier",
+                "required": True,
+                "allowMultiple": False,
+                "paramType": "path",
+                "dataType": "string"
+            },
+            {
+                "name": "location",
+                "description": "Folder, 'study' (default) or 'upload'",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "dataType": "string",
+                "enum": ["study", "upload"]
+            },
+            {
+                "name": "background",
+                "description": "Run as a background job (default). Returns a job id at once, "
+                               "use /studies/<study_id>/jobs/<job_id> for the progress and result",
+                "required": False,
+                "allowEmptyValue": True,
+                "allowMultiple": False,
+                "paramType": "query",
+                "type": "Boolean",
+                "defaultValue": True,
+                "default": True
+            },
+            {
+                "name": "user_token",
+                "description": "User API token",
+                "paramType": "header",
+                "type": "string",
+                "required": True,
+                "allowMultiple": False
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The checksums were worked out."
+            },
+            {
+                "code": 202,
+                "message": "Accepted. The background job was submitted, see jobId."
+            },
+            {
+                "code": 400,
+                "message": "Bad Request. The location is not valid."
+            },
+            {
+                "code": 403,
+                "message": "Forbidden. Access to the study is not allowed. Please provide a valid user token"
+            },
+            {
+                "code": 404,
+                "message": "Not found. The requested identifier is not valid or does not exist."
+            },
+            {
+                "code": 429,
+                "message": "Too Many Requests. Please wait for the number of seconds in the Retry-After header."
+            }
+        ]
+    )
+    @limit_requests('checksums')
+    def post(self, study_id):
+
+        # param validation
+        if study_id is None:
+            abort(404)
+
+        study_id = study_id.upper()
+
+        # User authentication
+        user_token = None
+        if "user_token" in request.headers:
+            user_token = request.headers["user_token"]
+
+        # query validation
+        parser = reqparse.RequestParser()
+        parser.add_argument('location', help='Study or upload folder')
+        parser.add_argument('background', help='Run as a background job')
+        location = 'study'
+        background = True
+
+        if request.args:
+            args = parser.parse_args(req=request)
+            location = args['location'].lower() if args['location'] else location
+            background = (args['background'] or '').lower() != 'false'
+
+        if location not in ('study', 'upload'):
+            abort(400, "location must be 'study' or 'upload'")
+
+        # check for access rights
+        is_curator, read_access, write_access, obfuscation_code, study_location, release_date, submission_date, \
+            study_status = wsc.get_permissions(study_id, user_token)
+        if not write_access:  # Reads all the files, only for the submitters and curators
+            abort(403)
+
+        folder = study_location
+        if location == 'upload':
+            folder = app.config.get('MTBLS_FTP_ROOT') + study_id.lower() + "-" + obfuscation_code
+        if not os.path.isdir(folder):
+            abort(404, "Folder not found")
+
+        if background:
+            return get_job_response(job_runner.submit('checksums', study_id, update_checksums, folder))
+        return update_checksums(folder)
+
+
+def update_checksums(folder, progress=None):
+    """
+    Work out the checksums of the new and changed files in a study or upload folder, see FileIndex.get_checksums()
+    :param progress: JobProgress when running as a background job
+    """
+    with FileIndex(folder) as file_index:
+        checksums = file_index.get_checksums(folder, update=True, progress=progress)
+    missing = sorted(path for path, checksum in checksums.items() if not checksum.md5)
+    return {'Success': 'Checksums of ' + str(len(checksums) - len(missing)) + ' files', 'missing': missing}
+
+
 class FileList(Resource):
     @swagger.operation(
         summary="Get a listof all files and directories  for the given location",
@@ -1295,6 +2163,7 @@ class FileList(Resource):
             }
         ]
     )
+    @limit_requests('file_listing')
     def get(self, study_id):
 
         # param validation
@@ -1327,14 +2196,16 @@ class FileList(Resource):
         source = study_location + "/" + directory_name
         files_list = []
         dir_list = []
-        for root, dirs, files in os.walk(source):
-            for filename in files:
-                file = {'file': filename, 'path': os.path.join(source, filename)}
-                files_list.append(file)
-            for dirname in dirs:
-                dir = {'directory': dirname, 'path': os.path.join(source, dirname)}
-                dir_list.append(dir)
-            break
+        try:
+            with FileIndex(study_location) as file_index:
+                entries = file_index.scan(source)
+        except (FileNotFoundError, NotADirectoryError):
+            entries = []  # Same as os.walk, an empty list for a folder that does not exist
+        for entry in entries:
+            if entry.is_dir():
+                dir_list.append({'directory': entry.name, 'path': os.path.join(source, entry.name)})
+            else:
+                files_list.append({'file': entry.name, 'path': os.path.join(source, entry.name)})
 
         return jsonify({'files': files_list,
                         'directories': dir_list})
\ No newline at end of file
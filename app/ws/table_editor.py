@@ -19,6 +19,7 @@
 import json
 import logging
 import os
+import re
 
 import numpy as np
 import pandas as pd
@@ -28,7 +29,8 @@ from flask_restful_swagger import swagger
 
 from app.ws.mtblsStudy import write_audit_files
 from app.ws.mtblsWSclient import WsClient
-from app.ws.utils import get_table_header, totuples, validate_row, log_request, read_tsv, write_tsv
+from app.ws.utils import get_table_header, totuples, validate_row, log_request, read_tsv, write_tsv, \
+    read_tsv_cached, check_if_match, etag_header, is_not_modified, not_modified
 
 """
 MTBLS Table Columns manipulator
@@ -46,6 +48,141 @@ def insert_row(idx, df, df_insert):
     return df.iloc[:idx, ].append(df_insert, ignore_index=True).append(df.iloc[idx:, ]).reset_index(drop=True)
 
 
+def filter_table(table_df, column_filters=None, search=None, sort=None):
+    """
+    Filter, search and sort a TSV table. The original row numbers are kept in the DataFrame index,
+    so the rows returned can still be used for row/cell updates
+    :param table_df: the table to filter, this is not modified
+    :param column_filters: list of "column:operator:value" strings, operator is one of equals, contains or regex
+    :param search: free text to look for (case insensitive) in all columns
+    :param sort: comma separated list of column names, prefix a column with '-' for descending order
+    :return: the filtered and sorted DataFrame
+    """
+    mask = pd.Series(True, index=table_df.index)
+
+    for column_filter in column_filters or []:
+        try:
+            column, operator, value = column_filter.split(':', 2)  # The value may contain ':', ie. CHEBI:15377
+        except ValueError:
+            abort(400, "Incorrect filter '" + column_filter + "'. Please use 'column:operator:value'")
+
+        if column not in table_df.columns:
+            abort(400, "'" + column + "' is not a valid column name")
+        values = table_df[column].astype(str)
+
+        if operator == 'equals':
+            mask &= values == value
+        elif operator == 'contains':
+            mask &= values.str.contains(value, case=False, regex=False)
+        elif operator == 'regex':
+            try:
+                mask &= values.str.contains(value, regex=True)
+            except re.error as e:
+                abort(400, "Incorrect regular expression '" + value + "'. " + str(e))
+        else:
+            abort(400, "Incorrect filter operator '" + operator + "'. Please use one of equals, contains or regex")
+
+    if search:
+        search_mask = pd.Series(False, index=table_df.index)
+        for column in table_df.columns:
+            search_mask |= table_df[column].astype(str).str.contains(search, case=False, regex=False)
+        mask &= search_mask
+
+    result_df = table_df[mask]
+
+    if sort:
+        sort_columns = []
+        ascending = []
+        for column in sort.split(','):
+            column = column.strip()
+            descending = column.startswith('-')
+            column = column.lstrip('-')
+            if column not in table_df.columns:
+                abort(400, "Can not sort on '" + column + "', it is not a valid column name")
+            sort_columns.append(column)
+            ascending.append(not descending)
+        # Stable sort, so rows with the same value keep their order in the file
+        result_df = result_df.sort_values(by=sort_columns, ascending=ascending, kind='mergesort')
+
+    return result_df
+
+
+def insert_columns(table_df, new_columns, update_existing=False):
+    """
+    Add (or update) several columns in one go. The result is the same as inserting the columns one by one,
+    in the order given, but the new table is only built once instead of re-allocating it for every column
+    :param table_df: the table to add the columns to, this is not modified
+    :param new_columns: list of dicts with the column 'name', 'index' (position) and default 'value'
+    :param update_existing: if the column in the given position has the same name, set its rows to the value
+    instead of inserting a new column. Otherwise columns with the same name are added next to each other
+    :return: a new DataFrame with all the columns added
+    """
+    # Work out the final column order first, each slot is either an existing column # or a new column value
+    names = list(table_df.columns)
+    slots = list(range(len(names)))
+    for column in new_columns:
+        try:
+            position = int(column['index'])
+            name = column['name']
+            value = column['value']
+        except (KeyError, TypeError, ValueError):
+            abort(400, "Please provide a 'name', 'index' and 'value' for each new column")
+
+        if update_existing and -len(names) <= position < len(names) and names[position] == name:
+            slots[position] = [value]  # We already have the column in this position, so update the rows
+        elif 0 <= position <= len(names):
+            names.insert(position, name)
+            slots.insert(position, [value])
+        else:
+            abort(400, "Column position " + str(position) + " is not valid for column '" + str(name) + "'")
+
+    row_count = table_df.shape[0]
+    columns = {}
+    for idx, slot in enumerate(slots):
+        if isinstance(slot, list):
+            columns[idx] = np.full(row_count, slot[0], dtype=object)  # Same default value for all rows
+        else:
+            columns[idx] = table_df.iloc[:, slot].values
+    result_df = pd.DataFrame(columns, index=table_df.index, columns=range(len(slots)))
+    result_df.columns = names  # Column names can be duplicated, ie. 'Protocol REF'
+    return result_df
+
+
+def rename_columns(table_df, renamed_columns):
+    """
+    Rename several columns in one go
+    :param table_df: the table to rename the columns in, this is not modified
+    :param renamed_columns: list of dicts with the column 'index' (position) and the new 'name'
+    :return: a new DataFrame with the columns renamed
+    """
+    names = list(table_df.columns)
+    for column in renamed_columns:
+        try:
+            position = int(column['index'])
+            name = column['name']
+        except (KeyError, TypeError, ValueError):
+            abort(400, "Please provide the 'index' and new 'name' for each column to rename")
+        if not 0 <= position < len(names):
+            abort(400, "Column position " + str(position) + " is not valid for column '" + str(name) + "'")
+        names[position] = name
+
+    result_df = table_df.copy(deep=False)
+    result_df.columns = names
+    return result_df
+
+
+def delete_columns(table_df, columns):
+    """
+    Remove several columns in one go
+    :param table_df: the table to remove the columns from, this is not modified
+    :param columns: list of column names to remove
+    :return: a new DataFrame without the columns, and the list of column names that were not found
+    """
+    not_found = [column for column in columns if column not in table_df.columns]
+    found = [column for column in columns if column in table_df.columns]
+    return table_df.drop(found, axis=1), not_found
+
+
 class SimpleColumns(Resource):
     @swagger.operation(
         summary="Add a new column to the given TSV file",
@@ -161,6 +298,7 @@ class SimpleColumns(Resource):
             abort(403)
 
         file_name = os.path.join(study_location, file_name)
+        check_if_match(file_name)
         try:
             table_df = read_tsv(file_name)
         except FileNotFoundError:
@@ -168,13 +306,9 @@ class SimpleColumns(Resource):
 
         audit_status, dest_path = write_audit_files(study_location)
 
-        #  Need to add values for each existing row (not header)
-        new_col = []
-        for row_val in range(table_df.shape[0]):
-            new_col.append(new_column_default_value)
-
-        # Add new column to the spreadsheet
-        table_df.insert(loc=int(new_column_position), column=new_column_name, value=new_col, allow_duplicates=True)
+        # Add new column to the spreadsheet, with the default value for each existing row (not header)
+        table_df = insert_columns(table_df, [{'name': new_column_name, 'index': new_column_position,
+                                              'value': new_column_default_value}])
 
         df_data_dict = totuples(table_df.reset_index(), 'rows')
 
@@ -183,7 +317,7 @@ class SimpleColumns(Resource):
 
         message = write_tsv(table_df, file_name)
 
-        return {'header': df_header, 'data': df_data_dict, 'message': message}
+        return {'header': df_header, 'data': df_data_dict, 'message': message}, 200, etag_header(file_name)
 
 
 class ComplexColumns(Resource):
@@ -280,6 +414,7 @@ class ComplexColumns(Resource):
             abort(403)
 
         file_name = os.path.join(study_location, file_name)
+        check_if_match(file_name)
         try:
             table_df = read_tsv(file_name)
         except FileNotFoundError:
@@ -287,31 +422,136 @@ class ComplexColumns(Resource):
 
         audit_status, dest_path = write_audit_files(study_location)
 
-        # Get an indexed header row
+        # Add all new columns, or update the existing column if it is already in the given position
+        table_df = insert_columns(table_df, new_columns, update_existing=True)
+
+        # Get an (updated) indexed header row
         df_header = get_table_header(table_df)
 
-        for column in new_columns:
-            new_column_default_value = column['value']
-            new_column_name = column['name']
-            new_column_position = column['index']
+        # Get all indexed rows
+        df_data_dict = totuples(table_df.reset_index(), 'rows')
 
-            #  Need to add values for each existing row (not header)
-            new_col = []
-            for row_val in range(table_df.shape[0]):
-                new_col.append(new_column_default_value)
+        message = write_tsv(table_df, file_name)
 
-            # Check if we already have the column in the current position
-            try:
-                header_name = table_df.iloc[:, new_column_position].name
-            except:
-                header_name = ""
+        return {'header': df_header, 'rows': df_data_dict, 'message': message}, 200, etag_header(file_name)
 
-            if header_name == new_column_name:  # We should update the existing column
-                table_df.iloc[:, new_column_position] = new_col
-            else:
-                # Add new column to the spreadsheet
-                table_df.insert(loc=int(new_column_position), column=new_column_name,
-                                value=new_col, allow_duplicates=True)
+    @swagger.operation(
+        summary="Rename columns in a tsv file",
+        nickname="Rename columns in a tsv file",
+        notes='''Rename given columns in a sample, assay or MAF sheet (tsv files). 
+        Only '.tsv', '.csv' or '.txt' files are allowed. The columns are given by position, as column names can be 
+        duplicated in ISA-Tab files.
+<pre><code> 
+{  
+  "data": { 
+    "columns": [
+        { "index": 2, "name": "new column name 1" },
+        { "index": 5, "name": "new column name 2" }
+    ]
+  }
+}
+</code></pre>''',
+        parameters=[
+            {
+                "name": "study_id",
+                "description": "MTBLS Identifier",
+                "required": True,
+                "allowMultiple": False,
+                "paramType": "path",
+                "dataType": "string"
+            },
+            {
+                "name": "file_name",
+                "description": "the CSV or TSV file name",
+                "required": True,
+                "allowMultiple": False,
+                "paramType": "path",
+                "dataType": "string"
+            },
+            {
+                "name": "columns",
+                "description": "The columns to rename",
+                "paramType": "body",
+                "type": "string",
+                "format": "application/json",
+                "required": True,
+                "allowMultiple": False
+            },
+            {
+                "name": "user_token",
+                "description": "User API token",
+                "paramType": "header",
+                "type": "string",
+                "required": True,
+                "allowMultiple": False
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The table has been updated."
+            },
+            {
+                "code": 400,
+                "message": "Bad Request. The column position is not valid."
+            },
+            {
+                "code": 401,
+                "message": "Unauthorized. Access to the resource requires user authentication."
+            },
+            {
+                "code": 403,
+                "message": "Forbidden. Access to the study is not allowed for this user."
+            },
+            {
+                "code": 404,
+                "message": "Not found. The requested identifier is not valid or does not exist."
+            },
+            {
+                "code": 417,
+                "message": "Incorrect parameters provided"
+            }
+        ]
+    )
+    def put(self, study_id, file_name):
+
+        # param validation
+        if study_id is None or file_name is None:
+            abort(417, "Please provide a study id and TSV file name")
+        study_id = study_id.upper()
+
+        fname, ext = os.path.splitext(file_name)
+        ext = ext.lower()
+        if ext not in ('.tsv', '.csv', '.txt'):
+            abort(400, "The file " + file_name + " is not a valid TSV or CSV file")
+
+        try:
+            data_dict = json.loads(request.data.decode('utf-8'))
+            columns = data_dict['data']['columns']
+        except Exception as e:
+            abort(417, 'Please ensure the JSON contains a "data" element with a "columns" list. ' + str(e))
+
+        # User authentication
+        user_token = None
+        if "user_token" in request.headers:
+            user_token = request.headers["user_token"]
+
+        # check for access rights
+        is_curator, read_access, write_access, obfuscation_code, study_location, release_date, submission_date, \
+        study_status = wsc.get_permissions(study_id, user_token)
+        if not write_access:
+            abort(403)
+
+        file_name = os.path.join(study_location, file_name)
+        check_if_match(file_name)
+        try:
+            table_df = read_tsv(file_name)
+        except FileNotFoundError:
+            abort(400, "The file " + file_name + " was not found")
+
+        table_df = rename_columns(table_df, columns)
+
+        audit_status, dest_path = write_audit_files(study_location)
 
         # Get an (updated) indexed header row
         df_header = get_table_header(table_df)
@@ -321,7 +561,7 @@ class ComplexColumns(Resource):
 
         message = write_tsv(table_df, file_name)
 
-        return {'header': df_header, 'rows': df_data_dict, 'message': message}
+        return {'header': df_header, 'rows': df_data_dict, 'message': message}, 200, etag_header(file_name)
 
     @swagger.operation(
         summary="Delete columns from a tsv file",
@@ -429,22 +669,23 @@ class ComplexColumns(Resource):
         if not write_access:
             abort(403)
 
+        check_if_match(os.path.join(study_location, file_name))
+
+        tsv_file = os.path.join(study_location, file_name)
+        if not os.path.isfile(tsv_file):
+            abort(406, "File " + file_name + " does not exist")
+
         audit_status, dest_path = write_audit_files(study_location)
 
-        for column in columns:
-            tsv_file = os.path.join(study_location, file_name)
-            if not os.path.isfile(tsv_file):
-                abort(406, "File " + file_name + " does not exist")
-            else:
-                file_df = read_tsv(tsv_file)
-                try:
-                    file_df.drop(column, axis=1, inplace=True)
-                    write_tsv(file_df, tsv_file)
-                except Exception as e:
-                    logger.error("Could not remove column '" + column + "' from file " + file_name)
-                    logger.error(str(e))
+        # Read and write the file once, however many columns we remove
+        file_df, not_found = delete_columns(read_tsv(tsv_file), columns)
+        for column in not_found:
+            logger.error("Could not remove column '" + column + "' from file " + file_name)
+        if len(not_found) < len(columns):
+            write_tsv(file_df, tsv_file)
 
-        return {"Success": "Removed column(s) from " + file_name}
+        return {"Success": "Removed column(s) from " + file_name}, 200, \
+            etag_header(os.path.join(study_location, file_name))
 
 
 class ColumnsRows(Resource):
@@ -544,6 +785,7 @@ class ColumnsRows(Resource):
             abort(403)
 
         file_name = os.path.join(study_location, file_name)
+        check_if_match(file_name)
         try:
             table_df = read_tsv(file_name)
         except FileNotFoundError:
@@ -576,7 +818,7 @@ class ColumnsRows(Resource):
         # Get an indexed header row
         df_header = get_table_header(table_df)
 
-        return {'header': df_header, 'rows': df_data_dict, 'message': message}
+        return {'header': df_header, 'rows': df_data_dict, 'message': message}, 200, etag_header(file_name)
 
 
 class AddRows(Resource):
@@ -704,6 +946,7 @@ class AddRows(Resource):
         else:
             file_name = os.path.join(study_location, file_name)
 
+        check_if_match(file_name)
         try:
             file_df = read_tsv(file_name)
         except FileNotFoundError:
@@ -752,7 +995,7 @@ class AddRows(Resource):
         except FileNotFoundError:
             abort(400, "The file " + file_name + " was not found")
 
-        return {'header': df_header, 'data': df_data_dict, 'message': message}
+        return {'header': df_header, 'data': df_data_dict, 'message': message}, 200, etag_header(file_name)
 
     @swagger.operation(
         summary="Update existing rows in the given TSV file",
@@ -875,6 +1118,7 @@ class AddRows(Resource):
             abort(403)
 
         file_name = os.path.join(study_location, file_name)
+        check_if_match(file_name)
 
         try:
             file_df = read_tsv(file_name)
@@ -905,7 +1149,7 @@ class AddRows(Resource):
         # Get an indexed header row
         df_header = get_table_header(file_df)
 
-        return {'header': df_header, 'data': df_data_dict, 'message': message}
+        return {'header': df_header, 'data': df_data_dict, 'message': message}, 200, etag_header(file_name)
 
     @swagger.operation(
         summary="Delete a row of the given TSV file",
@@ -994,6 +1238,7 @@ class AddRows(Resource):
             abort(403)
 
         file_name = os.path.join(study_location, file_name)
+        check_if_match(file_name)
         try:
             file_df = read_tsv(file_name)
         except FileNotFoundError:
@@ -1020,14 +1265,22 @@ class AddRows(Resource):
         # Get an indexed header row
         df_header = get_table_header(file_df)
 
-        return {'header': df_header, 'data': df_data_dict, 'message': message}
+        return {'header': df_header, 'data': df_data_dict, 'message': message}, 200, etag_header(file_name)
 
 
 class GetTsvFile(Resource):
     @swagger.operation(
         summary="Get TSV table for a study using filename",
         nickname="Get TSV table for a given study",
-        notes="Get a given TSV table for a MTBLS Study with in JSON format. Only '.tsv', '.csv' or '.txt' files are allowed",
+        notes="""Get a given TSV table for a MTBLS Study with in JSON format. Only '.tsv', '.csv' or '.txt' files are allowed.
+        </p>Rows can be filtered, searched, sorted and paged on the server. Each row returned keeps its "index",
+        the row number in the file, so it can be used when updating rows or cells.
+        </p>Filters are given as <b>column:operator:value</b>, where operator is one of 'equals', 'contains' or 'regex',
+        ie. <code>database_identifier:equals:CHEBI:15377</code>. Sort on one or more comma separated columns, 
+        prefix the column name with '-' for descending order.
+        </p>The response has an ETag header with the current version of the file. Send it back as 'If-None-Match' to
+        skip reloading an unchanged file (304), and as 'If-Match' when updating the file to avoid overwriting 
+        changes made by someone else (412)""",
         parameters=[
             {
                 "name": "study_id",
@@ -1045,6 +1298,46 @@ class GetTsvFile(Resource):
                 "paramType": "path",
                 "dataType": "string"
             },
+            {
+                "name": "filter",
+                "description": "Column filter, column:operator:value",
+                "required": False,
+                "allowMultiple": True,
+                "paramType": "query",
+                "dataType": "string"
+            },
+            {
+                "name": "search",
+                "description": "Text to search for in all columns",
+                "required": False,
+                "allowMultiple": False,
+                "paramType": "query",
+                "dataType": "string"
+            },
+            {
+                "name": "sort",
+                "description": "Comma separated column names to sort on, use '-column name' for descending order",
+                "required": False,
+                "allowMultiple": False,
+                "paramType": "query",
+                "dataType": "string"
+            },
+            {
+                "name": "offset",
+                "description": "Number of matching rows to skip",
+                "required": False,
+                "allowMultiple": False,
+                "paramType": "query",
+                "dataType": "integer"
+            },
+            {
+                "name": "limit",
+                "description": "Maximum number of rows to return",
+                "required": False,
+                "allowMultiple": False,
+                "paramType": "query",
+                "dataType": "integer"
+            },
             {
                 "name": "user_token",
                 "description": "User API token",
@@ -1059,6 +1352,10 @@ class GetTsvFile(Resource):
                 "code": 200,
                 "message": "OK. The TSV table is returned"
             },
+            {
+                "code": 400,
+                "message": "Incorrect filter, sort or paging parameters."
+            },
             {
                 "code": 401,
                 "message": "Unauthorized. Access to the resource requires user authentication."
@@ -1087,6 +1384,24 @@ class GetTsvFile(Resource):
         study_id = study_id.upper()
         file_name_param = file_name  # store the passed filename for simplicity
 
+        # query validation
+        parser = reqparse.RequestParser()
+        parser.add_argument('filter', help="Column filter, column:operator:value", action='append', location="args")
+        parser.add_argument('search', help="Text to search for in all columns", location="args")
+        parser.add_argument('sort', help="Column(s) to sort on", location="args")
+        parser.add_argument('offset', help="Number of matching rows to skip", type=int, location="args")
+        parser.add_argument('limit', help="Maximum number of rows to return", type=int, location="args")
+        args = parser.parse_args(req=request)
+        column_filters = args['filter']
+        search = args['search']
+        sort = args['sort']
+        offset = args['offset'] if args['offset'] else 0
+        limit = args['limit']
+
+        page_size = app.config.get('TSV_PAGE_SIZE')
+        if offset < 0 or (limit is not None and (limit < 1 or limit > page_size)):
+            abort(400, "Please provide an offset >= 0 and a limit between 1 and " + str(page_size))
+
         # User authentication
         user_token = None
         if "user_token" in request.headers:
@@ -1106,16 +1421,25 @@ class GetTsvFile(Resource):
         else:
             file_name = os.path.join(study_location, file_name)
 
+        if is_not_modified(file_name):
+            return not_modified(file_name)
+
         logger.info('Trying to load TSV file (%s) for Study %s', file_name, study_id)
         # Get the Assay table or create a new one if it does not already exist
         try:
-            file_df = read_tsv(file_name)
+            file_df = read_tsv_cached(file_name)
         except FileNotFoundError:
             abort(400, "The file " + file_name + " was not found")
 
-        df_data_dict = totuples(file_df.reset_index(), 'rows')
+        result_df = filter_table(file_df, column_filters=column_filters, search=search, sort=sort)
+        matched_rows = len(result_df.index)
+        if offset or limit:
+            result_df = result_df.iloc[offset:offset + limit if limit else None]
+
+        df_data_dict = totuples(result_df.reset_index(), 'rows')
 
         # Get an indexed header row
         df_header = get_table_header(file_df, study_id, file_name_param)
 
-        return {'header': df_header, 'data': df_data_dict}
+        return {'header': df_header, 'data': df_data_dict,
+                'totalRows': len(file_df.index), 'matchedRows': matched_rows}, 200, etag_header(file_name)
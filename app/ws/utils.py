@@ -19,6 +19,7 @@
 import base64
 import datetime
 import glob
+import hashlib
 import io
 import json
 import logging
@@ -32,6 +33,8 @@ import string
 import time
 import urllib
 import uuid
+from collections import OrderedDict
+from functools import lru_cache
 from os.path import normpath, basename
 
 import numpy as np
@@ -39,14 +42,15 @@ import pandas as pd
 import psycopg2
 import requests
 from flask import current_app as app
-from flask import request, abort
+from flask import request, abort, make_response, after_this_request, g, has_app_context
 from flask_restful import abort
 from isatools.model import Protocol, ProtocolParameter, OntologySource
 from lxml import etree
 from mzml2isa.parsing import convert as isa_convert
 from pandas import Series
 from psycopg2 import pool
-from dirsync import sync
+from werkzeug.http import quote_etag
+from app.ws.file_copy import copy_folder, get_copy_plan, get_thread_lock
 from app.ws.mm_models import OntologyAnnotation
 
 """
@@ -123,18 +127,28 @@ def copy_file(source, destination):
         raise
 
 
-def copytree(src, dst, symlinks=False, ignore=None, include_raw_data=False, include_investigation_file=True):
+def copytree(src, dst, symlinks=False, ignore=None, include_raw_data=False, include_investigation_file=True,
+             progress=None, dry_run=False):
+    """
+    Copy the new and updated files from the upload folder to the study folder. The raw data is copied by the copy
+    engine, see copy_folder(), both folders are listed with their file index
+    :param progress: function that is given the CopyStats after every raw data file
+    :param dry_run: do not copy anything, return the files that would be copied (see get_copy_plan())
+    :return: CopyStats of the raw data copied, None if only metadata files were copied. The plan for a dry run
+    """
+    aspera_extensions = ('.partial', '.aspera-ckpt', '.aspx')
+    metadata_files = []
     try:
-        if not os.path.exists(dst):
+        if not os.path.exists(dst) and not dry_run:
             logger.info('Creating a new folder for the study, %s', dst)
             os.makedirs(dst, exist_ok=True)
 
-        file_list = {}
+        raw_items = set()
         for item in os.listdir(src):
             source = os.path.join(src, item)
             destination = os.path.join(dst, item)
 
-            if item.endswith('.partial') or item.endswith('.aspera-ckpt') or item.endswith('.aspx'):
+            if item.endswith(aspera_extensions):
                 logger.info('Do NOT copy any aspera files')
                 continue
 
@@ -154,54 +168,43 @@ def copytree(src, dst, symlinks=False, ignore=None, include_raw_data=False, incl
                     logger.error('Error copying metadata file %s to %s. Error %s', source, destination, str(e))
 
                 if diff > 0:
-                    logger.info('Will copy files')
-                    copy_file(source, destination)
-            else:
-                if include_raw_data:
-                        if os.path.isdir(source):
-                            logger.info(source + ' is a directory')
-                            try:
-                                if os.path.isdir(destination):
-                                    sync(source, destination, 'sync', purge=False,logger=logger)
-                                else:
-                                    shutil.copytree(source, destination, symlinks=symlinks, ignore=ignore)
-                                logger.info('Copied file %s to %s', source, destination)
-                            except OSError as e:
-                                logger.error('Does the folder already exists? Can not copy %s to %s', source,
-                                             destination, str(e))
-                            except FileExistsError as e:
-                                logger.error('Folder already exists! Can not copy %s to %s', source, destination,
-                                             str(e))
-                            except Exception as e:
-                                logger.error('Other error! Can not copy %s to %s', source, destination,
-                                             str(e))
-                        else:  # elif not os.path.exists(destination):
-                            logger.info(source + ' is not a directory')
-                            try:
-                                if os.path.isfile(destination):
-                                    sync(source, destination, 'sync', purge=False,logger=logger)
-                                else:
-                                    shutil.copy2(source, destination)  # Should retain all file metadata, ie. timestamps
-                                logger.info('Copied file %s to %s', source, destination)
-                            except OSError as e:
-                                logger.error('Does the file already exists? Can not copy %s to %s', source, destination,
-                                             str(e))
-                            except FileExistsError as e:
-                                logger.error('File already exists! Can not copy %s to %s', source, destination, str(e))
-                            except Exception as e:
-                                logger.error('Other error! Can not copy %s to %s', source, destination, str(e))
+                    metadata_files.append(item)
+                    if not dry_run:
+                        logger.info('Will copy files')
+                        copy_file(source, destination)
+            elif include_raw_data:
+                raw_items.add(item)
+
+        def include_raw_item(relative_path, entry):
+            return relative_path.split(os.sep)[0] in raw_items and not entry.name.endswith(aspera_extensions)
+
+        if dry_run:
+            plan = get_copy_plan(src, dst, include=include_raw_item, source_location=src, destination_location=dst) \
+                if raw_items else {'copy': [], 'remove': [], 'folders': [], 'skipped': 0, 'bytes': 0}
+            plan['copy'] = sorted(metadata_files) + plan['copy']
+            return plan
+
+        if raw_items:
+            stats = copy_folder(src, dst, include=include_raw_item, progress=progress, source_location=src,
+                                destination_location=dst)
+            for error in stats.errors:
+                logger.error('Can not copy ' + error)
+            return stats
+        return None
     except Exception as e:
         logger.error(str(e))
         raise
 
 
-def copy_files_and_folders(source, destination, include_raw_data=True, include_investigation_file=True):
+def copy_files_and_folders(source, destination, include_raw_data=True, include_investigation_file=True,
+                           progress=None):
     """
       Make a copy of files/folders from origin to destination. If destination already exists, it will be replaced.
       :param source:  string containing the full path to the source file, including filename
       :param destination: string containing the path to the source file, including filename
       :param include_raw_data: Copy all files or metadata only, Boolean (default True)
       :param include_investigation_file: Copy the i_Investigation.txt file, Boolean (default True)
+      :param progress: function that is given the CopyStats after every raw data file, see copy_folder()
       :return:
       """
 
@@ -211,8 +214,8 @@ def copy_files_and_folders(source, destination, include_raw_data=True, include_i
     try:
         # copy origin to destination
         logger.info("Copying %s to %s", source, destination)
-        copytree(source, destination, include_raw_data=include_raw_data,
-                 include_investigation_file=include_investigation_file)
+        stats = copytree(source, destination, include_raw_data=include_raw_data,
+                         include_investigation_file=include_investigation_file, progress=progress)
     except FileNotFoundError:
         return False, 'No files found under ' + source
     except IsADirectoryError:
@@ -220,7 +223,10 @@ def copy_files_and_folders(source, destination, include_raw_data=True, include_i
     except Exception:
         return False, 'Could not copy files from ' + source
 
-    return True, 'Files successfully copied from ' + source + ' to ' + destination
+    message = 'Files successfully copied from ' + source + ' to ' + destination
+    if stats:
+        message = message + '. ' + str(stats)
+    return True, message
 
 
 def remove_samples_from_isatab(std_path):
@@ -265,45 +271,89 @@ def get_single_file_information(file_name):
     return file_time
 
 
-def get_assay_headers_and_protcols(assay_type):
-    tidy_header_row = ""
-    tidy_data_row = ""
-    protocols = ""
-    assay_desc = ""
-    assay_data_type = ""
-    assay_file_type = ""
-    assay_mandatory_type = ""
+# MetaboLightsAssayMaster.tsv parsed once, keyed on assay type. See load_assay_templates()
+assay_templates = None
+# MAF templates, keyed on template file name. Each entry is a DataFrame that must not be edited
+maf_templates = {}
 
-    if assay_type is None or assay_type == 'a':
-        logger.error('Assay Type is empty or incorrect!')
-        return tidy_header_row, tidy_data_row, protocols, assay_desc, assay_data_type, \
-               assay_file_type, assay_mandatory_type
+empty_assay_template = ((), (), (), "", (), (), ())
 
-    resource_folder = os.path.join(".", "resources")
-    logger.info(' - get_assay_headers_and_protcols for assay type ' + assay_type)
+
+def load_assay_templates(resource_folder=None):
+    """
+    Parse the assay master template once and index all the template rows per assay type.
+    Called at startup, and on first use if the application was started some other way
+    :param resource_folder: folder with MetaboLightsAssayMaster.tsv, defaults to ./resources
+    :return: dict of assay type -> (header row, data row, protocols, description, data types, file types, mandatory)
+    """
+    global assay_templates
+    if resource_folder is None:
+        resource_folder = os.path.join(".", "resources")
     assay_master_template = os.path.join(resource_folder, 'MetaboLightsAssayMaster.tsv')
     master_df = read_tsv(assay_master_template)
 
-    header_row = master_df.loc[master_df['name'] == assay_type + '-header']
-    data_row = master_df.loc[master_df['name'] == assay_type + '-data']
-    protocol_row = master_df.loc[master_df['name'] == assay_type + '-protocol']
-    assay_desc_row = master_df.loc[master_df['name'] == assay_type + '-assay']
-    assay_data_type_row = master_df.loc[master_df['name'] == assay_type + '-type']
-    assay_file_type_row = master_df.loc[master_df['name'] == assay_type + '-file']
-    assay_data_mandatory_row = master_df.loc[master_df['name'] == assay_type + '-mandatory']
+    # Index every labelled row once, instead of scanning the whole template for each assay type/row type
+    template_rows = {}
+    if 'name' in master_df.columns:
+        for idx, row_name in enumerate(master_df['name']):
+            if row_name not in template_rows:
+                template_rows[row_name] = master_df.iloc[[idx]]
 
-    try:
-        protocols = get_protocols_for_assay(protocol_row, assay_type)
-        assay_desc = get_desc_for_assay(assay_desc_row, assay_type)
-        assay_data_type = get_data_type_for_assay(assay_data_type_row, assay_type)
-        assay_file_type = get_file_type_for_assay(assay_file_type_row, assay_type)
-        assay_mandatory_type = get_mandatory_data_for_assay(assay_data_mandatory_row, assay_type)
-        tidy_header_row = tidy_template_row(header_row)  # Remove empty cells after end of column definition
-        tidy_data_row = tidy_template_row(data_row)
-    except:
+    templates = {}
+    for row_name in template_rows:
+        if not row_name.endswith('-header'):
+            continue
+        assay_type = row_name[:-len('-header')]
+        try:
+            protocols = get_protocols_for_assay(template_rows[assay_type + '-protocol'], assay_type)
+            templates[assay_type] = (
+                tuple(tidy_template_row(template_rows[assay_type + '-header'])),
+                tuple(tidy_template_row(template_rows[assay_type + '-data'])),
+                tuple(tuple(protocol) for protocol in protocols),
+                get_desc_for_assay(template_rows[assay_type + '-assay'], assay_type),
+                tuple(get_data_type_for_assay(template_rows[assay_type + '-type'], assay_type)),
+                tuple(get_file_type_for_assay(template_rows[assay_type + '-file'], assay_type)),
+                tuple(get_mandatory_data_for_assay(template_rows[assay_type + '-mandatory'], assay_type)))
+        except:
+            logger.error('Could not retrieve all required template info for this assay type: ' + assay_type)
+
+    logger.info('Loaded ' + str(len(templates)) + ' assay templates from ' + assay_master_template)
+    assay_templates = templates
+    return templates
+
+
+def get_assay_headers_and_protcols(assay_type):
+    if assay_type is None or assay_type == 'a':
+        logger.error('Assay Type is empty or incorrect!')
+        return "", "", "", "", "", "", ""
+
+    templates = assay_templates
+    if templates is None:
+        templates = load_assay_templates()
+
+    template = templates.get(assay_type)
+    if template is None:
         logger.error('Could not retrieve all required template info for this assay type: ' + assay_type)
+        template = empty_assay_template
 
-    return tidy_header_row, tidy_data_row, protocols, assay_desc, assay_data_type, assay_file_type, assay_mandatory_type
+    # Return copies, so callers can not change the shared template
+    tidy_header_row, tidy_data_row, protocols, assay_desc, assay_data_type, assay_file_type, \
+        assay_mandatory_type = template
+    return list(tidy_header_row), list(tidy_data_row), [list(protocol) for protocol in protocols], assay_desc, \
+        list(assay_data_type), list(assay_file_type), list(assay_mandatory_type)
+
+
+def get_maf_template(annotation_file_template):
+    """
+    Read a MAF template from the resources folder, only parsing each template once
+    :param annotation_file_template: full path to the MAF template
+    :return: a copy of the template DataFrame
+    """
+    maf_df = maf_templates.get(annotation_file_template)
+    if maf_df is None:
+        maf_df = pd.read_csv(annotation_file_template, sep="\t", header=0, encoding='utf-8')
+        maf_templates[annotation_file_template] = maf_df
+    return maf_df.copy()
 
 
 def get_table_header(table_df, study_id=None, file_name=None):
@@ -435,6 +485,143 @@ def read_tsv(file_name):
     return table_df
 
 
+# Parsed TSV files, keyed on file name. Each entry is (file version, DataFrame)
+tsv_cache = OrderedDict()
+# The caches below are also used from the threads listing the upload folder, see get_all_files_from_filesystem()
+cache_lock = get_thread_lock()
+
+
+def get_cached_value(cache, key, version):
+    # The cached value if it is for this version of the file(s), else None
+    with cache_lock:
+        cached = cache.get(key)
+        if cached and cached[0] == version:
+            cache.move_to_end(key)
+            return cached[1]
+    return None
+
+
+def add_cached_value(cache, key, version, value, cache_size):
+    # Keep the value, and remove the least recently used ones over the cache size
+    with cache_lock:
+        cache[key] = (version, value)
+        cache.move_to_end(key)
+        while len(cache) > cache_size:
+            cache.popitem(last=False)
+
+
+def get_file_version(file_name):
+    """
+    Get a cheap version signature for a file, changes whenever the file is re-written
+    :param file_name: full path to the file
+    :return: tuple of (mtime in nanoseconds, size in bytes)
+    """
+    stat_result = os.stat(file_name)
+    return stat_result.st_mtime_ns, stat_result.st_size
+
+
+def read_tsv_cached(file_name):
+    """
+    Read a TSV file, re-using the parsed DataFrame if the file has not changed since the last read.
+    The DataFrame returned is shared between requests, so treat it as read-only (or copy it before editing)
+    :param file_name: full path to the TSV file
+    :return: DataFrame with the same content as read_tsv(file_name)
+    """
+    version = get_file_version(file_name)  # Raises FileNotFoundError, same as read_tsv() callers expect
+    table_df = get_cached_value(tsv_cache, file_name, version)
+    if table_df is None:
+        table_df = read_tsv(file_name)
+        add_cached_value(tsv_cache, file_name, version, table_df, app.config.get('TSV_CACHE_SIZE') or 0)
+    return table_df
+
+
+def get_file_etag(file_name):
+    """
+    Get the version token (ETag) of a file, based on modification time and size
+    :param file_name: full path to the file
+    :return: unquoted ETag string, or None if the file does not exist
+    """
+    try:
+        mtime_ns, size = get_file_version(file_name)
+    except (OSError, TypeError):
+        return None
+    return hashlib.md5((str(mtime_ns) + '-' + str(size)).encode('utf-8')).hexdigest()
+
+
+def etag_header(file_name):
+    """
+    HTTP headers with the current ETag of a file, to return from a Resource as (data, code, headers)
+    """
+    etag = get_file_etag(file_name)
+    if etag is None:
+        return {}
+    return {'ETag': quote_etag(etag)}
+
+
+def add_etag(response, file_name):
+    """
+    Add the current ETag of a file to a Flask Response object, ie. from jsonify()
+    """
+    etag = get_file_etag(file_name)
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+
+def add_etag_after_request(file_name):
+    """
+    Add the ETag of a file, as it is once the request has been processed, to the response.
+    Use this when the Resource does not build the response itself, ie. returns a marshmallow dump
+    """
+    @after_this_request
+    def set_etag(response):
+        if response.status_code < 300:
+            add_etag(response, file_name)
+        return response
+
+
+def check_if_match(file_name):
+    """
+    Optimistic concurrency check for updates. If the client sent an If-Match header, the file must
+    not have changed since the client read it, otherwise the request is aborted with 412
+    :param file_name: full path to the file the client wants to update
+    """
+    if not request.if_match:  # No If-Match header, so the client does not use version tokens
+        return
+
+    etag = get_file_etag(file_name)
+    if etag is None or not request.if_match.contains(etag):
+        logger.info("If-Match precondition failed for %s", file_name)
+        abort(412, message="The file " + os.path.basename(str(file_name)) +
+                           " has been changed since you read it. Please reload and try again")
+
+
+def is_not_modified(file_name):
+    """
+    Check the If-None-Match header against the current version of the file
+    :return: True if the client already has the current version of the file
+    """
+    etag = get_file_etag(file_name)
+    return etag is not None and request.if_none_match.contains_weak(etag)
+
+
+def not_modified(file_name):
+    """
+    Empty '304 Not Modified' response, so the client can keep using its copy of the file
+    """
+    return add_etag(make_response('', 304), file_name)
+
+
+def get_investigation_file_name(study_location):
+    """
+    Full path to the investigation file of a study, this is the version file for all investigation sections
+    """
+    try:
+        return glob.glob(os.path.join(study_location, "i_*.txt"))[0]
+    except IndexError:
+        return None
+
+
 def tidy_template_row(df):
     row = df.iloc[0]
     new_row = []
@@ -748,7 +935,7 @@ def create_maf(technology, study_location, assay_file_name, annotation_file_name
         maf_df = pd.read_csv(full_annotation_file_name, sep="\t", header=0, encoding='utf-8')
     except FileNotFoundError:
         update_maf = True
-        maf_df = pd.read_csv(annotation_file_template, sep="\t", header=0, encoding='utf-8')
+        maf_df = get_maf_template(annotation_file_template)
         logger.info("Creating new MAF: " + full_annotation_file_name)
     except UnicodeDecodeError as e:
         if os.path.getsize(full_annotation_file_name) > 0:
@@ -841,36 +1028,130 @@ def remove_file(file_location, file_name, allways_remove=False):
     return True, "File " + file_name + " deleted"
 
 
-def map_file_type(file_name, directory, assay_file_list=None):
+class FileTypeRules:
+    """
+    The map_file_type() rules that only depend on the file name, built once from the application config.
+    The result for each file name is cached, the rules that need the ISA-Tab files or the filesystem are not
+    """
+
+    def __init__(self, config, cache_size=100000):
+        self.ignore_file_pattern = get_any_text_pattern(config.get('IGNORE_FILE_LIST'))
+        self.raw_files = set(config.get('RAW_FILES_LIST'))
+        self.derived_files = set(config.get('DERIVED_FILES_LIST'))
+        self.compressed_files = set(config.get('COMPRESSED_FILES_LIST'))
+        self.internal_mapping_files = set(config.get('INTERNAL_MAPPING_LIST'))
+        self.empty_exclusion_files = set(config.get('EMPTY_EXCLUSION_LIST'))
+        self.name_types = {'fid': 'fid', 'fid.txt': 'fid',  # NMR data
+                           'acqus': 'acqus', 'acqus.txt': 'acqus', 'acqu': 'acqus', 'acqu.txt': 'acqus'}
+        self.extension_types = {}
+        for file_type, extensions in (
+                ('spreadsheet', ('.xls', '.xlsx', '.xlsm', '.csv', '.tsv')),
+                ('chemical_structure', ('.sdf', '.mol')),
+                ('image', ('.png', '.tiff', '.tif', '.jpeg', '.mpg', '.jpg')),
+                ('part_of_raw', ('.result_c', '.mcf', '.mcf_idx', '.hdx', '.u2', '.method', '.unt', '.hss', '.ami',
+                                 '.baf', '.content', '.baf_idx', '.baf_xtr', '.xmc'))):
+            for extension in extensions:
+                self.extension_types.setdefault(extension, file_type)  # First rule wins, as in the old if/elif
+        self.text_extensions = {'.txt', '.text', '.tab', '.html', '.ini'}
+        self.temp_extensions = {'.temp', '.tmp'}
+        self.programmatic_extensions = {'.r', '.java', '.py', '.rdata', '.xsd', '.scan'}
+        self.aspera_extensions = {'.partial', '.aspera-ckpt', '.aspx'}
+        self.classify_name = lru_cache(maxsize=cache_size)(self.classify_name)
+
+    def classify_name(self, file_name):
+        """
+        :return: ('final', (type, status, folder)) if the name is enough, else what still has to be checked.
+            ('metadata', prefix), ('referenced', type) or ('other', ignored file, raw file extension)
+        """
+        active_status = 'active'
+        none_active_status = 'unreferenced'
+        final_filename = os.path.basename(file_name)
+        fname, ext = os.path.splitext(final_filename)
+        fname = fname.lower()
+        ext = ext.lower()
+
+        # Metadata first, current is if the files are present in the investigation and assay files
+        if fname.startswith(('i_', 'a_', 's_', 'm_')) and (ext == '.txt' or ext == '.tsv'):
+            return 'metadata', fname[:2]
+        if final_filename in self.name_types:
+            return 'final', (self.name_types[final_filename], active_status, False)
+        if ext in self.extension_types:
+            return 'final', (self.extension_types[ext], active_status, False)
+        if fname == 'synchelper' or fname == 'pulseprogram':
+            return 'final', ('part_of_raw', active_status, False)
+        if ext in self.text_extensions:
+            if self.ignore_file_pattern.search(fname):  # some internal RAW datafiles have these extensions
+                return 'final', ('part_of_raw', none_active_status, False)
+            return 'final', ('text', active_status, False)
+        if fname.startswith('~') or ext.endswith('~') or ext in self.temp_extensions:
+            return 'final', ('temp', none_active_status, False)
+        if ext in self.programmatic_extensions and '.wiff' not in fname:
+            return 'final', ('programmatic', none_active_status, False)
+        if ext in self.aspera_extensions:
+            return 'final', ('aspera-control', none_active_status, False)
+        if file_name == 'audit':
+            return 'final', ('audit', none_active_status, True)
+        if file_name == '.DS_Store':
+            return 'final', ('macos_special_file', none_active_status, False)
+        if ext in self.derived_files:
+            return 'referenced', 'derived'
+        if ext in self.compressed_files:
+            return 'referenced', 'compressed'
+        if fname in self.internal_mapping_files:
+            return 'final', ('internal_mapping', active_status, False)
+        if fname.endswith(('.tsv.split', '_pubchem.tsv', '_annotated.tsv')):
+            return 'final', ('chebi_pipeline_file', active_status, False)
+        if fname in self.empty_exclusion_files:
+            return 'final', ('ignored', none_active_status, False)
+        return 'other', bool(self.ignore_file_pattern.search(fname)), ext in self.raw_files
+
+
+def get_any_text_pattern(texts):
+    # One regular expression to find out if any of the texts is in a string
+    return re.compile('|'.join(re.escape(text) for text in texts) or '(?!)')
+
+
+file_type_rules = None
+
+
+def get_file_type_rules():
+    global file_type_rules
+    if file_type_rules is None:
+        file_type_rules = FileTypeRules(app.config)
+    return file_type_rules
+
+
+def map_file_type(file_name, directory, assay_file_list=None, is_dir=None):
+    """
+    Work out the type and status of a file or folder
+    :param file_name: name of the file, relative to directory
+    :param directory: folder the file is in
+    :param assay_file_list: the files referenced in the assays, if already known
+    :param is_dir: True/False if already known from scandir, saves looking at the filesystem again
+    :return: file type, status ('active' or 'unreferenced') and True if this is a folder
+    """
     active_status = 'active'
     none_active_status = 'unreferenced'
     folder = False
-    final_filename = os.path.basename(file_name)
-    # fname, ext = os.path.splitext(file_name)
-    fname, ext = os.path.splitext(final_filename)
-    fname = fname.lower()
-    ext = ext.lower()
-    empty_exclusion_list = app.config.get('EMPTY_EXCLUSION_LIST')
-    ignore_file_list = app.config.get('IGNORE_FILE_LIST')
-    raw_files_list = app.config.get('RAW_FILES_LIST')
-    derived_files_list = app.config.get('DERIVED_FILES_LIST')
-    compressed_files_list = app.config.get('COMPRESSED_FILES_LIST')
-    internal_mapping_list = app.config.get('INTERNAL_MAPPING_LIST')
-
-    # Metadata first, current is if the files are present in the investigation and assay files
-    if fname.startswith(('i_', 'a_', 's_', 'm_')) and (ext == '.txt' or ext == '.tsv'):
-        if fname.startswith('a_'):
+    rule, *details = get_file_type_rules().classify_name(file_name)
+
+    if rule == 'final':
+        return details[0]
+
+    if rule == 'metadata':
+        prefix = details[0]
+        if prefix == 'a_':
             if is_file_referenced(file_name, directory, 'i_'):
                 return 'metadata_assay', active_status, folder
-        elif fname.startswith('s_'):
+        elif prefix == 's_':
             if is_file_referenced(file_name, directory, 'i_'):
                 return 'metadata_sample', active_status, folder
-        elif fname.startswith('m_'):
+        elif prefix == 'm_':
             if is_file_referenced(file_name, directory, 'a_', assay_file_list=assay_file_list):
                 return 'metadata_maf', active_status, folder
             else:
                 return 'metadata_maf', none_active_status, folder
-        elif fname.startswith('i_'):
+        elif prefix == 'i_':
             investigation = os.path.join(directory, 'i_')
             if os.sep + 'audit' + os.sep in directory:
                 return 'metadata_investigation', none_active_status, folder
@@ -878,70 +1159,26 @@ def map_file_type(file_name, directory, assay_file_list=None):
                 if open(invest_file, encoding='utf8', errors="ignore").read():
                     return 'metadata_investigation', active_status, folder
         return 'metadata', none_active_status, folder
-    elif final_filename in ('fid', 'fid.txt'):  # NMR data
-        return 'fid', active_status, folder
-    elif final_filename in ('acqus', 'acqus.txt', 'acqu', 'acqu.txt'):  # NMR data
-        return 'acqus', active_status, folder
-    elif ext in ('.xls', '.xlsx', '.xlsm', '.csv', '.tsv'):
-        return 'spreadsheet', active_status, folder
-    elif ext in ('.sdf', '.mol'):
-        return 'chemical_structure', active_status, folder
-    elif ext in ('.png', '.tiff', '.tif', '.jpeg', '.mpg', '.jpg'):
-        return 'image', active_status, folder
-    elif ext in ('.result_c', '.mcf', '.mcf_idx', '.hdx', '.u2', '.method', '.unt', '.hss', '.ami', '.baf', '.content',
-                 '.baf_idx', '.baf_xtr', '.xmc') or fname == 'synchelper' or fname == 'pulseprogram':
-        return 'part_of_raw', active_status, folder
-    elif ext in ('.txt', '.text', '.tab', '.html', '.ini'):
-        for ignore in ignore_file_list:  # some internal RAW datafiles have these extensions, so ignore
-            if ignore in fname:
-                return 'part_of_raw', none_active_status, folder
-        return 'text', active_status, folder
-    elif fname.startswith('~') or ext.endswith('~') or ext in ('.temp', '.tmp'):
-        return 'temp', none_active_status, folder
-    elif ext in ('.r', '.java', '.py', '.rdata', '.xsd', '.scan') and '.wiff' not in fname:
-        return 'programmatic', none_active_status, folder
-    elif ext in ('.partial', '.aspera-ckpt', '.aspx'):
-        return 'aspera-control', none_active_status, folder
-    elif file_name == 'audit':
-        return 'audit', none_active_status, True
-    elif file_name == '.DS_Store':
-        return 'macos_special_file', none_active_status, False
-    elif ext in derived_files_list:
-        if is_file_referenced(file_name, directory, 'a_', assay_file_list=assay_file_list):
-            return 'derived', active_status, folder
-        else:
-            return 'derived', none_active_status, folder
-    elif ext in compressed_files_list:
-        if is_file_referenced(file_name, directory, 'a_', assay_file_list=assay_file_list):
-            return 'compressed', active_status, folder
-        else:
-            return 'compressed', none_active_status, folder
-    elif fname in internal_mapping_list:
-        return 'internal_mapping', active_status, folder
-    elif fname.endswith(('.tsv.split', '_pubchem.tsv', '_annotated.tsv')):
-        return 'chebi_pipeline_file', active_status, folder
-    elif fname in empty_exclusion_list:
-        return 'ignored', none_active_status, folder
-    else:
-        for ignore in ignore_file_list:
-            if ignore in fname:
-                return 'part_of_raw', none_active_status, folder
+
+    if rule == 'referenced':
+        file_type = details[0]
         if is_file_referenced(file_name, directory, 'a_', assay_file_list=assay_file_list):
-            if os.path.isdir(os.path.join(directory, file_name)):
-                return 'raw', active_status, True
-            else:
-                return 'raw', active_status, folder
+            return file_type, active_status, folder
         else:
-            if ext in raw_files_list:
-                if os.path.isdir(os.path.join(directory, file_name)):
-                    return 'raw', none_active_status, True
-                else:
-                    return 'raw', none_active_status, folder
-
-            if os.path.isdir(os.path.join(directory, file_name)):
-                return 'directory', none_active_status, True
-
-        return 'unknown', none_active_status, folder
+            return file_type, none_active_status, folder
+
+    ignored_file, raw_extension = details
+    if ignored_file:
+        return 'part_of_raw', none_active_status, folder
+    if is_dir is None:
+        is_dir = os.path.isdir(os.path.join(directory, file_name))
+    if is_file_referenced(file_name, directory, 'a_', assay_file_list=assay_file_list):
+        return 'raw', active_status, is_dir
+    if raw_extension:
+        return 'raw', none_active_status, is_dir
+    if is_dir:
+        return 'directory', none_active_status, True
+    return 'unknown', none_active_status, folder
 
 
 def traverse_subfolders(study_location=None, file_location=None, file_list=None, all_folders=None, full_path=None):
@@ -955,51 +1192,132 @@ def traverse_subfolders(study_location=None, file_location=None, file_list=None,
         return file_list, all_folders
 
     folder_exclusion_list = app.config.get('FOLDER_EXCLUSION_LIST')
+    seen_files = set(file_list)
+    seen_folders = set(all_folders)
+
+    if file_location not in seen_folders:
+        for root, sub_directories, files in os.walk(file_location):
+            if not root or basename(normpath(root)) in folder_exclusion_list:
+                continue
+
+            if root not in seen_folders:
+                seen_folders.add(root)
+                all_folders.append(root)
 
-    if file_location not in all_folders:
-        for params in os.walk(file_location):
-            root = None
-            sub_directories = None
-            files = None
-
-            if params:
-                if params[0]:
-                    root = params[0]
-                if params[1]:
-                    sub_directories = params[1]
-                if params[2]:
-                    files = params[2]
-
-            if root and basename(normpath(root)) not in folder_exclusion_list:
-                if root not in all_folders:
-                    all_folders.append(root)
-                if files:
-                    for file in files:
-                        if file:
-                            file_name = file
-                            if full_path:
-                                file_name = os.path.join(root.replace(study_location, ""), file_name)
-                            if file_name not in file_list:
-                                file_list.append(file_name)
-
-                if sub_directories:
-                    for directory in sub_directories:
-                        if directory and directory not in folder_exclusion_list:
-                            next_folder = os.path.join(root, directory)
-                            if next_folder not in all_folders:
-                                file_list, all_folders = traverse_subfolders(
-                                    study_location=study_location, file_location=next_folder, file_list=file_list,
-                                    all_folders=all_folders, full_path=full_path)
+            for file_name in files:
+                if full_path:
+                    file_name = os.path.join(root.replace(study_location, ""), file_name)
+                if file_name not in seen_files:
+                    seen_files.add(file_name)
+                    file_list.append(file_name)
 
     return file_list, all_folders
 
 
+class TextMatcher:
+    """
+    Find out if a (file) name is used in a set of ISA-Tab files. The text is split once into all the names it has:
+    the cell values, the words in them and all the parts of the paths in them ('RAW/x.raw' is also 'RAW' and 'x.raw').
+    A name is then a set lookup, whatever the number of files checked. A name that is only part of a word (ie. 'x.raw'
+    in 'old_x.raw') is not a reference, use contains_text() to look for any text
+    """
+    word_separator = re.compile(r'[\s,;|]+')
+
+    def __init__(self, texts):
+        self.text = '\n'.join(texts)
+        self.names = set()
+        for cell in set(re.split(r'[\t\r\n]', self.text)):
+            cell = cell.strip().strip('"').strip()
+            if not cell:
+                continue
+            self.names.add(cell)
+            for word in self.word_separator.split(cell):
+                parts = [part for part in word.split('/') if part]
+                for start in range(len(parts)):
+                    for end in range(start + 1, len(parts) + 1):
+                        self.names.add('/'.join(parts[start:end]))
+
+    def __contains__(self, name):
+        return bool(name) and name in self.names
+
+    def contains_text(self, text):
+        # Reads all of the text, only for the odd check that is not a name
+        return bool(text) and text in self.text
+
+
+class IsaTabReferences:
+    """
+    All the text in the ISA-Tab files of one folder, per file type ('i_', 'a_' etc.), read once
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.matchers = {}
+
+    def get_matcher(self, isa_tab_file_to_check):
+        matcher = self.matchers.get(isa_tab_file_to_check)
+        if matcher is None:
+            texts = []
+            for ref_file_name in glob.glob(os.path.join(self.directory, isa_tab_file_to_check + '*.txt')):
+                try:
+                    with io.open(ref_file_name, 'r', encoding='utf8', errors="ignore") as ref_file:
+                        texts.append(ref_file.read())
+                except Exception as e:
+                    logger.error('File Format error? Cannot read or open file ' + ref_file_name)
+                    logger.error(str(e))
+            matcher = TextMatcher(texts)
+            self.matchers[isa_tab_file_to_check] = matcher
+        return matcher
+
+    def is_referenced(self, text, isa_tab_file_to_check):
+        return text in self.get_matcher(isa_tab_file_to_check)
+
+    def contains_text(self, text, isa_tab_file_to_check):
+        return self.get_matcher(isa_tab_file_to_check).contains_text(text)
+
+
+# ISA-Tab references per folder, keyed on folder name. Each entry is (ISA-Tab files version, IsaTabReferences)
+isa_tab_reference_cache = OrderedDict()
+
+
+def get_isa_tab_files_version(directory):
+    versions = []
+    for isa_file in sorted(glob.glob(os.path.join(directory, "?_*.txt"))):
+        try:
+            stat = os.stat(isa_file)
+            versions.append((isa_file, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            continue
+    return tuple(versions)
+
+
+def get_isa_tab_references(directory):
+    """
+    The ISA-Tab references for a folder. Within one request the folder is only checked once, between requests
+    the references are re-used until any of the ISA-Tab files change
+    """
+    request_cache = {}
+    if has_app_context():
+        request_cache = g.setdefault('isa_tab_references', {})
+    references = request_cache.get(directory)
+    if references is not None:
+        return references
+
+    version = get_isa_tab_files_version(directory)
+    references = get_cached_value(isa_tab_reference_cache, directory, version)
+    if references is None:
+        references = IsaTabReferences(directory)
+        if version and has_app_context():  # No need to keep folders without any ISA-Tab files
+            add_cached_value(isa_tab_reference_cache, directory, version, references,
+                             app.config.get('ISA_TAB_REFERENCE_CACHE_SIZE') or 0)
+
+    request_cache[directory] = references
+    return references
+
+
 def is_file_referenced(file_name, directory, isa_tab_file_to_check, assay_file_list=None):
     """ There can be more than one assay, so each MAF must be checked against
     each Assay file. Do not state a MAF as not in use if it's used in the 'other' assay """
-    found = False
-    start_time = time.time()
-
     try:  # Submitters using standard ISAcreator (not ours) with a non UFT-8 character set will cause issues
         file_name = file_name.encode('ascii', 'ignore').decode('ascii')
     except Exception as e:
@@ -1019,65 +1337,70 @@ def is_file_referenced(file_name, directory, isa_tab_file_to_check, assay_file_l
         if file_name.startswith(('i_', 'a_', 's_', 'm_')) and os.sep + 'ftp' in directory:  # FTP metadata
             return False
 
-        isa_tab_file_to_check = isa_tab_file_to_check + '*.txt'
-        isa_tab_file = os.path.join(directory, isa_tab_file_to_check)
-        for ref_file_name in glob.glob(isa_tab_file):
-            """ The filename we pass in is found referenced in the metadata (ref_file_name)
-            One possible problem here is of the maf is found in an old assay file, then we will report it as 
-            current """
-            try:
-                logger.info("Checking if file " + file_name + " is referenced in " + ref_file_name)
-                if file_name in io.open(ref_file_name, 'r', encoding='utf8', errors="ignore").read():
-                    found = True
-            except Exception as e:
-                logger.error('File Format error? Cannot read or open file ' + file_name)
-                logger.error(str(e))
-
-        logger.info("Looking for file name '" + file_name + "' in ISA-Tab files took %s seconds" % round(
-            time.time() - start_time, 2))
+        # The filename we pass in is found referenced in the metadata. One possible problem here is if the maf is
+        # found in an old assay file, then we will report it as current
+        return get_isa_tab_references(directory).is_referenced(file_name, isa_tab_file_to_check)
     except Exception as e:
         logger.error('File Format error? Cannot access file :' + str(file_name))
         logger.error(str(e))
         return False
-    return found
 
 
 def find_text_in_isatab_file(study_folder, text_to_find):
-    found = False
-    isa_tab_file = os.path.join(study_folder, 'i_*.txt')
-    for ref_file in glob.glob(isa_tab_file):
-        try:
-            logger.info("Checking if text " + text_to_find + " is referenced in " + ref_file)
-            if text_to_find in io.open(ref_file, 'r', encoding='utf8', errors="ignore").read():
-                found = True
-        except Exception as e:
-            logger.error('File Format error? Cannot read or open file ' + ref_file)
-            logger.error(str(e))
+    return get_isa_tab_references(study_folder).contains_text(text_to_find, 'i_')
 
-    return found
 
+# Files referenced in the assays, keyed on study folder. Each entry is (assay files version, frozenset of file names)
+assay_file_list_cache = OrderedDict()
 
-def get_assay_file_list(study_location):
-    assay_files = os.path.join(study_location, 'a_*.txt')
-    all_files = []
 
-    for assay_file_name in glob.glob(assay_files):
-        assay_cols = []
-        assay_df = read_tsv(assay_file_name)
-        df_header = get_table_header(assay_df)
-        for header, value in df_header.items():
-            if ' File' in header:
-                assay_cols.append(value)
+def get_assay_file_list(study_location):
+    """
+    All the file names referenced in the '... File' columns of the assays in a study folder. Within one request the
+    folder is only checked once, between requests the list is re-used until any of the assay files change
+    :param study_location: study folder
+    :return: frozenset of file names
+    """
+    request_cache = {}
+    if has_app_context():
+        request_cache = g.setdefault('assay_file_lists', {})
+    all_files = request_cache.get(study_location)
+    if all_files is not None:
+        return all_files
+
+    versions = []
+    for assay_file_name in sorted(glob.glob(os.path.join(study_location, 'a_*.txt'))):
+        try:
+            versions.append((assay_file_name,) + get_file_version(assay_file_name))
+        except OSError:
+            continue
+    version = tuple(versions)
 
-        for col_pos in assay_cols:
-            unique_files = np.unique(assay_df.iloc[:, col_pos].values).tolist()
-            for a_file in unique_files:
-                if a_file not in all_files and len(str(a_file)) > 0:
-                    all_files.append(a_file)
+    all_files = get_cached_value(assay_file_list_cache, study_location, version)
+    if all_files is None:
+        all_files = read_assay_file_list([assay_file[0] for assay_file in versions])
+        if version and has_app_context():
+            add_cached_value(assay_file_list_cache, study_location, version, all_files,
+                             app.config.get('ASSAY_FILE_LIST_CACHE_SIZE') or 0)
 
+    request_cache[study_location] = all_files
     return all_files
 
 
+def read_assay_file_list(assay_file_names):
+    file_columns = []
+    for assay_file_name in assay_file_names:
+        assay_df = read_tsv(assay_file_name)
+        positions = [position for position, header in enumerate(assay_df.columns) if ' File' in str(header)]
+        if positions:
+            file_columns.append(assay_df.iloc[:, positions].values.ravel())
+
+    if not file_columns:
+        return frozenset()
+    unique_files = pd.unique(np.concatenate(file_columns))
+    return frozenset(a_file for a_file in unique_files if len(str(a_file)) > 0)
+
+
 def track_ga_event(category, action, tracking_id=None, label=None, value=0):
     data = {
         'v': '1',  # API Version.
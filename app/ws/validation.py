@@ -16,16 +16,20 @@
 #
 #  Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
 
+import copy
 import json
 import threading
 import traceback
+from collections import OrderedDict
 
 from flask_restful import Resource, reqparse
 from flask_restful_swagger import swagger
 
 from app.ws.db_connection import override_validations, update_validation_status
+from app.ws.file_index import get_directory_stats
 from app.ws.isaApiClient import IsaApiClient
 from app.ws.mtblsWSclient import WsClient
+from app.ws.request_limits import limit_requests
 from app.ws.study_files import get_all_files_from_filesystem, list_directories_full
 from app.ws.utils import *
 from app.ws.cluster_jobs import lsf_job
@@ -57,6 +61,139 @@ raw_file = 'Raw Spectral Data File'
 derived_file = 'Derived Spectral Data File'
 
 
+# The validation schema, loaded once and only loaded again when VALIDATIONS_FILE changes. The version is the file
+# version of a local file, or the ETag/Last-Modified headers of a URL
+validation_schema_cache = {'version': None, 'checked_at': 0, 'schema': None, 'protocol_columns': {}}
+# Overridden validations per study, keyed on study id. Each entry is (time read, list of overrides)
+override_cache = OrderedDict()
+# Result of each validation section, keyed on (study folder, section, log category). Each entry is (inputs of the
+# section, result, lists the section added to), see get_cached_section()
+validation_section_cache = OrderedDict()
+
+
+def get_validation_schema():
+    """
+    The validation schema (VALIDATIONS_FILE). The schema is shared between requests, so treat it as read-only
+    :return: dict, raises an exception if the schema can not be loaded
+    """
+    validation_schema_file = app.config.get('VALIDATIONS_FILE')
+    cache = validation_schema_cache
+    if validation_schema_file.startswith('http'):
+        check_interval = app.config.get('VALIDATIONS_FILE_CHECK_INTERVAL') or 0
+        if cache['schema'] is not None and time.time() - cache['checked_at'] < check_interval:
+            return cache['schema']
+        headers = {}
+        if cache['schema'] is not None and cache['version']:
+            etag, last_modified = cache['version'][1:]
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        try:
+            response = requests.get(validation_schema_file, headers=headers)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            if cache['schema'] is None:
+                raise
+            logger.warning('Could not check the validation schema, using the one loaded before. ' + str(e))
+            return cache['schema']
+        cache['checked_at'] = time.time()
+        if response.status_code == 304:
+            return cache['schema']
+        version = (validation_schema_file, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        validation_schema = json.loads(response.content)
+    else:
+        version = (validation_schema_file,) + get_file_version(validation_schema_file)
+        if cache['schema'] is not None and cache['version'] == version:
+            return cache['schema']
+        with open(validation_schema_file, 'r', encoding='utf-8') as json_file:
+            validation_schema = json.load(json_file)
+
+    cache['protocol_columns'] = index_protocol_assay_rules(validation_schema)
+    cache['schema'] = validation_schema
+    cache['version'] = version
+    logger.info('Loaded the validation schema from ' + validation_schema_file)
+    return validation_schema
+
+
+def index_protocol_assay_rules(validation_schema):
+    # Column name: rules, for all the protocol columns. The first protocol with the column wins
+    protocol_columns = {}
+    for column in validation_schema['study']['protocols']['default']:
+        if column['title'].lower() != 'sample collection':
+            for column_name, rules in column['columns'].items():
+                protocol_columns.setdefault(column_name, rules)
+    return protocol_columns
+
+
+def get_override_list(study_id):
+    """
+    The overridden validations of a study, as stored by OverrideValidation
+    :return: list of 'validation sequence:message'
+    """
+    cached = override_cache.get(study_id)
+    if cached and time.time() - cached[0] < app.config.get('VALIDATION_OVERRIDE_CACHE_SECONDS'):
+        override_cache.move_to_end(study_id)
+        return list(cached[1])
+
+    override_list = []
+    try:
+        query_list = override_validations(study_id, 'query')
+        if query_list and query_list[0]:
+            for val in query_list[0].split('|'):
+                override_list.append(val)
+    except Exception as e:
+        logger.error('Could not query overridden validations from the database. ' + str(e))
+        return override_list
+
+    override_cache[study_id] = (time.time(), override_list)
+    override_cache.move_to_end(study_id)
+    while len(override_cache) > app.config.get('VALIDATION_OVERRIDE_CACHE_SIZE'):
+        override_cache.popitem(last=False)
+    return list(override_list)
+
+
+def get_isa_file_versions(study_location):
+    """
+    File versions of the ISA-Tab files in the study folder, per type
+    :return: dict of 'i', 's', 'a' and 'm': tuple of (file name, mtime in nanoseconds, size)
+    """
+    versions = {'i': [], 's': [], 'a': [], 'm': []}
+    for isa_file in sorted(glob.glob(os.path.join(study_location, "?_*.t*"))):
+        file_name = os.path.basename(isa_file)
+        if file_name[0] in versions:
+            try:
+                versions[file_name[0]].append((file_name,) + get_file_version(isa_file))
+            except OSError:
+                continue
+    return {prefix: tuple(file_versions) for prefix, file_versions in versions.items()}
+
+
+def get_cached_section(study_location, section, log_category, inputs, validate, output_lists=()):
+    """
+    Validate one section of a study, or return the result of the last time, if none of the inputs of the section
+    have changed since then
+    :param inputs: tuple of everything the section depends on, ie. the versions of the ISA-Tab files it reads
+    :param validate: function that validates the section
+    :param output_lists: lists the section adds to (ie. the sample names), they are cached with the result
+    :return: the result of validate()
+    """
+    key = (study_location, section, log_category)
+    cached = validation_section_cache.get(key)
+    if cached and cached[0] == inputs:
+        validation_section_cache.move_to_end(key)
+        for output_list, values in zip(output_lists, cached[2]):
+            output_list.extend(values)
+        return copy.deepcopy(cached[1])
+
+    result = validate()
+    validation_section_cache[key] = (inputs, copy.deepcopy(result), [list(values) for values in output_lists])
+    validation_section_cache.move_to_end(key)
+    while len(validation_section_cache) > app.config.get('VALIDATION_SECTION_CACHE_SIZE'):
+        validation_section_cache.popitem(last=False)
+    return result
+
+
 def add_msg(validations, section, message, status, meta_file="", value="", descr="", val_sequence=0,
             log_category=error):
     if log_category == status or log_category == 'all':
@@ -85,19 +222,11 @@ def get_complex_validation_rules(validation_schema, part, sub_part, sub_set):
 
 
 def get_protocol_assay_rules(validation_schema, protocol_part):
-    val_rule = None
-    if validation_schema and protocol_part.lower() != 'sample name':
-        study_val = validation_schema['study']
-        val = study_val['protocols']
-        sub = val['default']
-        for column in sub:
-            column_title = column['title']
-            if column_title.lower() != 'sample collection':
-                rules = column['columns']
-                for rule in rules:
-                    if rule == protocol_part:
-                        return rules[protocol_part]
-    return val_rule
+    if not validation_schema or protocol_part.lower() == 'sample name':
+        return None
+    if validation_schema is validation_schema_cache['schema']:
+        return validation_schema_cache['protocol_columns'].get(protocol_part)
+    return index_protocol_assay_rules(validation_schema).get(protocol_part)
 
 
 def extract_details(rule):
@@ -485,6 +614,7 @@ class Validation(Resource):
             }
         ]
     )
+    @limit_requests('validation')
     def get(self, study_id):
 
         user_token = None
@@ -525,7 +655,7 @@ class Validation(Resource):
             section = 'all'
 
         try:
-            number_of_files = sum([len(files) for r, d, files in os.walk(study_location)])
+            number_of_files = get_directory_stats(study_location).file_count
         except:
             number_of_files = 0
 
@@ -728,33 +858,39 @@ def validate_study(study_id, study_location, user_token, obfuscation_code,
     db_submission_date, db_study_status = wsc.get_permissions(study_id, user_token)
 
     try:
-        validation_schema_file = app.config.get('VALIDATIONS_FILE')
-
-        if validation_schema_file.startswith('http'):
-            response = requests.get(validation_schema_file)
-            validation_schema = json.loads(response.content)
-        else:
-            with open(validation_schema_file, 'r', encoding='utf-8') as json_file:
-                validation_schema = json.load(json_file)
-
+        validation_schema = get_validation_schema()
     except Exception as e:
         all_validations.append({"info": "Could not find the validation schema, only basic validation will take place",
                                 "status": success})
         logger.error(str(e))
 
-    override_list = []
-    try:
-        query_list = override_validations(study_id, 'query')
-        if query_list and query_list[0]:
-            for val in query_list[0].split('|'):
-                override_list.append(val)
-    except Exception as e:
-        logger.error('Could not query overridden validations from the database. ' + str(e))
+    override_list = get_override_list(study_id)
+
+    # Each section is only validated again when any of its inputs changed, see get_cached_section()
+    isa_versions = get_isa_file_versions(study_location)
+    common_inputs = (validation_schema_cache['version'] if validation_schema else None, tuple(override_list))
+    investigation_inputs = common_inputs + (isa_versions['i'],)
+    all_isa_inputs = common_inputs + tuple(isa_versions[prefix] for prefix in sorted(isa_versions))
+    folder_inputs = None
+    isa_tab = {}
+
+    def load_isa_tab():
+        # The ISA-Tab files are only loaded if any of the sections has to be validated again
+        if not isa_tab:
+            isa_tab['result'] = validate_basic_isa_tab(
+                study_id, user_token, study_location, db_release_date, override_list, log_category=log_category)
+        return isa_tab['result']
+
+    def validate_basic():
+        isa_study, isa_inv, isa_samples, std_path, status, amber_warning, isa_validation, inv_file, s_file, \
+            assay_files = load_isa_tab()
+        return status, amber_warning, isa_validation, isa_study is not None, inv_file, s_file
 
     # Validate basic ISA-Tab structure
-    isa_study, isa_inv, isa_samples, std_path, status, amber_warning, isa_validation, inv_file, s_file, assay_files = \
-        validate_basic_isa_tab(
-            study_id, user_token, study_location, db_release_date, override_list, log_category=log_category)
+    status, amber_warning, isa_validation, isa_study, inv_file, s_file = \
+        get_cached_section(study_location, 'basic', log_category, all_isa_inputs + (db_release_date,), validate_basic)
+    if not isa_study:  # Try to load the ISA-Tab files again next time, the problem may not be in the files
+        validation_section_cache.pop((study_location, 'basic', log_category), None)
     all_validations.append(isa_validation)
     if not status:
         error_found = True
@@ -766,8 +902,10 @@ def validate_study(study_id, study_location, user_token, obfuscation_code,
     # Validate publications reported on the study
     val_section = "publication"
     if isa_study and validation_section == 'all' or val_section in validation_section:
-        status, amber_warning, pub_validation = validate_publication(
-            isa_study, validation_schema, inv_file, override_list, val_section, log_category=log_category)
+        status, amber_warning, pub_validation = get_cached_section(
+            study_location, val_section, log_category, investigation_inputs,
+            lambda: validate_publication(load_isa_tab()[0], validation_schema, inv_file, override_list, val_section,
+                                         log_category=log_category))
         all_validations.append(pub_validation)
 
     if not status:
@@ -778,8 +916,10 @@ def validate_study(study_id, study_location, user_token, obfuscation_code,
     # Validate detailed metadata in ISA-Tab structure
     val_section = "isa-tab"
     if validation_section == 'all' or val_section in validation_section:
-        status, amber_warning, isa_meta_validation = validate_isa_tab_metadata(
-            isa_inv, isa_study, validation_schema, inv_file, override_list, val_section, log_category=log_category)
+        status, amber_warning, isa_meta_validation = get_cached_section(
+            study_location, val_section, log_category, investigation_inputs,
+            lambda: validate_isa_tab_metadata(load_isa_tab()[1], load_isa_tab()[0], validation_schema, inv_file,
+                                              override_list, val_section, log_category=log_category))
         all_validations.append(isa_meta_validation)
 
     if not status:
@@ -790,8 +930,10 @@ def validate_study(study_id, study_location, user_token, obfuscation_code,
     # Validate Person (authors)
     val_section = "person"
     if isa_study and validation_section == 'all' or val_section in validation_section:
-        status, amber_warning, isa_person_validation = validate_contacts(
-            isa_study, validation_schema, inv_file, override_list, val_section, log_category=log_category)
+        status, amber_warning, isa_person_validation = get_cached_section(
+            study_location, val_section, log_category, investigation_inputs,
+            lambda: validate_contacts(load_isa_tab()[0], validation_schema, inv_file, override_list, val_section,
+                                      log_category=log_category))
         all_validations.append(isa_person_validation)
 
     if not status:
@@ -802,8 +944,10 @@ def validate_study(study_id, study_location, user_token, obfuscation_code,
     # Validate Protocols
     val_section = "protocols"
     if isa_study and validation_section == 'all' or val_section in validation_section:
-        status, amber_warning, isa_protocol_validation = validate_protocols(
-            isa_study, validation_schema, inv_file, override_list, val_section, log_category=log_category)
+        status, amber_warning, isa_protocol_validation = get_cached_section(
+            study_location, val_section, log_category, investigation_inputs,
+            lambda: validate_protocols(load_isa_tab()[0], validation_schema, inv_file, override_list, val_section,
+                                       log_category=log_category))
         all_validations.append(isa_protocol_validation)
 
     if not status:
@@ -815,9 +959,11 @@ def validate_study(study_id, study_location, user_token, obfuscation_code,
     val_section = "samples"
     sample_name_list = []
     if isa_study and validation_section == 'all' or val_section in validation_section:
-        status, amber_warning, isa_sample_validation = \
-            validate_samples(isa_study, isa_samples, validation_schema, s_file, override_list,
-                             sample_name_list, val_section, log_category=log_category)
+        status, amber_warning, isa_sample_validation = get_cached_section(
+            study_location, val_section, log_category, investigation_inputs + (isa_versions['s'],),
+            lambda: validate_samples(load_isa_tab()[0], load_isa_tab()[2], validation_schema, s_file, override_list,
+                                     sample_name_list, val_section, log_category=log_category),
+            output_lists=(sample_name_list,))
         all_validations.append(isa_sample_validation)
 
     if not status:
@@ -829,9 +975,13 @@ def validate_study(study_id, study_location, user_token, obfuscation_code,
     val_section = "files"
     file_name_list = []
     if isa_study and validation_section == 'all' or val_section in validation_section:
-        status, amber_warning, files_validation = validate_files(
-            study_id, study_location, obfuscation_code, override_list,
-            file_name_list, val_section, log_category=log_category, static_validation_file=static_validation_file)
+        folder_inputs = all_isa_inputs + (get_directory_stats(study_location), static_validation_file)
+        status, amber_warning, files_validation = get_cached_section(
+            study_location, val_section, log_category, folder_inputs,
+            lambda: validate_files(study_id, study_location, obfuscation_code, override_list, file_name_list,
+                                   val_section, log_category=log_category,
+                                   static_validation_file=static_validation_file),
+            output_lists=(file_name_list,))
         all_validations.append(files_validation)
 
     if not status:
@@ -842,9 +992,13 @@ def validate_study(study_id, study_location, user_token, obfuscation_code,
     # Validate assays
     val_section = "assays"
     if isa_study and validation_section == 'all' or val_section in validation_section or 'maf' in validation_section:
-        status, amber_warning, assay_validation = \
-            validate_assays(isa_study, study_location, validation_schema, override_list, sample_name_list,
-                            file_name_list, val_section, log_category=log_category)
+        # The assays are checked against the sample names and files found above, if those sections were validated
+        assay_inputs = (folder_inputs or all_isa_inputs + (get_directory_stats(study_location),)) + \
+            (tuple(sample_name_list), tuple(file_name_list))
+        status, amber_warning, assay_validation = get_cached_section(
+            study_location, val_section, log_category, assay_inputs,
+            lambda: validate_assays(load_isa_tab()[0], study_location, validation_schema, override_list,
+                                    sample_name_list, file_name_list, val_section, log_category=log_category))
         all_validations.append(assay_validation)
 
     if not status:
@@ -2203,6 +2357,7 @@ class OverrideValidation(Resource):
             query_list = override_validations(study_id, 'update', override=db_update_string)
         except Exception as e:
             logger.error('Could not store overridden validations on the database')
+        override_cache.pop(study_id, None)
 
         return {"success": val_feedback}
 
@@ -2213,8 +2368,8 @@ def run_validation_in_File(validations_file, study_id, study_location, user_toke
         return {"message": validation_run_msg}, 202
     # if validation file is already present - check if no update after that
     elif os.path.isfile(validations_file):
-        if is_newer_timestamp(study_location + '/DERIVED_FILES', validations_file) or is_newer_timestamp(
-                study_location + '/RAW_FILES', validations_file):
+        if is_newer_timestamp(study_location + '/DERIVED_FILES', validations_file, study_location) or \
+                is_newer_timestamp(study_location + '/RAW_FILES', validations_file, study_location):
             validation_schema = \
                 validate_study(study_id, study_location, user_token, obfuscation_code,
                                validation_section=section,
@@ -2279,16 +2434,15 @@ def submitJobToCluser(command, section, study_location):
     else:
         return {"error": message, "message": job_out, "errors": job_err}
 
-def is_newer_timestamp(location, fileToCompare):
+def is_newer_timestamp(location, fileToCompare, study_location=None):
+    # Has anything under the folder been changed after the file was written?
     need_validation_update = False
     try:
-        list_of_files = glob.glob(os.path.join(location, '*'))
-        latest_file = max(list_of_files, key=os.path.getctime)
+        updateTime = get_directory_stats(location, location=study_location).latest_ctime_ns
     except:
         return need_validation_update
-    updateTime = os.path.getctime(latest_file)
-    if os.path.getctime(fileToCompare) < updateTime:
-        need_validation_update = True  # No files modified since the validation schema files
+    if os.stat(fileToCompare).st_ctime_ns < updateTime:
+        need_validation_update = True  # Files modified since the validation schema files
     return need_validation_update
 
 class NewValidation(Resource):
@@ -2366,6 +2520,7 @@ class NewValidation(Resource):
             }
         ]
     )
+    @limit_requests('validation')
     def get(self, study_id):
 
         user_token = None
@@ -107,6 +107,74 @@ CONN_POOL_MAX = 20
 
 # Timeout in secounds when listing a large folder for files
 FILE_LIST_TIMEOUT = 90
+# Folder for the per-study file index databases (SQLite). Leave empty to always list the folders on the filesystem
+FILE_INDEX_ROOT = MTBLS_FILE_BASE + "<file index folder>/"
+# Seconds before an unchanged folder is listed again anyway, ie. to pick up files that were updated in place
+FILE_INDEX_MAX_AGE = 86400
+# Number of folders listed in parallel when listing all the files in a study
+FILE_SCAN_THREADS = 8
+# Number of files copied in parallel when copying files from the upload folder to the study folder
+FILE_COPY_THREADS = 8
+# Hard link the files instead of copying them when the source and destination are on the same filesystem. Do not turn
+# this on while the upload folders are writable by the submitters, a linked study file changes with the upload file
+FILE_COPY_HARD_LINKS = False
+# Number of files read in parallel when working out the checksums (MD5 and SHA-256) of the study files
+CHECKSUM_THREADS = 4
+# Bytes read at the time when working out the checksums
+CHECKSUM_BUFFER_SIZE = 4 * 1024 * 1024
+# Seconds between saving the worked out checksums in the file index, the index is locked while saving
+CHECKSUM_COMMIT_INTERVAL = 5
+# Maximum number of files returned per page when paging through a folder
+FILE_LIST_PAGE_SIZE = 1000
+# SQLite database with the status and progress of the background jobs (copy, sync, unzip, conversion)
+JOB_DB_FILE = MTBLS_FILE_BASE + "<jobs folder>/jobs.db"
+# Number of background jobs running at the same time, per gunicorn worker
+JOB_THREADS = 2
+# Seconds between saving the progress of a running job
+JOB_PROGRESS_INTERVAL = 2
+
+# Bytes read at the time when streaming a file or zip file download
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Let the front-end proxy send single file downloads: '' (Flask sends the file), 'x-accel-redirect' (nginx) or
+# 'x-sendfile' (Apache mod_xsendfile, lighttpd)
+DOWNLOAD_OFFLOAD = ''
+# For X-Accel-Redirect, the nginx internal location serving the files in DOWNLOAD_ACCEL_ROOT, ie.
+#   location /protected-files/ { internal; alias <DOWNLOAD_ACCEL_ROOT>/; }
+DOWNLOAD_ACCEL_ROOT = STUDY_PATH
+DOWNLOAD_ACCEL_LOCATION = "/protected-files/"
+# Folder for the cached zip files of the study metadata (file=metadata downloads). Leave empty to zip on every request
+METADATA_BUNDLE_ROOT = MTBLS_FILE_BASE + "<metadata bundle folder>/"
+
+# Limits for the heavy endpoints, per gunicorn worker. For each endpoint class:
+#   concurrent: requests running at the same time (all users)
+#   token_burst, token_rate: token bucket per user token, maximum burst of requests and requests per second after that
+#   study_burst, study_rate: token bucket per study
+# Leave a limit out to not use it. Requests over a limit get 429 Too Many Requests, with a Retry-After header
+REQUEST_LIMITS = {
+    'download': {'concurrent': 16, 'token_burst': 20, 'token_rate': 1.0, 'study_burst': 40, 'study_rate': 2.0},
+    'validation': {'concurrent': 4, 'token_burst': 5, 'token_rate': 0.2, 'study_burst': 5, 'study_rate': 0.2},
+    'file_listing': {'concurrent': 16, 'token_burst': 30, 'token_rate': 2.0, 'study_burst': 30, 'study_rate': 2.0},
+    'checksums': {'concurrent': 2, 'token_burst': 2, 'token_rate': 0.01, 'study_burst': 1, 'study_rate': 0.01}
+}
+# Different limits for some studies, ie. very large ones. A burst of 0 blocks the endpoint class for the study
+REQUEST_LIMITS_PER_STUDY = {
+    'MTBLS1405': {'download': {'study_burst': 0}}
+}
+# Seconds to wait (Retry-After) when the concurrent limit is reached, or a study is blocked
+REQUEST_LIMIT_RETRY_AFTER = 30
+# Number of token buckets (user tokens and studies) to keep track of
+REQUEST_LIMIT_BUCKETS = 10000
+
+# Number of parsed TSV tables (sample, assay, MAF) to keep in memory per worker
+TSV_CACHE_SIZE = 20
+# Number of study folders to keep the ISA-Tab file references (the text and file names) in memory for, per worker
+ISA_TAB_REFERENCE_CACHE_SIZE = 5
+# Number of study folders to keep the list of files referenced in the assays in memory for, per worker
+ASSAY_FILE_LIST_CACHE_SIZE = 50
+# Maximum number of rows returned per page when paging through a TSV table
+TSV_PAGE_SIZE = 1000
+# Number of rows read at the time when comparing two TSV files
+TSV_DIFF_CHUNK_SIZE = 10000
 
 # chebi
 REMOVED_HS_MOL_COUNT = 500
@@ -123,6 +191,17 @@ METADATA_VALIDATION_FILE = '/validation_meta.json'
 COMPLETE_VALIDATION_FILE = '/validation_complete.json'
 
 VALIDATIONS_FILE = "https://www.ebi.ac.uk/metabolights/editor/assets/configs/config20180618/validations.json"
+# Seconds between checking if the validation schema (VALIDATIONS_FILE) on the web server has changed. A local file is
+# checked on every validation
+VALIDATIONS_FILE_CHECK_INTERVAL = 300
+# Seconds the overridden validations of a study are kept in memory, per worker. A curator's change is seen at once by
+# the worker that stored it, the other workers see it after this time
+VALIDATION_OVERRIDE_CACHE_SECONDS = 60
+# Number of studies with their overridden validations kept in memory per worker
+VALIDATION_OVERRIDE_CACHE_SIZE = 1000
+# Number of validation section results (per study, section and log category) kept in memory per worker. A section is
+# only validated again when any of the files it depends on have changed
+VALIDATION_SECTION_CACHE_SIZE = 500
 
 FOLDER_EXCLUSION_LIST = ['audit', '.d', '.raw', 'metaspace', 'chebi', 'old', 'backup', 'chebi_pipeline_annotations',
                          '/audit', '/metaspace', '/chebi', '/old', '/backup', '/chebi_pipeline_annotations']
@@ -0,0 +1,86 @@
+#  EMBL-EBI MetaboLights - https://www.ebi.ac.uk/metabolights
+#  Metabolomics team
+#
+#  European Bioinformatics Institute (EMBL-EBI), European Molecular Biology Laboratory, Wellcome Genome Campus, Hinxton, Cambridge CB10 1SD, United Kingdom
+#
+#  Copyright 2026 EMBL - European Bioinformatics Institute
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+# Compare the old list based flatten/upload diff of the file listing with the set based versions
+# Usage: python -m tests.benchmark_file_listing [number of files] [include old flatten_list, slow on large folders]
+
+import sys
+import time
+from copy import deepcopy
+
+from app.ws.study_files import flatten_list, get_upload_diff
+
+
+def make_file_list(count, prefix='', status='active'):
+    return [{"file": prefix + 'Sample-' + str(idx) + '.raw', "createdAt": "June 02 2020 10:11:12",
+             "timestamp": "20200602101112", "type": "raw", "status": status, "directory": False}
+            for idx in range(count)]
+
+
+def old_flatten_list(list_name, flat_list=None):
+    if not flat_list:
+        flat_list = []
+    for entry in list_name:
+        if isinstance(entry, list):
+            for sub_entry in entry:
+                if isinstance(sub_entry, list):
+                    old_flatten_list(sub_entry, flat_list=flat_list)
+                elif sub_entry not in flat_list and type(sub_entry) != bool:
+                    flat_list.append(sub_entry)
+        else:
+            if type(entry) != bool and entry not in flat_list:
+                flat_list.append(entry)
+    return flat_list
+
+
+def old_upload_diff(study_files, upload_files):
+    u_files = deepcopy(upload_files)
+    for row in u_files:
+        row.pop('status')
+    s_files = deepcopy(study_files)
+    for row in s_files:
+        row.pop('status')
+    return [dict(i) for i in
+            {frozenset(row.items()) for row in u_files} - {frozenset(row.items()) for row in s_files}]
+
+
+def timed(name, function, *args):
+    start = time.time()
+    result = function(*args)
+    print("  %-12s %.3fs" % (name, time.time() - start))
+    return result
+
+
+def main(count=100000, include_old_flatten=False):
+    # Half of the upload folder has already been copied to the study folder
+    study_files = make_file_list(count)
+    upload_files = make_file_list(count // 2, status='unreferenced') + make_file_list(count // 2, prefix='new_')
+
+    print("Upload diff, " + str(count) + " files in each folder")
+    old = timed("old", old_upload_diff, study_files, upload_files)
+    new = timed("new", get_upload_diff, study_files, upload_files)
+    assert sorted(old, key=lambda row: row['file']) == sorted(new, key=lambda row: row['file'])
+
+    tree = [study_files[:count // 2], [study_files[count // 2:], [True]], study_files[:10]]
+    print("Flatten " + str(count) + " files")
+    new = timed("new", flatten_list, tree)
+    if include_old_flatten:
+        old = timed("old", old_flatten_list, tree)
+        assert old == new
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+         len(sys.argv) > 2 and sys.argv[2].lower() == 'true')
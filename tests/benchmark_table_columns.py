@@ -0,0 +1,100 @@
+#  EMBL-EBI MetaboLights - https://www.ebi.ac.uk/metabolights
+#  Metabolomics team
+#
+#  European Bioinformatics Institute (EMBL-EBI), European Molecular Biology Laboratory, Wellcome Genome Campus, Hinxton, Cambridge CB10 1SD, United Kingdom
+#
+#  Copyright 2026 EMBL - European Bioinformatics Institute
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+# Compare adding columns one by one (the old ComplexColumns.post loop) with the bulk insert_columns()
+# Usage: python -m tests.benchmark_table_columns [rows] [existing columns] [new columns]
+
+import os
+import sys
+import tempfile
+import timeit
+
+import pandas as pd
+
+from app.ws.table_editor import insert_columns, delete_columns
+from app.ws.utils import read_tsv, write_tsv
+
+
+def make_sample_sheet(rows, columns):
+    return pd.DataFrame({'Characteristics[col' + str(col) + ']': ['value ' + str(row) for row in range(rows)]
+                         for col in range(columns)}, dtype=str)
+
+
+def make_new_columns(count):
+    return [{'name': 'Characteristics[new' + str(col) + ']', 'index': 1 + col, 'value': ''} for col in range(count)]
+
+
+def insert_one_by_one(table_df, new_columns):
+    table_df = table_df.copy()
+    for column in new_columns:
+        new_col = []
+        for row_val in range(table_df.shape[0]):
+            new_col.append(column['value'])
+        try:
+            header_name = table_df.iloc[:, column['index']].name
+        except:
+            header_name = ""
+        if header_name == column['name']:
+            table_df.iloc[:, column['index']] = new_col
+        else:
+            table_df.insert(loc=int(column['index']), column=column['name'], value=new_col, allow_duplicates=True)
+    return table_df
+
+
+def delete_one_by_one(tsv_file, columns):
+    # The old code read and wrote the file for every column
+    for column in columns:
+        table_df = read_tsv(tsv_file)
+        table_df.drop(column, axis=1, inplace=True)
+        write_tsv(table_df, tsv_file)
+
+
+def delete_bulk(tsv_file, columns):
+    table_df = read_tsv(tsv_file)
+    table_df, not_found = delete_columns(table_df, columns)
+    write_tsv(table_df, tsv_file)
+
+
+def main(rows=50000, existing_columns=40, new_column_count=12, repeat=5):
+    table_df = make_sample_sheet(rows, existing_columns)
+    new_columns = make_new_columns(new_column_count)
+
+    old_df = insert_one_by_one(table_df, new_columns)
+    new_df = insert_columns(table_df, new_columns, update_existing=True)
+    assert list(old_df.columns) == list(new_df.columns), "Column order differs"
+    assert (old_df.values == new_df.values).all(), "Column values differ"
+
+    print("Table with " + str(rows) + " rows, " + str(existing_columns) + " columns, adding "
+          + str(new_column_count) + " columns")
+    print("  one by one: %.4fs" % min(timeit.repeat(lambda: insert_one_by_one(table_df, new_columns),
+                                                   number=1, repeat=repeat)))
+    print("  bulk:       %.4fs" % min(timeit.repeat(lambda: insert_columns(table_df, new_columns,
+                                                                         update_existing=True),
+                                                   number=1, repeat=repeat)))
+
+    drop = [column['name'] for column in new_columns]
+    print("Removing " + str(len(drop)) + " columns, reading and writing the file")
+    with tempfile.TemporaryDirectory() as folder:
+        tsv_file = os.path.join(folder, 's_benchmark.txt')
+        for name, function in (('one by one:', delete_one_by_one), ('bulk:      ', delete_bulk)):
+            times = []
+            for _ in range(repeat):
+                write_tsv(new_df.copy(), tsv_file)  # Start from the same file every time
+                times.append(timeit.timeit(lambda: function(tsv_file, drop), number=1))
+            print("  " + name + " %.4fs" % min(times))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:4]])
@@ -0,0 +1,91 @@
+#  EMBL-EBI MetaboLights - https://www.ebi.ac.uk/metabolights
+#  Metabolomics team
+#
+#  European Bioinformatics Institute (EMBL-EBI), European Molecular Biology Laboratory, Wellcome Genome Campus, Hinxton, Cambridge CB10 1SD, United Kingdom
+#
+#  Copyright 2026 EMBL - European Bioinformatics Institute
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from flask import Flask
+
+from app.ws.file_copy import copy_folder, get_member_path
+from app.ws.jobs import JobRunner
+
+file_count = 20
+file_size = 1000
+
+
+def copy_job(source, destination, progress=None):
+    return copy_folder(source, destination, progress=progress).to_dict()
+
+
+class CopyFolderJobTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, 'upload')
+        self.destination = os.path.join(self.folder, 'study')
+        os.makedirs(os.path.join(self.source, 'RAW_FILES'))
+        for idx in range(file_count):
+            with open(os.path.join(self.source, 'RAW_FILES', 'Sample-' + str(idx) + '.raw'), 'wb') as raw_file:
+                raw_file.write(os.urandom(file_size))
+
+        self.app = Flask(__name__)
+        self.app.config.update(JOB_DB_FILE=os.path.join(self.folder, 'jobs', 'jobs.db'), JOB_THREADS=1,
+                               JOB_PROGRESS_INTERVAL=0, FILE_COPY_THREADS=4, FILE_COPY_HARD_LINKS=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def get_finished_job(self, runner, job_id):
+        with self.app.app_context():
+            for _ in range(300):
+                job = runner.get_job(job_id)
+                if job['status'] not in ('queued', 'running'):
+                    return job
+                time.sleep(0.1)
+        self.fail('Job ' + job_id + ' did not finish')
+
+    def test_copy_folder_with_job_progress(self):
+        # The copy threads report the progress without an application context
+        runner = JobRunner()
+        with self.app.app_context():
+            job_id = runner.submit('copy', 'MTBLS1', copy_job, self.source, self.destination)
+        job = self.get_finished_job(runner, job_id)
+
+        self.assertEqual(job['status'], 'done', job['message'])
+        self.assertEqual(job['files_done'], file_count)
+        self.assertEqual(job['files_total'], file_count)
+        self.assertEqual(job['bytes_done'], file_count * file_size)
+        self.assertEqual(job['result']['errors'], 0)
+        self.assertEqual(len(os.listdir(os.path.join(self.destination, 'RAW_FILES'))), file_count)
+
+
+class ZipMemberPathTests(unittest.TestCase):
+
+    def test_member_in_folder(self):
+        self.assertEqual(get_member_path('/study', 'RAW_FILES/Sample-1.raw'), '/study/RAW_FILES/Sample-1.raw')
+        self.assertEqual(get_member_path('/study', 'RAW_FILES/../Sample-1.raw'), '/study/Sample-1.raw')
+        self.assertEqual(get_member_path('/study', 'RAW_FILES\\Sample-1.raw'), '/study/RAW_FILES/Sample-1.raw')
+
+    def test_member_outside_folder(self):
+        for member_name in ('../Sample-1.raw', 'RAW_FILES/../../Sample-1.raw', '..\\Sample-1.raw', '/etc/passwd',
+                            '/study/Sample-1.raw', '.', '../study2/Sample-1.raw'):
+            self.assertIsNone(get_member_path('/study', member_name), member_name)
+
+
+if __name__ == '__main__':
+    unittest.main()
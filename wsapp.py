@@ -38,6 +38,7 @@ from app.ws.isaAssay import *
 from app.ws.isaInvestigation import IsaInvestigation
 from app.ws.isaStudy import *
 from app.ws.jira_update import Jira
+from app.ws.jobs import StudyJob
 from app.ws.metaspace_pipeline import MetaspacePipeLine
 from app.ws.mtblsStudy import *
 from app.ws.mtbls_maf import *
@@ -51,9 +52,10 @@ from app.ws.send_files import SendFiles
 from app.ws.spectra import ExtractMSSpectra
 from app.ws.stats import StudyStats
 from app.ws.study_actions import StudyStatus,ToggleAccess,ToggleAccessGet
-from app.ws.study_files import StudyFiles, StudyFilesTree, SampleStudyFiles, UnzipFiles, CopyFilesFolders,SyncFolder,FileList
+from app.ws.study_files import StudyFiles, StudyFilesTree, StudyFilesTreeExpand, StudyFileChecksums, SampleStudyFiles, UnzipFiles, CopyFilesFolders,SyncFolder,FileList
 from app.ws.table_editor import *
 from app.ws.user_management import UserManagement
+from app.ws.utils import load_assay_templates
 from app.ws.validation import Validation, OverrideValidation, UpdateValidationFile,NewValidation
 from app.ws.pathway import keggid
 
@@ -74,6 +76,7 @@ def configure_app(flask_app):
 
 def initialize_app(flask_app):
     configure_app(flask_app)
+    load_assay_templates()  # Parse the assay master template once, not for every assay request
 
     CORS(application, resources={application.config.get('CORS_RESOURCES_PATH')},
          origins={application.config.get('CORS_HOSTS')},
@@ -100,6 +103,8 @@ def initialize_app(flask_app):
     api.add_resource(StudyFiles, res_path + "/studies/<string:study_id>/files")
     api.add_resource(FileList, res_path + "/studies/<string:study_id>/fileslist")
     api.add_resource(StudyFilesTree, res_path + "/studies/<string:study_id>/files/tree")
+    api.add_resource(StudyFilesTreeExpand, res_path + "/studies/<string:study_id>/files/tree/expand")
+    api.add_resource(StudyFileChecksums, res_path + "/studies/<string:study_id>/files/checksums")
     api.add_resource(SampleStudyFiles, res_path + "/studies/<string:study_id>/files/samples")
     api.add_resource(SendFiles,
                      res_path + "/studies/<string:study_id>/download",
@@ -120,6 +125,7 @@ def initialize_app(flask_app):
     api.add_resource(CopyFilesFolders, res_path + "/studies/<string:study_id>/sync")
     api.add_resource(SyncFolder, res_path + "/studies/<string:study_id>/dir_sync")
     api.add_resource(AuditFiles, res_path + "/studies/<string:study_id>/audit")
+    api.add_resource(StudyJob, res_path + "/studies/<string:study_id>/jobs/<string:job_id>")
     api.add_resource(StudyMetaInfo, res_path + "/studies/<string:study_id>/meta-info")
 
     # ISA Investigation